@@ -0,0 +1,203 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from .keycloak import get_client
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+
+class AdminTokenError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AdminTokenManager:
+    """
+    Keycloak admin token cached until shortly before it expires.
+
+    The token is shared by every worker through the default cache. Renewal is
+    single-flight: threads of a worker wait on a local lock and workers take
+    a Redis lock, so one of them renews (with the refresh token when it is
+    still valid) while the others pick up the token it stored.
+    """
+
+    CACHE_KEY = 'keycloak:admin-token'
+    LOCK_KEY = 'keycloak:admin-token:lock'
+
+    def __init__(self, skew=30, lock_timeout=10):
+        self.skew = skew
+        self.lock_timeout = lock_timeout
+        self._token = None
+        self._lock = threading.Lock()
+
+    def get_token(self):
+        token = self._token
+        if self._is_fresh(token):
+            return token['access_token']
+
+        with self._lock:
+            token = self._token
+            if not self._is_fresh(token):
+                token = self._shared_token()
+            if not self._is_fresh(token):
+                with self._distributed_lock():
+                    # Another worker may have renewed while we waited for the lock
+                    token = self._shared_token()
+                    if not self._is_fresh(token):
+                        token = self._renew(token or self._token)
+                        self._store(token)
+            self._token = token
+            return token['access_token']
+
+    async def aget_token(self):
+        token = self._token
+        if self._is_fresh(token):
+            return token['access_token']
+        # Renewal waits on locks, Redis and Keycloak; it's rare enough to run
+        # the sync path in a worker thread instead of blocking the event loop
+        return await sync_to_async(self.get_token, thread_sensitive=False)()
+
+    def invalidate(self, access_token):
+        """
+        Drop a token Keycloak no longer accepts (e.g. after an admin session reset)
+        """
+        with self._lock:
+            if self._token and self._token['access_token'] == access_token:
+                self._token = None
+            shared = self._shared_token()
+            if shared and shared['access_token'] == access_token:
+                try:
+                    cache.delete(self.CACHE_KEY)
+                except Exception as e:
+                    logger.warning("Failed to drop the shared admin token: %s", e)
+
+    def _is_fresh(self, token):
+        return token is not None and token['expires_at'] - self.skew > time.time()
+
+    def _renew(self, previous):
+        client = get_client()
+        if previous and previous.get('refresh_token') and previous['refresh_expires_at'] - self.skew > time.time():
+            response = client.refresh_admin_token(previous['refresh_token'])
+            if response.status_code == 200:
+                logger.debug("Refreshed Keycloak admin token")
+                return self._parse(response.json())
+            logger.warning("Admin token refresh failed with status %s, logging in again", response.status_code)
+
+        response = client.admin_token()
+        if response.status_code != 200:
+            raise AdminTokenError('Failed to authenticate with Keycloak admin', response.status_code)
+        logger.debug("Obtained Keycloak admin token")
+        return self._parse(response.json())
+
+    @staticmethod
+    def _parse(data):
+        now = time.time()
+        return {
+            'access_token': data['access_token'],
+            'expires_at': now + data.get('expires_in', 60),
+            'refresh_token': data.get('refresh_token'),
+            'refresh_expires_at': now + data.get('refresh_expires_in', 0),
+        }
+
+    def _shared_token(self):
+        try:
+            return cache.get(self.CACHE_KEY)
+        except Exception as e:
+            logger.warning("Shared admin token unavailable: %s", e)
+            return None
+
+    def _store(self, token):
+        timeout = int(max(token['expires_at'], token['refresh_expires_at']) - time.time())
+        if timeout <= 0:
+            return
+        try:
+            cache.set(self.CACHE_KEY, token, timeout)
+        except Exception as e:
+            logger.warning("Failed to share the admin token: %s", e)
+
+    @contextlib.contextmanager
+    def _distributed_lock(self):
+        # Only django_redis provides locks, other cache backends renew per worker
+        if not hasattr(cache, 'lock'):
+            yield
+            return
+        lock = cache.lock(self.LOCK_KEY, timeout=self.lock_timeout, blocking_timeout=self.lock_timeout)
+        try:
+            acquired = lock.acquire()
+        except Exception as e:
+            logger.warning("Admin token lock unavailable: %s", e)
+            acquired = False
+        try:
+            yield
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except Exception as e:
+                    logger.warning("Failed to release the admin token lock: %s", e)
+
+
+# Shared by every request handled by this process
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = AdminTokenManager(skew=settings.KEYCLOAK_ADMIN_TOKEN_SKEW)
+    return _manager
+
+
+def get_admin_token():
+    return get_manager().get_token()
+
+
+def call_with_admin_token(func, *args, **kwargs):
+    """
+    Call ``func(admin_token, ...)``, retrying once with a new token if Keycloak
+    answers 401 to a token we still considered valid
+    """
+    manager = get_manager()
+    admin_token = manager.get_token()
+    response = func(admin_token, *args, **kwargs)
+    if response.status_code == 401:
+        logger.warning("Keycloak rejected the cached admin token, renewing")
+        manager.invalidate(admin_token)
+        response = func(manager.get_token(), *args, **kwargs)
+    return response
+
+
+async def acall_with_admin_token(func, *args, **kwargs):
+    """
+    call_with_admin_token() for the async client's endpoint methods
+    """
+    manager = get_manager()
+    admin_token = await manager.aget_token()
+    response = await func(admin_token, *args, **kwargs)
+    if response.status_code == 401:
+        logger.warning("Keycloak rejected the cached admin token, renewing")
+        await sync_to_async(manager.invalidate, thread_sensitive=False)(admin_token)
+        response = await func(await manager.aget_token(), *args, **kwargs)
+    return response
+
+
+def _reset_after_fork():
+    global _manager, _manager_lock
+    _manager = None
+    _manager_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.decorators import permission_classes, throttle_classes
+from rest_framework.permissions import AllowAny
+
+from core import deadline
+from core.deadline import DeadlineExceeded
+from users.models import email_is
+
+from .admin_token import AdminTokenError, acall_with_admin_token
+from .decorators import async_api_view
+from .keycloak import KeycloakUnavailable, get_async_client
+from .ratelimit import LoginRateThrottle, RegisterRateThrottle
+from .views import create_local_user, created_user_id, keycloak_user_representation, password_grant
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+# Async versions of the Keycloak-bound endpoints, served instead of the DRF
+# views in api.views when ASYNC_VIEWS is enabled (the ASGI entry point). They
+# take the same requests, authenticated by the same DEFAULT_AUTHENTICATION_CLASSES,
+# and return the same responses.
+
+
+def keycloak_unavailable(exc):
+    logger.warning("Keycloak %s unavailable, retry after %ss", exc.operation, exc.wait)
+    return JsonResponse({'error': str(exc.detail)}, status=exc.status_code, headers={'Retry-After': str(exc.wait)})
+
+
+async def adelete_created_user(client, keycloak_id):
+    delete_response = await acall_with_admin_token(client.delete_user, keycloak_id)
+    if delete_response.status_code not in (204, 404):
+        logger.error("Failed to remove Keycloak user %s: %s", keycloak_id, delete_response.status_code)
+
+
+async def aremove_created_user(client, username):
+    response = await acall_with_admin_token(client.find_users, username=username, exact='true')
+    if response.status_code != 200:
+        logger.error("Failed to look up Keycloak user %s for removal: %s", username, response.status_code)
+        return
+    # Keycloak stores usernames in lower case
+    for user in response.json():
+        if user.get('username', '').lower() == username.lower():
+            await adelete_created_user(client, user['id'])
+
+
+@async_api_view(['POST'])
+@permission_classes([AllowAny])
+@throttle_classes([RegisterRateThrottle])
+async def register(request):
+    username = request.data.get('username')
+    email = request.data.get('email')
+    password = request.data.get('password')
+
+    if not all([username, email, password]):
+        logger.error("Registration failed: Missing fields")
+        return JsonResponse({'error': 'All fields are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # One query checks both unique fields
+    taken = [
+        taken_username async for taken_username in
+        User.objects.filter(Q(username=username) | Q(email_is(email))).values_list('username', flat=True)[:2]
+    ]
+    if taken:
+        if username in taken:
+            logger.error("Registration failed: Username %s already exists", username)
+            return JsonResponse({'error': 'Username already exists'}, status=status.HTTP_400_BAD_REQUEST)
+        logger.error("Registration failed: Email %s already exists", email)
+        return JsonResponse({'error': 'Email already exists'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Register user in Keycloak
+    try:
+        client = get_async_client()
+
+        create_user_response = await acall_with_admin_token(
+            client.create_user, keycloak_user_representation(username, email, password))
+
+        if create_user_response.status_code != 201:
+            logger.error("Failed to create user in Keycloak: %.200s", create_user_response.text)
+            return JsonResponse({'error': 'Failed to create user in Keycloak'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        keycloak_id = created_user_id(create_user_response)
+        if not keycloak_id:
+            logger.error("Keycloak did not return the created user's location, removing user %s", username)
+            with deadline.suspended():
+                await asyncio.shield(aremove_created_user(client, username))
+            return JsonResponse({'error': 'Failed to get user ID from Keycloak'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # Transactions need a single thread, run the insert through the sync ORM
+        try:
+            await sync_to_async(create_local_user)(username, email, password, keycloak_id)
+        except Exception as e:
+            # Don't leave an account in Keycloak that Django doesn't know about
+            logger.error("Failed to create user %s in Django, removing it from Keycloak: %s", username, e)
+            # Finish even when the request is cancelled at its deadline
+            with deadline.suspended():
+                await asyncio.shield(adelete_created_user(client, keycloak_id))
+            raise
+
+        logger.info("User %s created successfully with Keycloak ID: %s", username, keycloak_id)
+        return JsonResponse({'message': 'User registered successfully'}, status=status.HTTP_201_CREATED)
+
+    except AdminTokenError:
+        logger.error("Failed to authenticate with Keycloak admin")
+        return JsonResponse({'error': 'Failed to authenticate with Keycloak admin'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except KeycloakUnavailable as e:
+        return keycloak_unavailable(e)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        return JsonResponse({'error': f'Registration error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@async_api_view(['POST'])
+@permission_classes([AllowAny])
+@throttle_classes([LoginRateThrottle])
+async def login(request):
+    username = request.data.get('username')
+    password = request.data.get('password')
+    logger.debug("Login attempt for user: %s", username)
+
+    if not all([username, password]):
+        logger.error("Login failed: Missing fields")
+        return JsonResponse({'error': 'Username and password are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        response = await get_async_client().token(password_grant(username, password))
+
+        if response.status_code != 200:
+            logger.error("Login failed: %s - %.200s", response.status_code, response.text)
+            if response.status_code == 401:
+                return JsonResponse({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
+            return JsonResponse({'error': 'Authentication failed'}, status=status.HTTP_400_BAD_REQUEST)
+
+        token_data = response.json()
+        logger.info("User %s logged in successfully", username)
+        return JsonResponse({
+            'token': token_data['access_token'],
+            'refresh_token': token_data.get('refresh_token'),
+        })
+    except KeycloakUnavailable as e:
+        return keycloak_unavailable(e)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.error("Login error: %s", e)
+        return JsonResponse({'error': f'Authentication error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
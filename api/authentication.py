@@ -1,64 +1,281 @@
+from asgiref.sync import sync_to_async
 from rest_framework.authentication import BaseAuthentication, get_authorization_header
-from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.exceptions import APIException, AuthenticationFailed
 from django.contrib.auth.models import User
-import requests
+import hashlib
+import jwt
+import time
 from django.conf import settings
-import json
 import logging
+from core.cache import TwoTierCache
+from users.cache import aget_cached_user, cache_user, get_cached_user
+from users.models import UserProfile, get_user_by_subject
+from .jwks import get_key_set
+from .keycloak import KeycloakUnavailable, get_async_client, get_client
 
 # Initialize logger
 logger = logging.getLogger(__name__)
 
+# (verified_at, claims) of verified tokens keyed by a hash of the bearer token,
+# kept until the token expires
+token_cache = TwoTierCache('auth:token', max_entries=settings.KEYCLOAK_TOKEN_CACHE_SIZE)
+
 class KeycloakAuthentication(BaseAuthentication):
     """
     Custom authentication class for Keycloak JWT tokens
     """
 
     def authenticate(self, request):
+        token = self.get_bearer_token(request)
+        if token is None:
+            return None
+
+        try:
+            user_info = self.verify_token(token)
+            logger.debug("User info received: %s", user_info.get('preferred_username'))
+
+            user = self.get_user(user_info)
+            return (user, token)
+
+        except APIException:
+            # AuthenticationFailed, or KeycloakUnavailable while its circuit is open
+            raise
+        except Exception as e:
+            logger.error("Authentication error: %s", e)
+            raise AuthenticationFailed(f'Authentication error: {str(e)}')
+
+    async def aauthenticate(self, request):
+        """
+        authenticate() for the async views: cached tokens and users are resolved
+        on the event loop, Keycloak is called with the async client
+        """
+        token = self.get_bearer_token(request)
+        if token is None:
+            return None
+
+        try:
+            user_info = await self.averify_token(token)
+            logger.debug("User info received: %s", user_info.get('preferred_username'))
+
+            user = await self.aget_user(user_info)
+            return (user, token)
+
+        except APIException:
+            # AuthenticationFailed, or KeycloakUnavailable while its circuit is open
+            raise
+        except Exception as e:
+            logger.error("Authentication error: %s", e)
+            raise AuthenticationFailed(f'Authentication error: {str(e)}')
+
+    def get_bearer_token(self, request):
         auth_header = get_authorization_header(request).decode('utf-8')
-        
+
         if not auth_header or not auth_header.startswith('Bearer '):
             logger.debug("No Bearer token found in request")
             return None
-        
-        token = auth_header.split(' ')[1]
-        logger.debug("Verifying token with Keycloak")
-        print(f"Verifying token with Keycloak")  # Debugging line to print the token
-        
-        try:
-            # Verify token with Keycloak
-            response = requests.get(
-                settings.OIDC_OP_USER_ENDPOINT,
-                headers={
-                    'Authorization': f'Bearer {token}'
-                }
-            )
-            
-            logger.debug(f"Keycloak response status: {response.status_code}")
-            if response.status_code != 200:
-                logger.error(f"Token verification failed: {response.text}")
-                raise AuthenticationFailed('Invalid token or token expired')
-            
-            user_info = response.json()
-            logger.debug(f"User info received: {user_info.get('preferred_username')}")
-            
-            # Get or create the user
-            try:
-                user = User.objects.get(username=user_info['preferred_username'])
-                logger.debug(f"Found existing user: {user.username}")
-            except User.DoesNotExist:
+
+        return auth_header.split(' ')[1]
+
+    def get_user(self, user_info):
+        """
+        Resolve the Django user (with its profile) for the token's Keycloak subject
+        """
+        keycloak_id = user_info.get('sub')
+        if not keycloak_id:
+            raise AuthenticationFailed('Token is missing the sub claim')
+
+        user = get_cached_user(keycloak_id)
+        if user is not None:
+            return user
+        return self.get_or_create_user(keycloak_id, user_info)
+
+    async def aget_user(self, user_info):
+        keycloak_id = user_info.get('sub')
+        if not keycloak_id:
+            raise AuthenticationFailed('Token is missing the sub claim')
+
+        user = await aget_cached_user(keycloak_id)
+        if user is not None:
+            return user
+        # Cache misses (first login, linking, provisioning) take the sync path
+        return await sync_to_async(self.get_or_create_user)(keycloak_id, user_info)
+
+    def get_or_create_user(self, keycloak_id, user_info):
+        user = get_user_by_subject(keycloak_id)
+        if user is None:
+            # Accounts created before their Keycloak ID was recorded are linked once by username
+            user = User.objects.select_related('userprofile').filter(username=user_info['preferred_username']).first()
+            if user is None:
                 # Create a new user if they don't exist in Django but exist in Keycloak
-                logger.debug(f"Creating new user: {user_info['preferred_username']}")
-                user = User.objects.create_user(
+                logger.debug("Creating new user: %s", user_info['preferred_username'])
+                user = User(
                     username=user_info['preferred_username'],
-                    email=user_info.get('email', ''),
+                    email=User.objects.normalize_email(user_info.get('email', '')),
                 )
-            
-            return (user, token)
-        
-        except Exception as e:
-            logger.error(f"Authentication error: {str(e)}")
-            raise AuthenticationFailed(f'Authentication error: {str(e)}')
-        
+                user.set_unusable_password()
+                user.keycloak_id = keycloak_id
+                user.save()
+            else:
+                self.link_user(user, keycloak_id)
+
+        cache_user(keycloak_id, user)
+        return user
+
+    def link_user(self, user, keycloak_id):
+        try:
+            profile = user.userprofile
+        except UserProfile.DoesNotExist:
+            user.userprofile = UserProfile.objects.create(user=user, keycloak_id=keycloak_id)
+            return
+        if profile.keycloak_id and profile.keycloak_id != keycloak_id:
+            logger.error("User %s is linked to another Keycloak account", user.username)
+            raise AuthenticationFailed('User is linked to another Keycloak account')
+        logger.debug("Linking user %s to Keycloak ID %s", user.username, keycloak_id)
+        UserProfile.objects.filter(pk=profile.pk).update(keycloak_id=keycloak_id)
+        profile.keycloak_id = keycloak_id
+
+    def verify_token(self, token):
+        """
+        Return the token's claims, verifying it again only once the cached
+        result is older than KEYCLOAK_TOKEN_CACHE_TTL
+        """
+        cache_key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        cached = token_cache.get(cache_key)
+        if self.is_fresh(cached):
+            return cached[1]
+
+        try:
+            if settings.KEYCLOAK_TOKEN_VERIFICATION == 'userinfo':
+                user_info = self.fetch_userinfo(token)
+                expires_at = self.token_expiry(token)
+            else:
+                user_info = self.decode_token(token)
+                expires_at = user_info.get('exp')
+        except KeycloakUnavailable:
+            if cached is None:
+                raise
+            return self.stale_result(cached)
+
+        timeout = self.cache_timeout(expires_at)
+        if timeout:
+            token_cache.set(cache_key, (time.time(), user_info), timeout)
+        return user_info
+
+    async def averify_token(self, token):
+        cache_key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        cached = await token_cache.aget(cache_key)
+        if self.is_fresh(cached):
+            return cached[1]
+
+        try:
+            if settings.KEYCLOAK_TOKEN_VERIFICATION == 'userinfo':
+                user_info = await self.afetch_userinfo(token)
+                expires_at = self.token_expiry(token)
+            else:
+                user_info = await self.adecode_token(token)
+                expires_at = user_info.get('exp')
+        except KeycloakUnavailable:
+            if cached is None:
+                raise
+            return self.stale_result(cached)
+
+        timeout = self.cache_timeout(expires_at)
+        if timeout:
+            await token_cache.aset(cache_key, (time.time(), user_info), timeout)
+        return user_info
+
+    def is_fresh(self, cached):
+        return cached is not None and time.time() - cached[0] < settings.KEYCLOAK_TOKEN_CACHE_TTL
+
+    def stale_result(self, cached):
+        # While Keycloak is unavailable, tokens it accepted earlier stay valid
+        # until they expire (the cache entry is dropped at the token's exp)
+        logger.warning("Keycloak unavailable, using a stale token verification result")
+        return cached[1]
+
+    def cache_timeout(self, expires_at):
+        # Never keep a verification result past the token's own expiry
+        if not expires_at:
+            return None
+        timeout = expires_at - time.time()
+        return timeout if timeout > 0 else None
+
+    def token_expiry(self, token):
+        """
+        Read exp from a token Keycloak has already accepted, None for opaque tokens
+        """
+        try:
+            return jwt.decode(token, options={'verify_signature': False}).get('exp')
+        except jwt.PyJWTError:
+            return None
+
+    def decode_token(self, token):
+        """
+        Verify the token signature and claims locally against the realm JWKS
+        """
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+            signing_key = get_key_set().get_key(kid)
+            if signing_key is None:
+                raise jwt.InvalidKeyError(f'Unknown signing key: {kid}')
+            claims = jwt.decode(
+                token,
+                signing_key,
+                algorithms=[settings.OIDC_RP_SIGN_ALGO],
+                issuer=settings.KEYCLOAK_ISSUER,
+                leeway=settings.KEYCLOAK_TOKEN_LEEWAY,
+                options={'require': ['exp', 'iss', 'sub'], 'verify_aud': False},
+            )
+        except jwt.PyJWTError as e:
+            logger.debug("Token verification failed: %s", e)
+            raise AuthenticationFailed('Invalid token or token expired')
+
+        # Keycloak access tokens carry the requesting client in `azp`, while
+        # `aud` usually lists the resource servers (e.g. "account")
+        audience = claims.get('aud') or []
+        if isinstance(audience, str):
+            audience = [audience]
+        if settings.KEYCLOAK_AUDIENCE not in audience and claims.get('azp') != settings.KEYCLOAK_AUDIENCE:
+            logger.debug("Token issued for another client: %s", claims.get('azp'))
+            raise AuthenticationFailed('Invalid token or token expired')
+
+        if 'preferred_username' not in claims:
+            raise AuthenticationFailed('Token is missing the preferred_username claim')
+
+        return claims
+
+    async def adecode_token(self, token):
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+        except jwt.PyJWTError:
+            kid = None
+        if get_key_set().is_current(kid):
+            return self.decode_token(token)
+        # Fetching the JWKS blocks, do it in a worker thread
+        return await sync_to_async(self.decode_token, thread_sensitive=False)(token)
+
+    def fetch_userinfo(self, token):
+        """
+        Verify the token by asking Keycloak's userinfo endpoint
+        """
+        logger.debug("Verifying token with Keycloak")
+        response = get_client().userinfo(token)
+
+        if response.status_code != 200:
+            logger.error("Token verification failed: %.200s", response.text)
+            raise AuthenticationFailed('Invalid token or token expired')
+
+        return response.json()
+
+    async def afetch_userinfo(self, token):
+        logger.debug("Verifying token with Keycloak")
+        response = await get_async_client().userinfo(token)
+
+        if response.status_code != 200:
+            logger.error("Token verification failed: %.200s", response.text)
+            raise AuthenticationFailed('Invalid token or token expired')
+
+        return response.json()
+
     def authenticate_header(self, request):
-        return 'Bearer'
\ No newline at end of file
+        return 'Bearer'
@@ -0,0 +1,131 @@
+import logging
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f'Circuit {name} is open')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for one Keycloak operation.
+
+    After ``failure_threshold`` failures in a row the circuit opens and calls
+    fail fast for ``recovery_timeout`` seconds. It then half-opens and lets
+    ``half_open_max_calls`` probes through: a successful probe closes the
+    circuit, a failed one opens it again. A threshold of 0 disables it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_started_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError unless the call may go through
+        """
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN:
+                # A probe that never reported back doesn't block the circuit forever
+                if self._probes < self.half_open_max_calls or now - self._probe_started_at >= self.recovery_timeout:
+                    if self._probes >= self.half_open_max_calls:
+                        self._probes = 0
+                    self._probes += 1
+                    self._probe_started_at = now
+                    return
+                retry_after = self.recovery_timeout - (now - self._probe_started_at)
+            else:
+                retry_after = self.recovery_timeout - (now - self._opened_at)
+            raise CircuitOpenError(self.name, max(math.ceil(retry_after), 1))
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("Circuit %s closed", self.name)
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            self._failures += 1
+            if state == self.HALF_OPEN or (
+                state == self.CLOSED and self.failure_threshold and self._failures >= self.failure_threshold
+            ):
+                logger.warning("Circuit %s opened after %s failures", self.name, self._failures)
+                self._state = self.OPEN
+                self._opened_at = now
+
+    def _current_state(self, now):
+        # Must be called with self._lock held
+        if self._state == self.OPEN and now - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+
+# One breaker per Keycloak operation, shared by every thread of the process
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(
+                    name,
+                    failure_threshold=settings.KEYCLOAK_BREAKER_THRESHOLDS.get(
+                        name, settings.KEYCLOAK_BREAKER_FAILURE_THRESHOLD),
+                    recovery_timeout=settings.KEYCLOAK_BREAKER_RECOVERY_TIMEOUT,
+                )
+    return breaker
+
+
+def breaker_states():
+    return {name: breaker.state for name, breaker in sorted(_breakers.items())}
+
+
+def _reset_after_fork():
+    global _breakers, _breakers_lock
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
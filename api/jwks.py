@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+import time
+
+import jwt
+from django.conf import settings
+
+from .keycloak import get_client
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+
+class JWKSKeySet:
+    """
+    Realm signing keys parsed once into public-key objects and indexed by kid.
+
+    Keys are refreshed in a background thread shortly before they expire. A
+    token signed with an unknown kid (Keycloak key rotation) triggers a single
+    refetch that concurrent threads wait on instead of each fetching the JWKS
+    themselves, and refetches are rate limited to one per
+    ``min_refetch_interval`` seconds per process.
+    """
+
+    def __init__(self, max_age=300, refresh_ahead=60, min_refetch_interval=30):
+        self.max_age = max_age
+        self.refresh_ahead = min(refresh_ahead, max_age)
+        self.min_refetch_interval = min_refetch_interval
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._refreshing_lock = threading.Lock()
+
+    def get_key(self, kid):
+        """
+        Return the public key for ``kid`` or None if the realm doesn't have it
+        """
+        now = time.monotonic()
+        if now >= self._expires_at:
+            self.refresh(min_expires_at=now)
+        elif now >= self._expires_at - self.refresh_ahead and not self._fetched_recently(now):
+            self.refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None:
+            key = self._refetch_for(kid)
+        return key
+
+    def is_current(self, kid):
+        """
+        True when get_key(kid) can answer without fetching the JWKS
+        """
+        return kid in self._keys and time.monotonic() < self._expires_at
+
+    def refresh(self, min_expires_at=None, rate_limited=False):
+        """
+        Fetch the key set, unless another thread already did while we waited
+        (or, when ``rate_limited``, fetched it less than ``min_refetch_interval``
+        seconds ago)
+        """
+        with self._lock:
+            if min_expires_at is not None and self._expires_at > min_expires_at:
+                return
+            if rate_limited and self._fetched_recently(time.monotonic()):
+                return
+            self._update()
+
+    def refresh_in_background(self):
+        with self._refreshing_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, name='jwks-refresh', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            # After a failed fetch the keys expire within the refresh-ahead
+            # window, only retry once per refetch interval until then
+            self.refresh(min_expires_at=time.monotonic() + self.refresh_ahead, rate_limited=True)
+        finally:
+            self._refreshing = False
+
+    def _refetch_for(self, kid):
+        with self._lock:
+            # Another thread may have fetched the rotated keys while we waited
+            if kid in self._keys:
+                return self._keys[kid]
+            if self._fetched_recently(time.monotonic()):
+                logger.debug("Unknown signing key %s, refetch rate limited", kid)
+                return None
+            logger.info("Unknown signing key %s, refetching JWKS", kid)
+            self._update()
+            return self._keys.get(kid)
+
+    def _fetched_recently(self, now):
+        return self._last_fetch is not None and now - self._last_fetch < self.min_refetch_interval
+
+    def _update(self):
+        # Must be called with self._lock held
+        self._last_fetch = time.monotonic()
+        try:
+            data = self._fetch()
+        except Exception as e:
+            if not self._keys:
+                raise
+            # Keep serving the keys we have and retry after the refetch interval
+            logger.error("Failed to refresh JWKS, keeping cached keys: %s", e)
+            self._expires_at = self._last_fetch + self.min_refetch_interval
+            return
+        self._keys = self.parse(data)
+        self._expires_at = self._last_fetch + self.max_age
+        logger.debug("Loaded %s signing keys from JWKS", len(self._keys))
+
+    def _fetch(self):
+        response = get_client().jwks()
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def parse(data):
+        keys = {}
+        for jwk in data.get('keys', []):
+            if jwk.get('use', 'sig') != 'sig' or 'kid' not in jwk:
+                continue
+            try:
+                keys[jwk['kid']] = jwt.PyJWK(jwk).key
+            except jwt.PyJWTError as e:
+                logger.warning("Skipping unusable signing key %s: %s", jwk.get('kid'), e)
+        return keys
+
+
+# Shared by every request handled by this process
+_key_set = None
+_key_set_lock = threading.Lock()
+
+
+def get_key_set():
+    global _key_set
+    if _key_set is None:
+        with _key_set_lock:
+            if _key_set is None:
+                _key_set = JWKSKeySet(
+                    max_age=settings.KEYCLOAK_JWKS_MAX_AGE,
+                    refresh_ahead=settings.KEYCLOAK_JWKS_REFRESH_AHEAD,
+                    min_refetch_interval=settings.KEYCLOAK_JWKS_MIN_REFETCH_INTERVAL,
+                )
+    return _key_set
+
+
+def _reset_after_fork():
+    # Locks held by a refresh thread in the parent would never be released
+    global _key_set, _key_set_lock
+    _key_set = None
+    _key_set_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
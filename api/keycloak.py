@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from urllib3.util.retry import Retry
+
+from core import deadline
+from core.deadline import DeadlineExceeded
+from core.metrics import observe_keycloak
+from .circuit_breaker import CircuitOpenError, get_breaker
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+
+class KeycloakUnavailable(APIException):
+    """
+    Raised without calling Keycloak while the operation's circuit is open
+    """
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Keycloak is temporarily unavailable, try again later'
+    default_code = 'keycloak_unavailable'
+
+    def __init__(self, operation, retry_after):
+        super().__init__()
+        self.operation = operation
+        # Sent as Retry-After by DRF's exception handler
+        self.wait = retry_after
+
+
+class KeycloakClient:
+    """
+    Keycloak HTTP client holding a keep-alive connection pool.
+
+    Every call gets a (connect, read) timeout, capped at what is left of the
+    request's deadline. Idempotent requests are retried
+    with exponential backoff on connection errors and 502/503/504 responses;
+    POSTs are only retried when the connection could not be established.
+    Each operation goes through its circuit breaker: connection errors,
+    timeouts and 5xx answers count as failures, and calls fail fast with
+    KeycloakUnavailable while the circuit is open.
+    """
+
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+    def __init__(self, base_url, realm, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 retries=2, backoff=0.2):
+        self.base_url = base_url.rstrip('/')
+        self.realm = realm
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=self.IDEMPOTENT_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, operation, method, url, **kwargs):
+        kwargs['timeout'] = deadline.limit_timeout(kwargs.get('timeout', self.timeout))
+        breaker = self.before_call(operation)
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            observe_keycloak(operation, 'error', started)
+            self.call_failed(operation, breaker, e)
+            raise
+        observe_keycloak(operation, response.status_code, started)
+        self.after_call(breaker, response)
+        logger.debug("Keycloak %s response status: %s", operation, response.status_code)
+        return response
+
+    def before_call(self, operation):
+        breaker = get_breaker(operation)
+        try:
+            breaker.before_call()
+        except CircuitOpenError as e:
+            logger.warning("Keycloak %s circuit open, failing fast", operation)
+            raise KeycloakUnavailable(operation, e.retry_after)
+        return breaker
+
+    def call_failed(self, operation, breaker, error):
+        if deadline.expired():
+            # Our budget ran out, that says nothing about Keycloak's health
+            logger.warning("Keycloak %s request abandoned at the request deadline", operation)
+            raise DeadlineExceeded() from error
+        breaker.record_failure()
+        logger.error("Keycloak %s request failed: %s", operation, error)
+
+    def after_call(self, breaker, response):
+        # 4xx answers come from a healthy Keycloak
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    @property
+    def realm_url(self):
+        return f"{self.base_url}/realms/{self.realm}"
+
+    @property
+    def admin_url(self):
+        return f"{self.base_url}/admin/realms/{self.realm}"
+
+    # Realm endpoints
+
+    def token(self, data):
+        return self.request('token', 'POST', settings.OIDC_OP_TOKEN_ENDPOINT, data=data)
+
+    def userinfo(self, access_token):
+        return self.request(
+            'userinfo', 'GET', settings.OIDC_OP_USER_ENDPOINT,
+            headers={'Authorization': f'Bearer {access_token}'},
+        )
+
+    def jwks(self):
+        return self.request('jwks', 'GET', settings.OIDC_OP_JWKS_ENDPOINT)
+
+    def discovery(self):
+        return self.request('discovery', 'GET', f"{self.realm_url}/.well-known/openid-configuration")
+
+    # Admin endpoints
+
+    def admin_token(self):
+        return self.request(
+            'admin_token', 'POST', f"{self.base_url}/realms/master/protocol/openid-connect/token",
+            data={
+                'grant_type': 'password',
+                'client_id': 'admin-cli',
+                'username': settings.KEYCLOAK_ADMIN_USERNAME,
+                'password': settings.KEYCLOAK_ADMIN_PASSWORD,
+            },
+        )
+
+    def refresh_admin_token(self, refresh_token):
+        return self.request(
+            'admin_token', 'POST', f"{self.base_url}/realms/master/protocol/openid-connect/token",
+            data={
+                'grant_type': 'refresh_token',
+                'client_id': 'admin-cli',
+                'refresh_token': refresh_token,
+            },
+        )
+
+    def create_user(self, admin_token, representation):
+        return self.request(
+            'admin_create_user', 'POST', f"{self.admin_url}/users",
+            json=representation,
+            headers={'Authorization': f'Bearer {admin_token}'},
+        )
+
+    def delete_user(self, admin_token, user_id):
+        return self.request(
+            'admin_delete_user', 'DELETE', f"{self.admin_url}/users/{user_id}",
+            headers={'Authorization': f'Bearer {admin_token}'},
+        )
+
+    def find_users(self, admin_token, **params):
+        return self.request(
+            'admin_find_users', 'GET', f"{self.admin_url}/users",
+            params=params,
+            headers={'Authorization': f'Bearer {admin_token}'},
+        )
+
+    def partial_import(self, admin_token, representation):
+        return self.request(
+            'admin_partial_import', 'POST', f"{self.admin_url}/partialImport",
+            json=representation,
+            headers={'Authorization': f'Bearer {admin_token}'},
+        )
+
+    def get_clients(self, admin_token):
+        return self.request(
+            'admin_clients', 'GET', f"{self.admin_url}/clients",
+            headers={'Authorization': f'Bearer {admin_token}'},
+        )
+
+
+class AsyncKeycloakClient(KeycloakClient):
+    """
+    Keycloak client for the async views, over an httpx connection pool.
+
+    It exposes the same endpoint methods as KeycloakClient, which here return
+    awaitables, with the same timeouts and retry policy.
+    """
+
+    RETRY_STATUSES = frozenset([502, 503, 504])
+
+    def __init__(self, base_url, realm, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 retries=2, backoff=0.2):
+        self.base_url = base_url.rstrip('/')
+        self.realm = realm
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.session = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def request(self, operation, method, url, **kwargs):
+        breaker = self.before_call(operation)
+        idempotent = method in self.IDEMPOTENT_METHODS
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            timeout = deadline.limit_timeout((self.timeout.connect, self.timeout.read))
+            try:
+                response = await self.session.request(
+                    method, url, timeout=httpx.Timeout(timeout[1], connect=timeout[0]), **kwargs)
+            except httpx.HTTPError as e:
+                # POSTs are only retried when they never reached Keycloak
+                retryable = idempotent or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if not retryable or attempt >= self.retries or deadline.expired():
+                    observe_keycloak(operation, 'error', started)
+                    self.call_failed(operation, breaker, e)
+                    raise
+            else:
+                if not idempotent or response.status_code not in self.RETRY_STATUSES or attempt >= self.retries:
+                    observe_keycloak(operation, response.status_code, started)
+                    self.after_call(breaker, response)
+                    logger.debug("Keycloak %s response status: %s", operation, response.status_code)
+                    return response
+            await asyncio.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+
+# One client (and connection pool) per worker process
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return this process' Keycloak client, creating a new one after a fork so
+    gunicorn workers never share sockets inherited from a preloaded master
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = KeycloakClient(
+                    settings.KEYCLOAK_URL,
+                    settings.KEYCLOAK_REALM,
+                    pool_size=settings.KEYCLOAK_HTTP_POOL_SIZE,
+                    connect_timeout=settings.KEYCLOAK_HTTP_CONNECT_TIMEOUT,
+                    read_timeout=settings.KEYCLOAK_HTTP_READ_TIMEOUT,
+                    retries=settings.KEYCLOAK_HTTP_RETRIES,
+                    backoff=settings.KEYCLOAK_HTTP_BACKOFF,
+                )
+                _client_pid = pid
+    return _client
+
+
+# httpx pools are bound to the event loop they were created on
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """
+    Return the async Keycloak client of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncKeycloakClient(
+            settings.KEYCLOAK_URL,
+            settings.KEYCLOAK_REALM,
+            pool_size=settings.KEYCLOAK_HTTP_POOL_SIZE,
+            connect_timeout=settings.KEYCLOAK_HTTP_CONNECT_TIMEOUT,
+            read_timeout=settings.KEYCLOAK_HTTP_READ_TIMEOUT,
+            retries=settings.KEYCLOAK_HTTP_RETRIES,
+            backoff=settings.KEYCLOAK_HTTP_BACKOFF,
+        )
+    return client
+
+
+def _reset_after_fork():
+    global _client, _client_pid, _client_lock
+    _client = None
+    _client_pid = None
+    _client_lock = threading.Lock()
+    _async_clients.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+# Token buckets checked and taken in one step: a request is allowed only if
+# every bucket has a token, and rejected requests take none. Uses the Redis
+# clock so all workers and nodes agree.
+# KEYS: one bucket per identity; ARGV: capacity and refill period (ms) per key
+# Returns 0 when allowed, otherwise the milliseconds until a token is available
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local rate = capacity / tonumber(ARGV[i * 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, math.ceil((1 - tokens) / rate))
+    end
+    levels[i] = tokens
+end
+if wait > 0 then
+    return wait
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'ts', now)
+    redis.call('PEXPIRE', key, tonumber(ARGV[i * 2]))
+end
+return 0
+"""
+
+
+def parse_rate(rate):
+    """
+    '5/min' -> (5, 60), in the format of DRF's throttle rates
+    """
+    num, period = rate.split('/')
+    return int(num), {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+
+
+class RateLimiter:
+    """
+    Token buckets shared by every worker through Redis.
+
+    Each decision is one EVALSHA of TOKEN_BUCKET_SCRIPT. With a cache backend
+    other than django_redis (tests, local development) the buckets are kept
+    in-process instead. Redis errors let the request through: the limiter
+    must not take login down with it.
+    """
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+        self._script = None
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def hit(self, buckets):
+        """
+        Take a token from each ``(key, capacity, period)`` bucket; returns 0
+        when allowed, otherwise the seconds until the request would be
+        """
+        if not buckets:
+            return 0
+        script = self.script()
+        if script is None:
+            return self._hit_local(buckets, time.monotonic())
+        args = []
+        for _, capacity, period in buckets:
+            args += [capacity, period * 1000]
+        try:
+            wait_ms = script(keys=[key for key, _, _ in buckets], args=args)
+        except Exception as e:
+            logger.warning("Rate limiter unavailable, allowing request: %s", e)
+            return 0
+        return wait_ms / 1000
+
+    def script(self):
+        if self._script is None:
+            try:
+                from django_redis import get_redis_connection
+                connection = get_redis_connection(self.alias)
+            except (ImportError, NotImplementedError):
+                self._script = False
+            else:
+                self._script = connection.register_script(TOKEN_BUCKET_SCRIPT)
+        return self._script or None
+
+    def _hit_local(self, buckets, now):
+        # Same algorithm as the Lua script, for a single process
+        with self._lock:
+            wait = 0
+            levels = []
+            for key, capacity, period in buckets:
+                rate = capacity / period
+                tokens, ts = self._local.get(key, (capacity, now))
+                tokens = min(capacity, tokens + max(0, now - ts) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                levels.append(tokens)
+            if wait:
+                return wait
+            for (key, _, _), tokens in zip(buckets, levels):
+                self._local[key] = (tokens - 1, now)
+            return 0
+
+
+# Shared by every request handled by this process
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter()
+    return _limiter
+
+
+def _reset_after_fork():
+    global _limiter, _limiter_lock
+    _limiter = None
+    _limiter_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def request_buckets(scope, request, ident):
+    """
+    Buckets for the identities RATE_LIMITS configures for ``scope``: the
+    client IP and request fields such as the username or email
+    """
+    buckets = []
+    for identity, rate in settings.RATE_LIMITS.get(scope, {}).items():
+        value = ident if identity == 'ip' else request.data.get(identity)
+        if not value or not isinstance(value, str):
+            continue
+        # Hashed so the keys don't hold usernames and email addresses
+        digest = hashlib.sha256(value.strip().lower().encode('utf-8')).hexdigest()[:32]
+        capacity, period = parse_rate(rate)
+        buckets.append((f'ratelimit:{scope}:{identity}:{digest}', capacity, period))
+    return buckets
+
+
+def check_rate_limit(scope, request, ident):
+    """
+    Seconds the request has to wait, 0 when it may go through
+    """
+    if not settings.RATE_LIMIT_ENABLED:
+        return 0
+    wait = get_rate_limiter().hit(request_buckets(scope, request, ident))
+    if wait:
+        logger.warning("Rate limited %s request from %s", scope, ident)
+    return wait
+
+
+class KeycloakRateThrottle(BaseThrottle):
+    """
+    DRF throttle backed by the shared token buckets of ``scope``
+    """
+    scope = None
+
+    def allow_request(self, request, view):
+        self._wait = check_rate_limit(self.scope, request, self.get_ident(request))
+        return not self._wait
+
+    def wait(self):
+        return math.ceil(self._wait)
+
+
+class LoginRateThrottle(KeycloakRateThrottle):
+    scope = 'login'
+
+
+class RegisterRateThrottle(KeycloakRateThrottle):
+    scope = 'register'
+
+
+class ForgotPasswordRateThrottle(KeycloakRateThrottle):
+    scope = 'forgot_password'
@@ -0,0 +1,3 @@
+"""
+Test package for api app.
+"""
\ No newline at end of file
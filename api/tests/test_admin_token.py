@@ -0,0 +1,92 @@
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from api.admin_token import AdminTokenError, AdminTokenManager, call_with_admin_token
+
+
+def token_response(access_token, status_code=200, expires_in=60, refresh_expires_in=1800):
+    response = mock.Mock(status_code=status_code)
+    response.json.return_value = {
+        'access_token': access_token,
+        'expires_in': expires_in,
+        'refresh_token': f'refresh-{access_token}',
+        'refresh_expires_in': refresh_expires_in,
+    }
+    return response
+
+
+class TestAdminTokenManager(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('api.admin_token.get_client')
+        self.keycloak = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.keycloak.admin_token.return_value = token_response('first')
+        self.manager = AdminTokenManager(skew=30)
+
+    def test_token_cached(self):
+        """Test that the admin token is reused until it is about to expire"""
+        self.assertEqual(self.manager.get_token(), 'first')
+        self.assertEqual(self.manager.get_token(), 'first')
+        self.keycloak.admin_token.assert_called_once()
+
+    def test_token_shared_between_workers(self):
+        """Test that another worker picks up the token from the shared cache"""
+        self.manager.get_token()
+        other_worker = AdminTokenManager(skew=30)
+        self.assertEqual(other_worker.get_token(), 'first')
+        self.keycloak.admin_token.assert_called_once()
+
+    def test_renewed_with_refresh_token(self):
+        """Test that an expiring token is renewed with its refresh token"""
+        self.manager.get_token()
+        self.keycloak.refresh_admin_token.return_value = token_response('second')
+        with mock.patch('api.admin_token.time.time', return_value=time.time() + 45):
+            self.assertEqual(self.manager.get_token(), 'second')
+        self.keycloak.refresh_admin_token.assert_called_once_with('refresh-first')
+        self.keycloak.admin_token.assert_called_once()
+
+    def test_failed_refresh_logs_in_again(self):
+        """Test that a rejected refresh token falls back to the password grant"""
+        self.manager.get_token()
+        self.keycloak.refresh_admin_token.return_value = token_response('ignored', status_code=400)
+        self.keycloak.admin_token.return_value = token_response('second')
+        with mock.patch('api.admin_token.time.time', return_value=time.time() + 45):
+            self.assertEqual(self.manager.get_token(), 'second')
+        self.assertEqual(self.keycloak.admin_token.call_count, 2)
+
+    def test_admin_login_failure(self):
+        """Test that a failed admin login raises with Keycloak's status"""
+        self.keycloak.admin_token.return_value = token_response('ignored', status_code=401)
+        with self.assertRaises(AdminTokenError) as ctx:
+            self.manager.get_token()
+        self.assertEqual(ctx.exception.status_code, 401)
+
+    def test_concurrent_renewal_single_flight(self):
+        """Test that concurrent threads share one admin login"""
+        def slow_login():
+            time.sleep(0.05)
+            return token_response('first')
+
+        self.keycloak.admin_token.side_effect = slow_login
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(self.manager.get_token())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tokens, ['first'] * 10)
+        self.keycloak.admin_token.assert_called_once()
+
+    def test_rejected_token_renewed_once(self):
+        """Test that a 401 from the admin API renews the token and retries once"""
+        self.keycloak.admin_token.side_effect = [token_response('first'), token_response('second')]
+        api_call = mock.Mock(side_effect=[mock.Mock(status_code=401), mock.Mock(status_code=200)])
+        with mock.patch('api.admin_token.get_manager', return_value=self.manager):
+            response = call_with_admin_token(api_call, 'arg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(api_call.call_args_list, [mock.call('first', 'arg'), mock.call('second', 'arg')])
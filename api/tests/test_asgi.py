@@ -0,0 +1,63 @@
+import importlib
+import importlib.util
+import os
+from unittest import mock
+
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+from django.core.handlers.asgi import ASGIHandler
+from django.test import SimpleTestCase, override_settings
+
+import core.settings
+
+
+def load_settings(**environ):
+    """
+    A fresh copy of core.settings, as loaded with ``environ``
+    """
+    with mock.patch.dict(os.environ, environ):
+        spec = importlib.util.spec_from_file_location('asgi_settings', core.settings.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+class TestASGIApplication(SimpleTestCase):
+    def test_no_middleware_adapted(self):
+        """Test that with the async views every middleware runs on the event loop"""
+        middleware = load_settings(ASYNC_VIEWS='True').MIDDLEWARE
+        self.assertNotIn('whitenoise.middleware.WhiteNoiseMiddleware', middleware)
+        # Django logs each sync middleware it has to wrap in a thread
+        with override_settings(MIDDLEWARE=middleware, DEBUG=True), self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    def test_sync_middleware_detected(self):
+        """Test that a sync-only middleware is reported as adapted"""
+        self.assertIn('whitenoise.middleware.WhiteNoiseMiddleware', settings.MIDDLEWARE)
+        with override_settings(DEBUG=True), self.assertLogs('django.request', 'DEBUG') as logs:
+            ASGIHandler()
+        self.assertIn('WhiteNoiseMiddleware', '\n'.join(logs.output))
+
+    async def test_static_files_served(self):
+        """Test that the ASGI application serves static files without WhiteNoise"""
+        with mock.patch.dict(os.environ), override_settings(ASYNC_VIEWS=True):
+            asgi = importlib.reload(importlib.import_module('core.asgi'))
+        self.assertIsInstance(asgi.application, ASGIStaticFilesHandler)
+
+        communicator = ApplicationCommunicator(asgi.application, {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': '/static/admin/css/base.css',
+            'query_string': b'',
+            'headers': [(b'host', b'testserver')],
+            'server': ('testserver', 80),
+            'client': ('127.0.0.1', 50000),
+        })
+        await communicator.send_input({'type': 'http.request'})
+        start = await communicator.receive_output(timeout=5)
+        self.assertEqual(start['status'], 200)
+        await communicator.wait(timeout=5)
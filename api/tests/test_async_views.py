@@ -0,0 +1,134 @@
+import json
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import AsyncRequestFactory, TestCase
+from rest_framework import status
+
+from api import admin_token, async_views
+from api.keycloak import KeycloakUnavailable
+from api.tests.test_views import keycloak_response
+from users.tests.factories import UserFactory
+
+
+class AsyncKeycloakViewTestCase(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.keycloak = mock.Mock()
+        for method in ('token', 'create_user', 'delete_user', 'find_users'):
+            setattr(self.keycloak, method, mock.AsyncMock())
+        patcher = mock.patch('api.async_views.get_async_client', return_value=self.keycloak)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Admin tokens are renewed by the sync client in a worker thread
+        self.admin_keycloak = mock.Mock()
+        self.admin_keycloak.admin_token.return_value = keycloak_response(200, {'access_token': 'admin', 'expires_in': 60})
+        patcher = mock.patch('api.admin_token.get_client', return_value=self.admin_keycloak)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        admin_token._reset_after_fork()
+        cache.clear()
+
+    def post(self, path, data):
+        return self.factory.post(path, json.dumps(data), content_type='application/json')
+
+
+class TestAsyncLogin(AsyncKeycloakViewTestCase):
+    async def test_login_success(self):
+        """Test that Keycloak tokens are returned on a successful password grant"""
+        self.keycloak.token.return_value = keycloak_response(
+            200, {'access_token': 'access', 'refresh_token': 'refresh'})
+        response = await async_views.login(self.post('/api/login/', {'username': 'alice', 'password': 'pw'}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {'token': 'access', 'refresh_token': 'refresh'})
+        self.assertEqual(self.keycloak.token.await_args.args[0]['username'], 'alice')
+
+    async def test_login_invalid_credentials(self):
+        """Test that rejected credentials are reported as 401"""
+        self.keycloak.token.return_value = keycloak_response(401)
+        response = await async_views.login(self.post('/api/login/', {'username': 'alice', 'password': 'bad'}))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_login_method_not_allowed(self):
+        """Test that only the view's methods are accepted"""
+        response = await async_views.login(self.factory.get('/api/login/'))
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        self.keycloak.token.assert_not_called()
+
+    async def test_login_malformed_body(self):
+        """Test that a malformed JSON body is rejected"""
+        request = self.factory.post('/api/login/', '{"username"', content_type='application/json')
+        response = await async_views.login(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    async def test_login_keycloak_unavailable(self):
+        """Test that logins fail fast with a 503 while Keycloak's circuit is open"""
+        self.keycloak.token.side_effect = KeycloakUnavailable('token', 12)
+        response = await async_views.login(self.post('/api/login/', {'username': 'alice', 'password': 'pw'}))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers['Retry-After'], '12')
+
+
+class TestAsyncRegister(AsyncKeycloakViewTestCase):
+    payload = {'username': 'newuser', 'email': 'newuser@example.com', 'password': 'S3cure-pass'}
+
+    def setUp(self):
+        super().setUp()
+        self.keycloak.create_user.return_value = keycloak_response(
+            201, headers={'Location': 'http://keycloak:8080/admin/realms/test-realm/users/kc-new'})
+        self.keycloak.delete_user.return_value = keycloak_response(204)
+
+    async def test_register_success(self):
+        """Test that a user is created in Keycloak and Django with the Keycloak ID"""
+        response = await async_views.register(self.post('/api/register/', self.payload))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        user = await User.objects.select_related('userprofile').aget(username='newuser')
+        self.assertEqual(user.userprofile.keycloak_id, 'kc-new')
+        self.keycloak.create_user.assert_awaited_once()
+        self.assertEqual(self.keycloak.create_user.await_args.args[0], 'admin')
+
+    async def test_register_duplicate_username(self):
+        """Test that an existing username is rejected before calling Keycloak"""
+        await sync_to_async(UserFactory)(username='newuser')
+        response = await async_views.register(self.post('/api/register/', self.payload))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content)['error'], 'Username already exists')
+        self.keycloak.create_user.assert_not_called()
+
+    async def test_register_database_failure_compensates(self):
+        """Test that the Keycloak user is removed when the Django insert fails"""
+        with mock.patch('users.models.UserProfile.objects.create', side_effect=RuntimeError('db down')):
+            response = await async_views.register(self.post('/api/register/', self.payload))
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.keycloak.delete_user.assert_awaited_once_with('admin', 'kc-new')
+        self.assertFalse(await User.objects.filter(username='newuser').aexists())
+
+    async def test_register_without_location_compensates(self):
+        """Test that a Keycloak user created without a usable Location is found by username and removed"""
+        self.keycloak.create_user.return_value = keycloak_response(201)
+        self.keycloak.find_users.return_value = keycloak_response(200, [{'id': 'kc-new', 'username': 'newuser'}])
+        response = await async_views.register(self.post('/api/register/', self.payload))
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.keycloak.find_users.assert_awaited_once_with('admin', username='newuser', exact='true')
+        self.keycloak.delete_user.assert_awaited_once_with('admin', 'kc-new')
+        self.assertFalse(await User.objects.filter(username='newuser').aexists())
+
+    async def test_register_rejected_admin_token_renewed(self):
+        """Test that a cached admin token Keycloak no longer accepts is renewed once"""
+        self.keycloak.create_user.side_effect = [
+            keycloak_response(401),
+            keycloak_response(201, headers={'Location': 'http://keycloak:8080/admin/realms/test-realm/users/kc-new'}),
+        ]
+        response = await async_views.register(self.post('/api/register/', self.payload))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.admin_keycloak.admin_token.call_count, 2)
+
+    async def test_register_admin_login_failure(self):
+        """Test that a failed admin login is reported"""
+        self.admin_keycloak.admin_token.return_value = keycloak_response(401)
+        response = await async_views.register(self.post('/api/register/', self.payload))
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(json.loads(response.content)['error'], 'Failed to authenticate with Keycloak admin')
@@ -0,0 +1,352 @@
+import hashlib
+import time
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIRequestFactory
+
+from api.authentication import KeycloakAuthentication, token_cache
+from api.jwks import JWKSKeySet
+from api.keycloak import KeycloakUnavailable
+from api.tests.tokens import JWKS, make_token
+from users.cache import user_cache
+from users.models import UserProfile
+from users.tests.factories import UserFactory
+
+
+class TestKeycloakAuthentication(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.auth = KeycloakAuthentication()
+        key_set = JWKSKeySet()
+        key_set._fetch = mock.Mock(return_value=JWKS)
+        patcher = mock.patch('api.authentication.get_key_set', return_value=key_set)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        token_cache.clear_local()
+        user_cache.clear_local()
+        cache.clear()
+
+    def authenticate(self, token):
+        request = self.factory.get('/users/api/profile/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return self.auth.authenticate(request)
+
+    def test_no_bearer_token(self):
+        """Test that requests without a Bearer token are left to other authenticators"""
+        request = self.factory.get('/users/api/profile/')
+        self.assertIsNone(self.auth.authenticate(request))
+
+    def test_valid_token_creates_user(self):
+        """Test that a locally verified token authenticates and provisions the user"""
+        token = make_token()
+        with mock.patch('api.authentication.get_client') as get_client:
+            user, auth = self.authenticate(token)
+        get_client.assert_not_called()
+        self.assertEqual(auth, token)
+        self.assertEqual(user.username, 'kcuser')
+        self.assertEqual(user.email, 'kcuser@example.com')
+        self.assertTrue(User.objects.filter(username='kcuser').exists())
+        self.assertFalse(user.has_usable_password())
+
+    def test_new_user_profile_linked(self):
+        """Test that a provisioned user's profile records the Keycloak subject on insert"""
+        token = make_token(sub='kc-new')
+        user, _ = self.authenticate(token)
+        self.assertEqual(User.objects.get(username='kcuser').userprofile.keycloak_id, 'kc-new')
+
+    def test_existing_user_linked_by_username(self):
+        """Test that an existing account without a Keycloak ID is linked on first login"""
+        existing = UserFactory(username='kcuser')
+        user, _ = self.authenticate(make_token(sub='kc-link'))
+        self.assertEqual(user.pk, existing.pk)
+        existing.userprofile.refresh_from_db()
+        self.assertEqual(existing.userprofile.keycloak_id, 'kc-link')
+
+    def test_user_linked_to_other_subject(self):
+        """Test that a username owned by another Keycloak account is not taken over"""
+        existing = UserFactory(username='kcuser')
+        existing.userprofile.keycloak_id = 'kc-original'
+        existing.userprofile.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(make_token(sub='kc-impostor'))
+
+    def test_user_resolved_by_subject(self):
+        """Test that users are found by Keycloak subject even after a username change"""
+        existing = UserFactory(username='renamed')
+        existing.userprofile.keycloak_id = 'kc-sub'
+        existing.userprofile.save()
+        user, _ = self.authenticate(make_token(sub='kc-sub'))
+        self.assertEqual(user.pk, existing.pk)
+
+    def test_warm_cache_no_queries(self):
+        """Test that a warm request resolves the user and profile without DB queries"""
+        token = make_token()
+        self.authenticate(token)
+        with self.assertNumQueries(0):
+            user, _ = self.authenticate(token)
+            self.assertFalse(user.userprofile.mfa_enabled)
+
+    def test_cached_user_from_shared_tier(self):
+        """Test that a user cached by another worker is rebuilt with its profile"""
+        token = make_token(sub='kc-shared')
+        first, _ = self.authenticate(token)
+        user_cache.clear_local()
+        with self.assertNumQueries(0):
+            user, _ = self.authenticate(token)
+            self.assertEqual(user.pk, first.pk)
+            self.assertEqual(user.userprofile.keycloak_id, 'kc-shared')
+            self.assertIs(user.userprofile.user, user)
+
+    def test_profile_save_invalidates_user(self):
+        """Test that saving the profile drops the cached user"""
+        token = make_token(sub='kc-invalidate')
+        user, _ = self.authenticate(token)
+        profile = user.userprofile
+        profile.mfa_enabled = True
+        profile.save()
+        user, _ = self.authenticate(token)
+        self.assertTrue(user.userprofile.mfa_enabled)
+
+    def test_user_save_invalidates_user(self):
+        """Test that saving the user drops the cached user"""
+        token = make_token(sub='kc-deactivate')
+        user, _ = self.authenticate(token)
+        user = User.objects.get(pk=user.pk)
+        user.email = 'changed@example.com'
+        user.save()
+        user, _ = self.authenticate(token)
+        self.assertEqual(user.email, 'changed@example.com')
+
+    def test_expired_token(self):
+        """Test that expired tokens are rejected"""
+        token = make_token(exp=int(time.time()) - 3600)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_wrong_issuer(self):
+        """Test that tokens from another realm are rejected"""
+        token = make_token(iss='http://localhost:8080/realms/other')
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_wrong_audience(self):
+        """Test that tokens issued to another client are rejected"""
+        token = make_token(aud='other-client', azp='other-client')
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_audience_claim(self):
+        """Test that the client may appear in aud instead of azp"""
+        token = make_token(aud=['account', 'django-client'], azp='frontend')
+        with override_settings(KEYCLOAK_AUDIENCE='django-client'):
+            user, _ = self.authenticate(token)
+        self.assertEqual(user.username, 'kcuser')
+
+    def test_bad_signature(self):
+        """Test that tokens signed with an unknown key are rejected"""
+        other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        token = make_token(key=other_key)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    @override_settings(KEYCLOAK_TOKEN_VERIFICATION='userinfo')
+    def test_userinfo_fallback(self):
+        """Test that the userinfo mode still asks Keycloak to verify the token"""
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'sub': 'kc-sub', 'preferred_username': 'kcuser', 'email': 'kcuser@example.com'}
+        with mock.patch('api.authentication.get_client') as get_client:
+            userinfo = get_client.return_value.userinfo
+            userinfo.return_value = response
+            user, _ = self.authenticate('opaque-token')
+        userinfo.assert_called_once()
+        self.assertEqual(user.username, 'kcuser')
+
+    @override_settings(KEYCLOAK_TOKEN_VERIFICATION='userinfo')
+    def test_userinfo_rejects_token(self):
+        """Test that a userinfo error is reported as an authentication failure"""
+        response = mock.Mock(status_code=401, text='invalid token')
+        with mock.patch('api.authentication.get_client') as get_client:
+            get_client.return_value.userinfo.return_value = response
+            with self.assertRaises(AuthenticationFailed):
+                self.authenticate('opaque-token')
+
+
+class TestTokenCache(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.auth = KeycloakAuthentication()
+        self.key_set = JWKSKeySet()
+        self.key_set._fetch = mock.Mock(return_value=JWKS)
+        patcher = mock.patch('api.authentication.get_key_set', return_value=self.key_set)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        token_cache.clear_local()
+        token_cache.reset_stats()
+        user_cache.clear_local()
+        cache.clear()
+
+    def authenticate(self, token):
+        request = self.factory.get('/users/api/profile/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return self.auth.authenticate(request)
+
+    def test_token_verified_once(self):
+        """Test that a reused token is served from the cache"""
+        token = make_token()
+        with mock.patch.object(KeycloakAuthentication, 'decode_token', wraps=self.auth.decode_token) as decode:
+            self.authenticate(token)
+            self.authenticate(token)
+        decode.assert_called_once()
+        stats = token_cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['local_hits'], 1)
+
+    def test_shared_tier_hit(self):
+        """Test that another worker's verification result is reused from the shared cache"""
+        token = make_token()
+        self.authenticate(token)
+        token_cache.clear_local()
+        with mock.patch.object(KeycloakAuthentication, 'decode_token') as decode:
+            user, _ = self.authenticate(token)
+        decode.assert_not_called()
+        self.assertEqual(user.username, 'kcuser')
+        self.assertEqual(token_cache.stats()['shared_hits'], 1)
+
+    def test_entry_expires_with_token(self):
+        """Test that cached results don't outlive the token's exp"""
+        token = make_token(exp=int(time.time()) + 60)
+        self.authenticate(token)
+        with mock.patch('core.cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(token_cache.get(hashlib.sha256(token.encode()).hexdigest()))
+
+    @override_settings(KEYCLOAK_TOKEN_VERIFICATION='userinfo')
+    def test_userinfo_result_cached(self):
+        """Test that userinfo verification results are cached until the token expires"""
+        token = make_token()
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'sub': 'kc-sub', 'preferred_username': 'kcuser', 'email': 'kcuser@example.com'}
+        with mock.patch('api.authentication.get_client') as get_client:
+            userinfo = get_client.return_value.userinfo
+            userinfo.return_value = response
+            self.authenticate(token)
+            self.authenticate(token)
+        userinfo.assert_called_once()
+
+    @override_settings(KEYCLOAK_TOKEN_VERIFICATION='userinfo', KEYCLOAK_TOKEN_CACHE_TTL=60)
+    def test_result_reverified_after_ttl(self):
+        """Test that a cached result older than the TTL is verified again"""
+        token = make_token(exp=int(time.time()) + 600)
+        with mock.patch('api.authentication.get_client') as get_client:
+            userinfo = get_client.return_value.userinfo
+            userinfo.return_value = self.userinfo_response()
+            self.authenticate(token)
+            with mock.patch('time.time', return_value=time.time() + 61):
+                self.authenticate(token)
+        self.assertEqual(userinfo.call_count, 2)
+
+    @override_settings(KEYCLOAK_TOKEN_VERIFICATION='userinfo', KEYCLOAK_TOKEN_CACHE_TTL=60)
+    def test_stale_result_while_keycloak_unavailable(self):
+        """Test that tokens verified earlier are accepted until they expire while the circuit is open"""
+        token = make_token(exp=int(time.time()) + 600)
+        with mock.patch('api.authentication.get_client') as get_client:
+            userinfo = get_client.return_value.userinfo
+            userinfo.return_value = self.userinfo_response()
+            self.authenticate(token)
+            userinfo.side_effect = KeycloakUnavailable('userinfo', 30)
+            with mock.patch('time.time', return_value=time.time() + 300):
+                user, _ = self.authenticate(token)
+            self.assertEqual(user.username, 'kcuser')
+            with mock.patch('time.time', return_value=time.time() + 601):
+                with self.assertRaises(KeycloakUnavailable):
+                    self.authenticate(token)
+
+    @override_settings(KEYCLOAK_TOKEN_VERIFICATION='userinfo')
+    def test_unverified_token_while_keycloak_unavailable(self):
+        """Test that new tokens fail fast with a 503 rather than a 401 while the circuit is open"""
+        with mock.patch('api.authentication.get_client') as get_client:
+            get_client.return_value.userinfo.side_effect = KeycloakUnavailable('userinfo', 30)
+            with self.assertRaises(KeycloakUnavailable):
+                self.authenticate(make_token())
+
+    def userinfo_response(self):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'sub': 'kc-sub', 'preferred_username': 'kcuser', 'email': 'kcuser@example.com'}
+        return response
+
+    def test_invalid_token_not_cached(self):
+        """Test that rejected tokens are verified again rather than cached"""
+        token = make_token(iss='http://localhost:8080/realms/other')
+        for _ in range(2):
+            with self.assertRaises(AuthenticationFailed):
+                self.authenticate(token)
+        self.assertEqual(token_cache.stats()['misses'], 2)
+
+
+class TestAsyncAuthentication(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.auth = KeycloakAuthentication()
+        self.key_set = JWKSKeySet()
+        self.key_set._fetch = mock.Mock(return_value=JWKS)
+        patcher = mock.patch('api.authentication.get_key_set', return_value=self.key_set)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        token_cache.clear_local()
+        token_cache.reset_stats()
+        user_cache.clear_local()
+        cache.clear()
+
+    async def aauthenticate(self, token):
+        request = self.factory.get('/users/api/profile/', headers={'Authorization': f'Bearer {token}'})
+        return await self.auth.aauthenticate(request)
+
+    async def test_no_bearer_token(self):
+        """Test that requests without a Bearer token are left to other authenticators"""
+        self.assertIsNone(await self.auth.aauthenticate(self.factory.get('/users/api/profile/')))
+
+    async def test_valid_token_creates_user(self):
+        """Test that the async path verifies the token and provisions the user"""
+        token = make_token(sub='kc-async')
+        user, auth = await self.aauthenticate(token)
+        self.assertEqual(auth, token)
+        self.assertEqual(user.username, 'kcuser')
+        profile = await UserProfile.objects.aget(user=user)
+        self.assertEqual(profile.keycloak_id, 'kc-async')
+
+    async def test_warm_cache_no_fetch(self):
+        """Test that a cached token and user are resolved without Keycloak or the database"""
+        token = make_token()
+        await self.aauthenticate(token)
+        with mock.patch('api.authentication.sync_to_async') as sync_to_async:
+            user, _ = await self.aauthenticate(token)
+        sync_to_async.assert_not_called()
+        self.assertFalse(user.userprofile.mfa_enabled)
+        self.key_set._fetch.assert_called_once()
+        self.assertEqual(token_cache.stats()['local_hits'], 1)
+
+    async def test_current_keys_verified_inline(self):
+        """Test that tokens signed with a known key are decoded without a thread hop"""
+        self.key_set.get_key('test-kid')
+        with mock.patch('api.authentication.sync_to_async', wraps=sync_to_async) as wrapped:
+            await self.auth.averify_token(make_token())
+        wrapped.assert_not_called()
+
+    async def test_invalid_token(self):
+        """Test that rejected tokens raise AuthenticationFailed"""
+        with self.assertRaises(AuthenticationFailed):
+            await self.aauthenticate(make_token(exp=int(time.time()) - 3600))
+
+    @override_settings(KEYCLOAK_TOKEN_VERIFICATION='userinfo')
+    async def test_userinfo_async_client(self):
+        """Test that the userinfo mode calls Keycloak with the async client"""
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'sub': 'kc-sub', 'preferred_username': 'kcuser', 'email': 'kcuser@example.com'}
+        with mock.patch('api.authentication.get_async_client') as get_async_client:
+            userinfo = get_async_client.return_value.userinfo = mock.AsyncMock(return_value=response)
+            user, _ = await self.aauthenticate('opaque-token')
+        userinfo.assert_awaited_once_with('opaque-token')
+        self.assertEqual(user.username, 'kcuser')
@@ -0,0 +1,94 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from api import circuit_breaker
+from api.circuit_breaker import CircuitBreaker, CircuitOpenError, get_breaker
+
+
+class TestCircuitBreaker(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('api.circuit_breaker.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('token', failure_threshold=3, recovery_timeout=30)
+
+    def fail(self, times=1):
+        for _ in range(times):
+            self.breaker.before_call()
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        """Test that the circuit opens once the failure threshold is reached"""
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.fail()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.before_call()
+        self.assertEqual(raised.exception.retry_after, 30)
+
+    def test_success_resets_failures(self):
+        """Test that only consecutive failures count"""
+        self.fail(2)
+        self.breaker.record_success()
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_single_probe(self):
+        """Test that one probe is let through after the recovery timeout"""
+        self.fail(3)
+        self.now += 30
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_probe_success_closes(self):
+        """Test that a successful probe closes the circuit"""
+        self.fail(3)
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.before_call()
+
+    def test_probe_failure_reopens(self):
+        """Test that a failed probe opens the circuit for another recovery timeout"""
+        self.fail(3)
+        self.now += 30
+        self.fail()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.now += 29
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_lost_probe_replaced(self):
+        """Test that a probe that never reports back doesn't keep the circuit half-open forever"""
+        self.fail(3)
+        self.now += 30
+        self.breaker.before_call()
+        self.now += 30
+        self.breaker.before_call()
+
+    def test_zero_threshold_disables(self):
+        """Test that a threshold of 0 never opens the circuit"""
+        breaker = CircuitBreaker('jwks', failure_threshold=0)
+        for _ in range(100):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+class TestGetBreaker(SimpleTestCase):
+    def setUp(self):
+        circuit_breaker._reset_after_fork()
+        self.addCleanup(circuit_breaker._reset_after_fork)
+
+    @override_settings(KEYCLOAK_BREAKER_FAILURE_THRESHOLD=5, KEYCLOAK_BREAKER_THRESHOLDS={'jwks': 2})
+    def test_per_operation_threshold(self):
+        """Test that operations get their own breaker and configured threshold"""
+        self.assertIs(get_breaker('token'), get_breaker('token'))
+        self.assertEqual(get_breaker('token').failure_threshold, 5)
+        self.assertEqual(get_breaker('jwks').failure_threshold, 2)
+        self.assertEqual(circuit_breaker.breaker_states(), {'jwks': 'closed', 'token': 'closed'})
@@ -0,0 +1,216 @@
+import asyncio
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api.keycloak import KeycloakClient
+from core import deadline
+from core.deadline import DeadlineExceeded, DeadlineMiddleware, execute_with_deadline, install_execute_wrapper
+
+
+class TestDeadline(SimpleTestCase):
+    def test_no_deadline_outside_requests(self):
+        """Test that timeouts are left alone outside a request"""
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual(deadline.limit_timeout((3.05, 10)), (3.05, 10))
+
+    def test_timeout_capped_at_remaining_budget(self):
+        """Test that Keycloak timeouts are cut to the time the request has left"""
+        with deadline.deadline(2):
+            connect, read = deadline.limit_timeout((3.05, 10))
+        self.assertLessEqual(read, 2)
+        self.assertLessEqual(connect, 2)
+
+    def test_nested_deadline_never_extends(self):
+        """Test that an inner budget can't outlive the request's"""
+        with deadline.deadline(1):
+            with deadline.deadline(60):
+                self.assertLessEqual(deadline.remaining(), 1)
+
+    def test_spent_budget(self):
+        """Test that no call is attempted once the budget is spent"""
+        with deadline.deadline(0):
+            with self.assertRaises(DeadlineExceeded):
+                deadline.limit_timeout(10)
+
+    def test_suspended(self):
+        """Test that cleanup can run without the request's deadline"""
+        with deadline.deadline(0):
+            with deadline.suspended():
+                self.assertEqual(deadline.limit_timeout(10), 10)
+            self.assertTrue(deadline.expired())
+
+    def test_keycloak_client_timeout(self):
+        """Test that Keycloak calls get the remaining budget as their timeout"""
+        client = KeycloakClient('http://keycloak:8080', 'test-realm', connect_timeout=3.05, read_timeout=10)
+        with mock.patch.object(client.session, 'request', return_value=mock.Mock(status_code=200)) as request:
+            with deadline.deadline(0.5):
+                client.jwks()
+        self.assertLessEqual(max(request.call_args.kwargs['timeout']), 0.5)
+
+
+@override_settings(REQUEST_DEADLINE_DEFAULT=30, REQUEST_DEADLINE_MAX=60, REQUEST_DEADLINES={'login': 10})
+class TestRequestBudget(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_budget_per_url_name(self):
+        """Test that endpoints get their configured budget"""
+        self.assertEqual(deadline.request_budget(self.factory.post('/api/login/')), 10)
+        self.assertEqual(deadline.request_budget(self.factory.get('/api/keycloak-check/')), 30)
+        self.assertEqual(deadline.request_budget(self.factory.get('/missing/')), 30)
+
+    def test_edge_proxy_header(self):
+        """Test that the edge proxy's budget overrides the endpoint's, up to the maximum"""
+        request = self.factory.post('/api/login/', headers={'X-Request-Timeout-Ms': '2500'})
+        self.assertEqual(deadline.request_budget(request), 2.5)
+        request = self.factory.post('/api/login/', headers={'X-Request-Timeout-Ms': '600000'})
+        self.assertEqual(deadline.request_budget(request), 60)
+        request = self.factory.post('/api/login/', headers={'X-Request-Timeout-Ms': 'soon'})
+        self.assertEqual(deadline.request_budget(request), 10)
+
+
+class TestDeadlineMiddleware(TestCase):
+    def test_view_sees_deadline(self):
+        """Test that the middleware sets the deadline around the view"""
+        seen = []
+        middleware = DeadlineMiddleware(lambda request: seen.append(deadline.remaining()) or HttpResponse())
+        middleware(RequestFactory().get('/api/login/', headers={'X-Request-Timeout-Ms': '2000'}))
+        self.assertLessEqual(seen[0], 2)
+        self.assertIsNone(deadline.remaining())
+
+    def test_keycloak_call_at_deadline(self):
+        """Test that a view whose Keycloak call runs out of time answers 504"""
+        client = APIClient()
+        with mock.patch('api.views.get_client') as get_client:
+            get_client.return_value.token.side_effect = DeadlineExceeded()
+            response = client.post(reverse('login'), {'username': 'alice', 'password': 'pw'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+
+    def test_async_view_cancelled(self):
+        """Test that async views are cancelled once the budget is spent"""
+        async def slow_view(request):
+            await asyncio.sleep(5)
+            return HttpResponse()
+
+        middleware = DeadlineMiddleware(slow_view)
+        request = AsyncRequestFactory().get('/users/api/profile/', headers={'X-Request-Timeout-Ms': '50'})
+        response = asyncio.run(middleware(request))
+        self.assertEqual(response.status_code, status.HTTP_504_GATEWAY_TIMEOUT)
+
+
+class TestQueryDeadline(TestCase):
+    def setUp(self):
+        install_execute_wrapper(None, connection)
+
+    def test_query_refused_after_deadline(self):
+        """Test that no query is sent once the request's budget is spent"""
+        with deadline.deadline(0):
+            with self.assertRaises(DeadlineExceeded):
+                User.objects.count()
+
+    def test_queries_run_within_budget(self):
+        """Test that queries run normally while there is time left"""
+        with deadline.deadline(5):
+            self.assertEqual(User.objects.count(), 0)
+
+    def postgres_context(self, in_atomic_block=False):
+        connection = SimpleNamespace(vendor='postgresql', in_atomic_block=in_atomic_block, alias='default',
+                                     execute_wrappers=[])
+        install_execute_wrapper(None, connection)
+        return {'connection': connection, 'cursor': mock.Mock()}
+
+    def statement_timeouts(self, context):
+        return [call.args[1][0] for call in context['cursor'].cursor.execute.call_args_list]
+
+    @override_settings(DATABASE_STATEMENT_TIMEOUT=30)
+    def test_postgres_statement_timeout_lowered(self):
+        """Test that queries of a request run with a statement_timeout of the time left"""
+        context = self.postgres_context()
+        execute = mock.Mock(return_value='rows')
+        with deadline.deadline(2):
+            self.assertEqual(execute_with_deadline(execute, 'SELECT 1', None, False, context), 'rows')
+        [timeout] = self.statement_timeouts(context)
+        self.assertLessEqual(timeout, 2000)
+        self.assertEqual(context['cursor'].cursor.execute.call_args.args[0], 'SET statement_timeout = %s')
+        execute.assert_called_once()
+
+    @override_settings(DATABASE_STATEMENT_TIMEOUT=30)
+    def test_postgres_statement_timeout_set_once(self):
+        """Test that the lowered statement_timeout is reused by the next queries and requests"""
+        context = self.postgres_context()
+        for _ in range(3):
+            with deadline.deadline(5):
+                for _ in range(5):
+                    execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        self.assertEqual(len(self.statement_timeouts(context)), 1)
+
+        # A request with a longer budget raises it, queries outside requests
+        # get DATABASE_STATEMENT_TIMEOUT back
+        with deadline.deadline(15):
+            execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        timeouts = self.statement_timeouts(context)
+        self.assertEqual(len(timeouts), 3)
+        self.assertGreater(timeouts[1], 14000)
+        self.assertEqual(timeouts[2], 30000)
+
+    @override_settings(DATABASE_STATEMENT_TIMEOUT=0)
+    def test_postgres_statement_timeout_disabled(self):
+        """Test that queries outside requests don't set a disabled statement_timeout again"""
+        context = self.postgres_context()
+        for _ in range(3):
+            execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        context['cursor'].cursor.execute.assert_not_called()
+
+        # A request lowers it and the next query outside one turns it off again
+        with deadline.deadline(5):
+            execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        self.assertEqual(self.statement_timeouts(context)[1:], [0])
+
+    @override_settings(DATABASE_STATEMENT_TIMEOUT=1)
+    def test_postgres_statement_timeout_kept(self):
+        """Test that the connection's statement_timeout is kept when the request has more time"""
+        context = self.postgres_context()
+        with deadline.deadline(10):
+            execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        context['cursor'].cursor.execute.assert_not_called()
+
+    @override_settings(DATABASE_STATEMENT_TIMEOUT=30)
+    def test_postgres_statement_timeout_rolled_back(self):
+        """Test that a statement_timeout set in a transaction that was rolled back is set again"""
+        context = self.postgres_context(in_atomic_block=True)
+        with deadline.deadline(5), mock.patch('core.deadline.transaction.on_commit') as on_commit:
+            execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        on_commit.assert_called_once()
+        # The transaction ended without its on_commit callbacks
+        context['connection'].in_atomic_block = False
+        with deadline.deadline(5):
+            execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        self.assertEqual(len(self.statement_timeouts(context)), 2)
+
+        # Committed, the value is known again
+        on_commit.call_args.args[0]()
+        with deadline.deadline(5):
+            execute_with_deadline(mock.Mock(), 'SELECT 1', None, False, context)
+        self.assertEqual(len(self.statement_timeouts(context)), 2)
+
+    def test_cancelled_query_reported_as_deadline(self):
+        """Test that a query cancelled by the lowered statement_timeout answers 504"""
+        context = self.postgres_context()
+
+        execute = mock.Mock(side_effect=OperationalError('canceling statement due to statement timeout'))
+        with deadline.deadline(1):
+            with mock.patch('core.deadline.expired', return_value=True):
+                with self.assertRaises(DeadlineExceeded):
+                    execute_with_deadline(execute, 'SELECT 1', None, False, context)
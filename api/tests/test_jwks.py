@@ -0,0 +1,121 @@
+import threading
+import time
+from unittest import mock
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.test import SimpleTestCase
+
+from api.jwks import JWKSKeySet
+from api.tests.tokens import JWKS, public_jwk
+
+ROTATED_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+ROTATED_JWKS = {'keys': JWKS['keys'] + [public_jwk(ROTATED_KEY, kid='rotated-kid')]}
+
+
+class TestJWKSKeySet(SimpleTestCase):
+    def make_key_set(self, *documents, **kwargs):
+        key_set = JWKSKeySet(**kwargs)
+        key_set._fetch = mock.Mock(side_effect=list(documents))
+        return key_set
+
+    def test_keys_parsed_once(self):
+        """Test that keys are fetched once and served from memory afterwards"""
+        key_set = self.make_key_set(JWKS)
+        first = key_set.get_key('test-kid')
+        self.assertIsNotNone(first)
+        self.assertIs(key_set.get_key('test-kid'), first)
+        key_set._fetch.assert_called_once()
+
+    def test_encryption_keys_skipped(self):
+        """Test that non-signing keys in the realm JWKS are ignored"""
+        enc_key = dict(public_jwk(kid='enc-kid'), use='enc', alg='RSA-OAEP')
+        keys = JWKSKeySet.parse({'keys': JWKS['keys'] + [enc_key]})
+        self.assertEqual(list(keys), ['test-kid'])
+
+    def test_unknown_kid_refetches(self):
+        """Test that a rotated key is picked up by refetching the JWKS"""
+        key_set = self.make_key_set(JWKS, ROTATED_JWKS, min_refetch_interval=0)
+        key_set.get_key('test-kid')
+        self.assertIsNotNone(key_set.get_key('rotated-kid'))
+        self.assertEqual(key_set._fetch.call_count, 2)
+
+    def test_unknown_kid_refetch_rate_limited(self):
+        """Test that unknown kids don't refetch more than once per interval"""
+        key_set = self.make_key_set(JWKS, JWKS, JWKS, min_refetch_interval=60)
+        key_set.get_key('test-kid')
+        self.assertIsNone(key_set.get_key('bogus-kid'))
+        self.assertIsNone(key_set.get_key('bogus-kid'))
+        key_set._fetch.assert_called_once()
+
+    def test_concurrent_unknown_kid_single_flight(self):
+        """Test that threads seeing the same unknown kid share one refetch"""
+        def slow_fetch():
+            time.sleep(0.05)
+            return ROTATED_JWKS
+
+        key_set = self.make_key_set(JWKS, min_refetch_interval=0)
+        key_set.get_key('test-kid')
+        key_set._fetch = mock.Mock(side_effect=slow_fetch)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(key_set.get_key('rotated-kid')))
+            for _ in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        key_set._fetch.assert_called_once()
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(key is not None for key in results))
+
+    def test_background_refresh_before_expiry(self):
+        """Test that keys close to expiry are refreshed without blocking the caller"""
+        key_set = self.make_key_set(JWKS, ROTATED_JWKS, max_age=300, refresh_ahead=60)
+        key_set.get_key('test-kid')
+        key_set._last_fetch -= 270
+        key_set._expires_at = time.monotonic() + 30
+        self.assertIsNotNone(key_set.get_key('test-kid'))
+        for _ in range(100):
+            if key_set._fetch.call_count == 2 and not key_set._refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(key_set._fetch.call_count, 2)
+        self.assertIn('rotated-kid', key_set._keys)
+
+    def test_failed_refresh_keeps_keys(self):
+        """Test that a failed refresh keeps serving the cached keys"""
+        key_set = self.make_key_set(JWKS, ConnectionError('keycloak down'))
+        key = key_set.get_key('test-kid')
+        key_set._expires_at = 0
+        self.assertIs(key_set.get_key('test-kid'), key)
+        self.assertGreater(key_set._expires_at, time.monotonic())
+
+    def test_outage_refetch_rate_limited(self):
+        """Test that during an outage the JWKS is fetched once per refetch interval, not on every request"""
+        key_set = self.make_key_set(JWKS, *[ConnectionError('keycloak down')] * 10, min_refetch_interval=30)
+        key_set.get_key('test-kid')
+        key_set._last_fetch -= 300
+        key_set._expires_at = 0
+        # The failed refresh moves the expiry into the refresh-ahead window
+        self.assertIsNotNone(key_set.get_key('test-kid'))
+        for _ in range(100):
+            self.assertIsNotNone(key_set.get_key('test-kid'))
+        time.sleep(0.05)
+        self.assertEqual(key_set._fetch.call_count, 2)
+        self.assertFalse(key_set._refreshing)
+
+        # Once the interval has passed, the next request retries in the background
+        key_set._last_fetch -= 30
+        key_set.get_key('test-kid')
+        for _ in range(100):
+            if key_set._fetch.call_count == 3 and not key_set._refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(key_set._fetch.call_count, 3)
+
+    def test_first_fetch_failure_raises(self):
+        """Test that having no keys at all is reported to the caller"""
+        key_set = self.make_key_set(ConnectionError('keycloak down'))
+        with self.assertRaises(ConnectionError):
+            key_set.get_key('test-kid')
@@ -0,0 +1,169 @@
+from unittest import mock
+
+import httpx
+import requests
+from django.test import SimpleTestCase, override_settings
+
+from api import circuit_breaker, keycloak
+from api.keycloak import AsyncKeycloakClient, KeycloakClient, KeycloakUnavailable, get_async_client, get_client
+
+
+class TestKeycloakClient(SimpleTestCase):
+    def setUp(self):
+        circuit_breaker._reset_after_fork()
+        self.addCleanup(circuit_breaker._reset_after_fork)
+        self.client = KeycloakClient('http://keycloak:8080/', 'test-realm', pool_size=4,
+                                     connect_timeout=1, read_timeout=2, retries=3)
+
+    def test_connection_pool_shared(self):
+        """Test that http and https calls share one keep-alive pool"""
+        adapter = self.client.session.get_adapter('http://keycloak:8080/realms/test-realm')
+        self.assertIs(adapter, self.client.session.get_adapter('https://keycloak/'))
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+    def test_retries_idempotent_only(self):
+        """Test that only idempotent methods are retried on read errors"""
+        retry = self.client.session.get_adapter('http://keycloak:8080/').max_retries
+        self.assertEqual(retry.total, 3)
+        self.assertIn('GET', retry.allowed_methods)
+        self.assertNotIn('POST', retry.allowed_methods)
+
+    def test_default_timeout(self):
+        """Test that every call gets the configured timeouts"""
+        with mock.patch.object(self.client.session, 'request', return_value=mock.Mock(status_code=200)) as request:
+            self.client.find_users('admin-token', username='alice')
+        request.assert_called_once_with(
+            'GET', 'http://keycloak:8080/admin/realms/test-realm/users',
+            params={'username': 'alice'},
+            headers={'Authorization': 'Bearer admin-token'},
+            timeout=(1, 2),
+        )
+
+    @override_settings(KEYCLOAK_ADMIN_USERNAME='root', KEYCLOAK_ADMIN_PASSWORD='secret')
+    def test_admin_token_uses_configured_account(self):
+        """Test that the admin grant uses the configured master realm account"""
+        with mock.patch.object(self.client.session, 'request', return_value=mock.Mock(status_code=200)) as request:
+            self.client.admin_token()
+        data = request.call_args.kwargs['data']
+        self.assertEqual((data['username'], data['password']), ('root', 'secret'))
+
+
+    @override_settings(KEYCLOAK_BREAKER_THRESHOLDS={'userinfo': 2})
+    def test_open_circuit_fails_fast(self):
+        """Test that connection errors open the operation's circuit and later calls skip Keycloak"""
+        with mock.patch.object(self.client.session, 'request', side_effect=requests.ConnectionError) as request:
+            for _ in range(2):
+                with self.assertRaises(requests.ConnectionError):
+                    self.client.userinfo('token')
+            with self.assertRaises(KeycloakUnavailable) as raised:
+                self.client.userinfo('token')
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(raised.exception.status_code, 503)
+        self.assertEqual(raised.exception.wait, 30)
+        # Other operations have their own circuit
+        with mock.patch.object(self.client.session, 'request', return_value=mock.Mock(status_code=200)):
+            self.client.jwks()
+
+    @override_settings(KEYCLOAK_BREAKER_THRESHOLDS={'token': 2})
+    def test_only_server_errors_trip_circuit(self):
+        """Test that 5xx answers count as failures while 4xx answers don't"""
+        with mock.patch.object(self.client.session, 'request') as request:
+            request.return_value = mock.Mock(status_code=401)
+            for _ in range(5):
+                self.client.token({})
+            request.return_value = mock.Mock(status_code=500)
+            for _ in range(2):
+                self.client.token({})
+            with self.assertRaises(KeycloakUnavailable):
+                self.client.token({})
+
+
+class TestAsyncKeycloakClient(SimpleTestCase):
+    def setUp(self):
+        circuit_breaker._reset_after_fork()
+        self.addCleanup(circuit_breaker._reset_after_fork)
+        self.requests = []
+        self.responses = []
+        self.client = AsyncKeycloakClient('http://keycloak:8080/', 'test-realm', pool_size=4,
+                                          connect_timeout=1, read_timeout=2, retries=2, backoff=0)
+        self.client.session = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+    def handle(self, request):
+        self.requests.append(request)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def test_endpoint_methods_awaitable(self):
+        """Test that the sync client's endpoint methods return awaitable responses"""
+        self.responses = [httpx.Response(200, json=[{'id': 'kc-1'}])]
+        response = await self.client.find_users('admin-token', username='alice')
+        self.assertEqual(response.json(), [{'id': 'kc-1'}])
+        request = self.requests[0]
+        self.assertEqual(str(request.url), 'http://keycloak:8080/admin/realms/test-realm/users?username=alice')
+        self.assertEqual(request.headers['Authorization'], 'Bearer admin-token')
+
+    async def test_idempotent_retried_on_gateway_errors(self):
+        """Test that GETs are retried on 502/503/504 up to the retry limit"""
+        self.responses = [httpx.Response(503), httpx.Response(502), httpx.Response(503)]
+        response = await self.client.jwks()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.requests), 3)
+
+    async def test_post_not_retried_after_sending(self):
+        """Test that POSTs which may have reached Keycloak are not retried"""
+        self.responses = [httpx.Response(503), httpx.ReadTimeout('timed out')]
+        response = await self.client.token({'grant_type': 'password'})
+        self.assertEqual(response.status_code, 503)
+        self.responses = [httpx.ReadTimeout('timed out')]
+        with self.assertRaises(httpx.ReadTimeout):
+            await self.client.token({'grant_type': 'password'})
+        self.assertEqual(len(self.requests), 2)
+
+    async def test_post_retried_on_connect_error(self):
+        """Test that POSTs are retried when the connection could not be established"""
+        self.responses = [httpx.ConnectError('refused'), httpx.Response(200, json={'access_token': 'a'})]
+        response = await self.client.token({'grant_type': 'password'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.requests), 2)
+
+    @override_settings(KEYCLOAK_BREAKER_THRESHOLDS={'jwks': 1})
+    async def test_open_circuit_fails_fast(self):
+        """Test that the async client shares the operation's circuit breaker"""
+        self.responses = [httpx.Response(503)] * 3
+        await self.client.jwks()
+        with self.assertRaises(KeycloakUnavailable):
+            await self.client.jwks()
+        self.assertEqual(len(self.requests), 3)
+
+    def test_pool_limits(self):
+        """Test that the pool size and timeouts are applied to the httpx client"""
+        client = AsyncKeycloakClient('http://keycloak:8080', 'test-realm', pool_size=4,
+                                     connect_timeout=1, read_timeout=2)
+        self.assertEqual(client.session.timeout, httpx.Timeout(2, connect=1))
+        pool = client.session._transport._pool
+        self.assertEqual(pool._max_connections, 4)
+
+
+class TestGetClient(SimpleTestCase):
+    def setUp(self):
+        keycloak._reset_after_fork()
+        self.addCleanup(keycloak._reset_after_fork)
+
+    def test_client_reused(self):
+        """Test that a worker reuses a single client"""
+        self.assertIs(get_client(), get_client())
+
+    def test_new_client_after_fork(self):
+        """Test that a forked worker doesn't reuse the parent's connection pool"""
+        parent = get_client()
+        with mock.patch('api.keycloak.os.getpid', return_value=-1):
+            child = get_client()
+        self.assertIsNot(parent, child)
+
+    async def test_async_client_per_event_loop(self):
+        """Test that the async client is reused within an event loop"""
+        client = get_async_client()
+        self.assertIsInstance(client, AsyncKeycloakClient)
+        self.assertIs(client, get_async_client())
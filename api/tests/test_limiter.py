@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core import limiter
+from core.limiter import AdaptiveLimiter, get_limiter
+
+
+class TestAdaptiveLimiter(SimpleTestCase):
+    def test_limit_grows_when_fast_and_used(self):
+        """Test that fast requests raise a limit that is in use"""
+        limiter = AdaptiveLimiter('idp', initial_limit=2, max_limit=3, latency_target=0.5)
+        for _ in range(3):
+            limiter.acquire(0)
+            limiter.acquire(0)
+            limiter.release(0.1)
+            limiter.release(0.1)
+        self.assertEqual(limiter.stats()['limit'], 3)
+
+    def test_idle_limit_not_grown(self):
+        """Test that the limit doesn't grow from a trickle of requests"""
+        limiter = AdaptiveLimiter('idp', initial_limit=10, latency_target=0.5)
+        for _ in range(20):
+            limiter.acquire(0)
+            limiter.release(0.1)
+        self.assertEqual(limiter.stats()['limit'], 10)
+
+    def test_limit_backs_off_on_latency(self):
+        """Test that slow or failed requests shrink the limit multiplicatively, down to the minimum"""
+        limiter = AdaptiveLimiter('idp', initial_limit=10, min_limit=2, latency_target=0.5, backoff_ratio=0.5)
+        with mock.patch('core.limiter.time.monotonic', side_effect=[100, 101, 102]):
+            limiter.acquire(0)
+            limiter.release(2.0)
+            self.assertEqual(limiter.stats()['limit'], 5)
+            limiter.acquire(0)
+            limiter.release(0.1, overloaded=True)
+            limiter.acquire(0)
+            limiter.release(0.1, overloaded=True)
+        self.assertEqual(limiter.stats()['limit'], 2)
+
+    def test_burst_backs_off_once(self):
+        """Test that many requests slowed down together shrink the limit once per latency window"""
+        limiter = AdaptiveLimiter('idp', initial_limit=40, min_limit=1, latency_target=0.5, backoff_ratio=0.9)
+        for _ in range(40):
+            self.assertTrue(limiter.acquire(0))
+        releases = [threading.Thread(target=limiter.release, args=(2.0,)) for _ in range(40)]
+        with mock.patch('core.limiter.time.monotonic', return_value=100):
+            for thread in releases:
+                thread.start()
+            for thread in releases:
+                thread.join()
+        self.assertEqual(limiter.stats(), {'limit': 36, 'inflight': 0, 'queued': 0, 'rejected': 0})
+
+        # Requests still slow a window later back off again
+        with mock.patch('core.limiter.time.monotonic', return_value=100.5):
+            limiter.acquire(0)
+            limiter.release(2.0)
+        self.assertEqual(limiter.stats()['limit'], 32)
+
+    def test_rejected_after_queue_timeout(self):
+        """Test that a request waiting longer than the queue timeout is rejected"""
+        limiter = AdaptiveLimiter('idp', initial_limit=1)
+        self.assertTrue(limiter.acquire(0))
+        self.assertFalse(limiter.acquire(0.01))
+        self.assertEqual(limiter.stats(), {'limit': 1, 'inflight': 1, 'queued': 0, 'rejected': 1})
+
+    def test_full_queue_rejects_immediately(self):
+        """Test that the queue is bounded"""
+        limiter = AdaptiveLimiter('idp', initial_limit=1, max_queue=0)
+        limiter.acquire(0)
+        with mock.patch('core.limiter._Waiter') as waiter:
+            self.assertFalse(limiter.acquire(10))
+        waiter.assert_not_called()
+
+    def test_queued_thread_gets_released_slot(self):
+        """Test that a released slot goes to the oldest queued request"""
+        limiter = AdaptiveLimiter('idp', initial_limit=1)
+        limiter.acquire(0)
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(limiter.acquire(5)))
+        waiter.start()
+        while not limiter.stats()['queued']:
+            time.sleep(0.001)
+        limiter.release(0.1)
+        waiter.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(limiter.stats()['inflight'], 1)
+
+    def test_queued_coroutine_gets_released_slot(self):
+        """Test that async requests wait for a slot without blocking the event loop"""
+        limiter = AdaptiveLimiter('idp', initial_limit=1)
+
+        async def scenario():
+            await limiter.aacquire(0)
+            waiting = asyncio.ensure_future(limiter.aacquire(5))
+            await asyncio.sleep(0)
+            self.assertEqual(limiter.stats()['queued'], 1)
+            limiter.release(0.1)
+            return await waiting
+
+        self.assertTrue(asyncio.run(scenario()))
+
+
+@override_settings(
+    CONCURRENCY_LIMITS={
+        'idp': {'initial_limit': 1, 'queue_timeout': 0},
+        'local': {'initial_limit': 5, 'queue_timeout': 0},
+    },
+    CONCURRENCY_RETRY_AFTER=2,
+)
+class TestConcurrencyLimitMiddleware(TestCase):
+    def setUp(self):
+        limiter._reset_after_fork()
+        self.addCleanup(limiter._reset_after_fork)
+        self.client = APIClient()
+
+    def test_idp_requests_shed(self):
+        """Test that IdP-bound requests over the limit are answered 503 with Retry-After"""
+        get_limiter('idp').acquire(0)
+        with mock.patch('api.views.get_client') as get_client:
+            response = self.client.post(reverse('login'), {'username': 'alice', 'password': 'pw'}, format='json')
+        get_client.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '2')
+
+    def test_local_requests_unaffected(self):
+        """Test that a saturated IdP group doesn't limit locally served endpoints"""
+        get_limiter('idp').acquire(0)
+        response = self.client.get(reverse('api_profile'))
+        self.assertNotEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(get_limiter('local').stats()['inflight'], 0)
+
+    def test_slot_released(self):
+        """Test that the slot is given back when the view returns"""
+        with mock.patch('api.views.get_client'):
+            self.client.post(reverse('login'), {'username': 'alice'}, format='json')
+        self.assertEqual(get_limiter('idp').stats()['inflight'], 0)
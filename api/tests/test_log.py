@@ -0,0 +1,155 @@
+import io
+import json
+import logging
+import sys
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from core.log import BackgroundHandler, JsonFormatter, SamplingFilter, redact
+
+
+def make_record(msg='Hello %s', args=('world',), level=logging.INFO, lineno=10, **extra):
+    record = logging.LogRecord('api.views', level, 'api/views.py', lineno, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestRedact(SimpleTestCase):
+    def test_bearer_token(self):
+        """Test that authorization header values are masked"""
+        self.assertEqual(redact('Authorization: Bearer abc.def-ghi'), 'Authorization: Bearer [REDACTED]')
+
+    def test_jwt(self):
+        """Test that JWTs are masked wherever they appear"""
+        self.assertEqual(redact('token eyJhbGciOi.eyJzdWIiOi.c2lnbmF0dXJl expired'), 'token [REDACTED] expired')
+
+    def test_key_values(self):
+        """Test that passwords and secrets are masked in JSON bodies and query strings"""
+        self.assertEqual(
+            redact('{"access_token": "abc", "expires_in": 300, "refresh_token": "def"}'),
+            '{"access_token": "[REDACTED]", "expires_in": 300, "refresh_token": "[REDACTED]"}',
+        )
+        self.assertEqual(
+            redact('grant_type=password&username=bob&password=hunter2&client_secret=s3cret'),
+            'grant_type=password&username=bob&password=[REDACTED]&client_secret=[REDACTED]',
+        )
+
+    def test_plain_text_untouched(self):
+        """Test that messages without credentials are left alone"""
+        self.assertEqual(redact('User bob logged in successfully'), 'User bob logged in successfully')
+
+
+class TestSamplingFilter(SimpleTestCase):
+    def test_burst_per_call_site(self):
+        """Test that each call site gets its own burst"""
+        sampling = SamplingFilter(burst=2, period=60)
+        self.assertEqual([sampling.filter(make_record()) for _ in range(4)], [True, True, False, False])
+        self.assertTrue(sampling.filter(make_record(lineno=20)))
+
+    def test_warnings_not_sampled(self):
+        """Test that warnings and errors always get through"""
+        sampling = SamplingFilter(burst=1, period=60)
+        self.assertTrue(all(sampling.filter(make_record(level=logging.WARNING)) for _ in range(5)))
+
+    def test_suppressed_count_reported(self):
+        """Test that the next period's first record carries the number of records dropped"""
+        sampling = SamplingFilter(burst=1, period=60)
+        with mock.patch('core.log.time.monotonic', return_value=0):
+            for _ in range(4):
+                sampling.filter(make_record())
+        record = make_record()
+        with mock.patch('core.log.time.monotonic', return_value=60):
+            self.assertTrue(sampling.filter(record))
+        self.assertEqual(record.suppressed, 3)
+
+    def test_disabled(self):
+        """Test that a burst of 0 turns sampling off"""
+        sampling = SamplingFilter(burst=0)
+        self.assertTrue(all(sampling.filter(make_record()) for _ in range(100)))
+
+
+class TestJsonFormatter(SimpleTestCase):
+    def test_fields(self):
+        """Test that records are written as JSON with their extra attributes"""
+        entry = json.loads(JsonFormatter().format(make_record(view='login')))
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['logger'], 'api.views')
+        self.assertEqual(entry['message'], 'Hello world')
+        self.assertEqual(entry['view'], 'login')
+
+    def test_exception(self):
+        """Test that tracebacks are included"""
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = logging.LogRecord('api.views', logging.ERROR, __file__, 1, 'Failed', (), sys.exc_info())
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertIn('ValueError: boom', entry['exception'])
+
+
+class TestBackgroundHandler(SimpleTestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = BackgroundHandler(stream=self.stream)
+        self.handler.setFormatter(JsonFormatter())
+
+    def tearDown(self):
+        self.handler.close()
+
+    def lines(self):
+        self.handler.close()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_written_by_background_thread(self):
+        """Test that records are formatted and redacted by the writer thread"""
+        threads = []
+        write = self.handler.write
+        with mock.patch.object(self.handler, 'write', side_effect=lambda record: (
+                threads.append(threading.current_thread().name), write(record))):
+            self.handler.handle(make_record('Keycloak said %s', ('{"access_token": "abc"}',)))
+            lines = self.lines()
+        self.assertEqual(threads, ['log-writer'])
+        self.assertEqual(lines[0]['message'], 'Keycloak said {"access_token": "[REDACTED]"}')
+
+    def test_arguments_merged_by_caller(self):
+        """Test that arguments changed after the call don't change the message"""
+        body = {'state': 'before'}
+        self.handler.handle(make_record('Body %s', (body,)))
+        body['state'] = 'after'
+        self.assertEqual(self.lines()[0]['message'], "Body {'state': 'before'}")
+
+    def test_extra_attributes_redacted(self):
+        """Test that extra= values are redacted too"""
+        self.handler.handle(make_record(url='/reset?token=abc'))
+        self.assertEqual(self.lines()[0]['url'], '/reset?token=[REDACTED]')
+
+    def test_full_queue_drops(self):
+        """Test that a full queue drops records instead of blocking and reports how many"""
+        self.handler.close()
+        self.handler.queue_size = 1
+        self.handler.start()
+        writing, release = threading.Event(), threading.Event()
+        written = []
+
+        def write(record):
+            writing.set()
+            release.wait(5)
+            written.append(record)
+
+        with mock.patch.object(self.handler, 'write', side_effect=write):
+            self.handler.handle(make_record())
+            writing.wait(5)
+            # The writer is busy and the queue holds one record
+            for _ in range(3):
+                self.handler.handle(make_record())
+            self.assertEqual(self.handler.dropped, 2)
+            release.set()
+            while len(written) < 2:
+                time.sleep(0.01)
+            self.handler.handle(make_record())
+            self.handler.close()
+        self.assertEqual(self.handler.dropped, 0)
+        self.assertEqual([getattr(record, 'dropped', None) for record in written], [None, None, 2])
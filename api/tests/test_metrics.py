@@ -0,0 +1,95 @@
+from unittest import mock
+
+import requests
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from prometheus_client import REGISTRY
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api import circuit_breaker
+from api.keycloak import KeycloakClient
+from api.tests.test_views import keycloak_response
+from core.cache import TwoTierCache
+from core.query_budget import install_execute_wrapper
+from users.tests.factories import UserFactory
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestRequestMetrics(TestCase):
+    def setUp(self):
+        install_execute_wrapper(None, connection)
+        self.client = APIClient()
+        self.user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+
+    def test_request_latency_and_queries(self):
+        """Test that each request's latency and query count are recorded under its URL name"""
+        latency = sample('http_request_duration_seconds_count', view='toggle_mfa', method='POST', status='200')
+        queries = sample('http_request_db_queries_sum', view='toggle_mfa')
+        response = self.client.post(reverse('toggle_mfa'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sample('http_request_duration_seconds_count', view='toggle_mfa', method='POST', status='200'),
+            latency + 1)
+        self.assertGreater(sample('http_request_db_queries_sum', view='toggle_mfa'), queries)
+
+    def test_unmatched_paths_share_a_label(self):
+        """Test that unknown paths don't create a series each"""
+        before = sample('http_request_duration_seconds_count', view='unmatched', method='GET', status='404')
+        self.client.get('/no-such-page/')
+        self.assertEqual(
+            sample('http_request_duration_seconds_count', view='unmatched', method='GET', status='404'),
+            before + 1)
+
+    def test_metrics_endpoint(self):
+        """Test that the metrics are served in the Prometheus text format"""
+        self.client.get(reverse('api_profile'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'http_request_duration_seconds_bucket', response.content)
+        self.assertIn(b'keycloak_request_duration_seconds', response.content)
+
+
+class TestKeycloakMetrics(SimpleTestCase):
+    def setUp(self):
+        self.client = KeycloakClient('http://keycloak:8080', 'test-realm')
+        circuit_breaker._reset_after_fork()
+
+    def test_call_latency_by_status(self):
+        """Test that Keycloak calls are timed by operation and response status"""
+        before = sample('keycloak_request_duration_seconds_count', operation='userinfo', status='401')
+        with mock.patch.object(self.client.session, 'request', return_value=keycloak_response(401)):
+            self.client.userinfo('token')
+        self.assertEqual(
+            sample('keycloak_request_duration_seconds_count', operation='userinfo', status='401'), before + 1)
+
+    def test_failed_call(self):
+        """Test that calls without a response are recorded as errors"""
+        before = sample('keycloak_request_duration_seconds_count', operation='token', status='error')
+        with mock.patch.object(self.client.session, 'request', side_effect=requests.ConnectionError('refused')):
+            with self.assertRaises(requests.ConnectionError):
+                self.client.token({'grant_type': 'password'})
+        self.assertEqual(
+            sample('keycloak_request_duration_seconds_count', operation='token', status='error'), before + 1)
+
+
+class TestCacheMetrics(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_lookups_by_result(self):
+        """Test that cache lookups are counted as local hits, shared hits or misses"""
+        tiered = TwoTierCache('metrics-test')
+        tiered.get('key')
+        tiered.set('key', 'value', 60)
+        tiered.get('key')
+        tiered.clear_local()
+        tiered.get('key')
+        for result in ('miss', 'local_hit', 'shared_hit'):
+            self.assertEqual(sample('cache_lookups_total', cache='metrics-test', result=result), 1)
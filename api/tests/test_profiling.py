@@ -0,0 +1,112 @@
+import asyncio
+import marshal
+from unittest import mock
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+
+from core.profiling import ProfilingMiddleware, recent_profiles
+from users.tests.factories import UserFactory
+
+
+def view(request):
+    sum(i * i for i in range(10000))
+    return HttpResponse()
+
+
+@override_settings(PROFILING_TOKEN='secret', PROFILING_SAMPLE_RATE=0)
+class TestProfilingMiddleware(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def test_not_profiled_by_default(self):
+        """Test that requests without the token aren't profiled"""
+        with mock.patch('pyinstrument.Profiler') as profiler:
+            ProfilingMiddleware(view)(self.factory.get('/api/login/'))
+        profiler.assert_not_called()
+        self.assertEqual(recent_profiles(), [])
+
+    def test_wrong_token_ignored(self):
+        """Test that only the configured token triggers profiling"""
+        ProfilingMiddleware(view)(self.factory.get('/api/login/', headers={'X-Profile-Token': 'guess'}))
+        self.assertEqual(recent_profiles(), [])
+
+    def test_profiled_with_token(self):
+        """Test that a request with the token is profiled and stored"""
+        response = ProfilingMiddleware(view)(self.factory.get('/api/login/', headers={'X-Profile-Token': 'secret'}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        [profile] = recent_profiles()
+        self.assertEqual(profile['id'], 1)
+        self.assertEqual(profile['path'], '/api/login/')
+        self.assertEqual(profile['view'], 'login')
+        self.assertEqual(profile['status'], 200)
+        self.assertNotIn('session', profile)
+
+    @override_settings(PROFILING_TOKEN='', PROFILING_SAMPLE_RATE=1.0)
+    def test_sampled(self):
+        """Test that sampled requests are profiled, newest listed first"""
+        middleware = ProfilingMiddleware(view)
+        middleware(self.factory.get('/api/login/'))
+        middleware(self.factory.post('/api/register/'))
+        self.assertEqual([profile['id'] for profile in recent_profiles()], [2, 1])
+
+    @override_settings(PROFILING_MAX_LISTED=1)
+    def test_listing_bounded(self):
+        """Test that only the most recent profiles are listed"""
+        middleware = ProfilingMiddleware(view)
+        for _ in range(3):
+            middleware(self.factory.get('/api/login/', headers={'X-Profile-Token': 'secret'}))
+        self.assertEqual([profile['id'] for profile in recent_profiles()], [3])
+
+    def test_async_profiled(self):
+        """Test that async requests are profiled"""
+        async def async_view(request):
+            await asyncio.sleep(0.01)
+            return HttpResponse()
+
+        request = AsyncRequestFactory().get('/api/login/', headers={'X-Profile-Token': 'secret'})
+        asyncio.run(ProfilingMiddleware(async_view)(request))
+        self.assertEqual(len(recent_profiles()), 1)
+
+    def test_storage_errors_ignored(self):
+        """Test that a cache outage doesn't fail the profiled request"""
+        with mock.patch('core.profiling.cache.incr', side_effect=ConnectionError('down')):
+            response = ProfilingMiddleware(view)(
+                self.factory.get('/api/login/', headers={'X-Profile-Token': 'secret'}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+@override_settings(PROFILING_TOKEN='secret')
+class TestProfileAdmin(TestCase):
+    def setUp(self):
+        cache.clear()
+        ProfilingMiddleware(view)(RequestFactory().get('/api/login/', headers={'X-Profile-Token': 'secret'}))
+
+    def test_staff_only(self):
+        """Test that profiles are only shown to staff"""
+        self.client.force_login(UserFactory())
+        response = self.client.get(reverse('admin_profiles'))
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+
+    def test_list_and_download(self):
+        """Test that stored profiles are listed and downloadable in both formats"""
+        self.client.force_login(UserFactory(is_staff=True))
+        response = self.client.get(reverse('admin_profiles'))
+        self.assertContains(response, '/api/login/')
+
+        response = self.client.get(reverse('admin_profile_download', args=[1, 'speedscope']))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="profile-1.speedscope.json"')
+        self.assertIn(b'speedscope', response.content)
+
+        response = self.client.get(reverse('admin_profile_download', args=[1, 'pstats']))
+        self.assertIsInstance(marshal.loads(response.content), dict)
+
+    def test_expired_profile(self):
+        """Test that a profile past its TTL is a 404"""
+        self.client.force_login(UserFactory(is_staff=True))
+        response = self.client.get(reverse('admin_profile_download', args=[2, 'pstats']))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,156 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from prometheus_client import REGISTRY
+from rest_framework import status
+
+from core.metrics import MetricsMiddleware
+from core.query_budget import QueryBudgetExceeded, QueryBudgetMiddleware, QueryLog
+from users.tests.factories import UserFactory
+
+
+def run_queries(count, distinct=False):
+    def view(request):
+        for i in range(count):
+            if distinct:
+                User.objects.filter(pk=i).exists() if i % 2 else User.objects.filter(username=str(i)).exists()
+            else:
+                User.objects.filter(pk=i).exists()
+        return HttpResponse()
+    return view
+
+
+class TestQueryLog(TestCase):
+    def test_savepoints_not_counted(self):
+        """Test that savepoints don't count against the budget"""
+        queries = QueryLog()
+        queries.add('SAVEPOINT "s1_x1"', False)
+        queries.add('SELECT 1', False)
+        queries.add('RELEASE SAVEPOINT "s1_x1"', False)
+        self.assertEqual(queries.count, 1)
+
+    def test_repeated_statements(self):
+        """Test that statements run with different parameters are grouped by their SQL"""
+        queries = QueryLog()
+        for _ in range(3):
+            queries.add('SELECT * FROM users_userprofile WHERE user_id = %s', False)
+        queries.add('SELECT 1', False)
+        self.assertEqual(queries.repeated(3), [('SELECT * FROM users_userprofile WHERE user_id = %s', 3)])
+        self.assertEqual(queries.repeated(4), [])
+
+
+@override_settings(QUERY_BUDGETS={'api_profile': 2}, QUERY_REPEAT_THRESHOLD=3)
+class TestQueryBudgetMiddleware(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_within_budget(self):
+        """Test that requests within their budget pass"""
+        response = QueryBudgetMiddleware(run_queries(2, distinct=True))(self.factory.get('/users/api/profile/'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_over_budget_raises_when_strict(self):
+        """Test that a view going over its budget fails under QUERY_BUDGET_STRICT"""
+        middleware = QueryBudgetMiddleware(run_queries(3, distinct=True))
+        with self.assertRaisesMessage(QueryBudgetExceeded, '3 queries, budget is 2'):
+            middleware(self.factory.get('/users/api/profile/'))
+
+    @override_settings(QUERY_BUDGET_STRICT=False)
+    def test_over_budget_logged(self):
+        """Test that budget violations are only logged in production"""
+        middleware = QueryBudgetMiddleware(run_queries(3, distinct=True))
+        with self.assertLogs('core.query_budget', 'WARNING') as logs:
+            response = middleware(self.factory.get('/users/api/profile/'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('Query budget of api_profile exceeded: 3 queries, budget is 2', logs.output[0])
+
+    def test_repeated_query_detected(self):
+        """Test that a query run in a loop is reported even without a budget"""
+        middleware = QueryBudgetMiddleware(run_queries(3))
+        with self.assertRaisesMessage(QueryBudgetExceeded, '3x SELECT'):
+            middleware(self.factory.get('/no-budget/'))
+
+    def test_log_shared_with_metrics(self):
+        """Test that the request metrics and the query budget use one log and one execute wrapper"""
+        before = REGISTRY.get_sample_value('http_request_db_queries_sum', {'view': 'api_profile'}) or 0
+        budget = QueryBudgetMiddleware(run_queries(2, distinct=True))
+        with mock.patch.object(budget, 'check') as check:
+            MetricsMiddleware(budget)(self.factory.get('/users/api/profile/'))
+        self.assertEqual(check.call_args.args[1].count, 2)
+        self.assertEqual(REGISTRY.get_sample_value('http_request_db_queries_sum', {'view': 'api_profile'}), before + 2)
+        wrappers = [wrapper.__name__ for wrapper in connection.execute_wrappers]
+        self.assertEqual(wrappers.count('log_queries'), 1)
+        self.assertNotIn('count_queries', wrappers)
+
+    def test_queries_outside_requests_ignored(self):
+        """Test that queries run outside a request aren't recorded"""
+        QueryBudgetMiddleware(run_queries(0))
+        with mock.patch.object(QueryLog, 'add') as add:
+            User.objects.count()
+        add.assert_not_called()
+        self.assertIn('log_queries', [wrapper.__name__ for wrapper in connection.execute_wrappers])
+
+
+class TestViewBudgets(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        # Session authentication is the most expensive way in
+        self.client.force_login(self.user)
+
+    def test_profile_endpoints_within_budget(self):
+        """Test that the profile API stays within its budgets with session authentication"""
+        self.assertEqual(self.client.get(reverse('api_profile')).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.post(reverse('toggle_mfa')).status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('update_phone'), {'phone_number': '+15550001111'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response.headers['ETag']
+        response = self.client.patch(reverse('api_profile'), {'mfa_enabled': True}, content_type='application/json',
+                                     HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_user_directory_within_budget(self):
+        """Test that any page of the user directory is read in a single query"""
+        self.user.is_staff = True
+        self.user.save()
+        UserFactory.create_batch(3)
+        response = self.client.get(reverse('user_directory'), {'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNone(response.data['next'])
+
+    def test_anonymous_endpoints_with_session_cookie_within_budget(self):
+        """Test that login, registration and password recovery stay within their budgets from a logged in browser"""
+        keycloak = mock.Mock()
+        keycloak.token.return_value = mock.Mock(status_code=200, json=mock.Mock(return_value={'access_token': 'a'}))
+        keycloak.admin_token.return_value = mock.Mock(
+            status_code=200, json=mock.Mock(return_value={'access_token': 'admin', 'expires_in': 60}))
+        keycloak.create_user.return_value = mock.Mock(
+            status_code=201, headers={'Location': 'http://keycloak:8080/admin/realms/test-realm/users/kc-new'})
+        with mock.patch('api.views.get_client', return_value=keycloak), \
+                mock.patch('api.admin_token.get_client', return_value=keycloak):
+            response = self.client.post(reverse('login'), {'username': self.user.username, 'password': 'pw'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(reverse('register'), {
+                'username': 'newuser', 'email': 'newuser@example.com', 'password': 'S3cure-pass',
+            })
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(reverse('forgot_password'), {'email': self.user.email})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_password_reset_within_budget(self):
+        """Test that resetting a password updates the user without touching its profile"""
+        self.client.logout()
+        session = self.client.session
+        session[f'reset_token_{self.user.email}'] = 'reset-token'
+        session.save()
+        with self.assertNumQueries(2):
+            response = self.client.post(reverse('reset_password'), {
+                'email': self.user.email, 'token': 'reset-token', 'new_password': 'n3w-Passw0rd',
+            })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
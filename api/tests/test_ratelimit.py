@@ -0,0 +1,167 @@
+import json
+from unittest import mock
+
+from django.conf import settings
+from django.core import mail
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from redis.exceptions import ConnectionError
+
+from api import async_views, ratelimit
+from api.ratelimit import TOKEN_BUCKET_SCRIPT, RateLimiter, parse_rate
+from api.tests.test_views import keycloak_response
+from users.tests.factories import UserFactory
+
+RATE_LIMITS = {
+    'login': {'ip': '5/min', 'username': '2/min'},
+    'register': {'ip': '1/hour'},
+    'forgot_password': {'ip': '10/hour', 'email': '1/hour'},
+}
+
+
+class TestRateLimiter(SimpleTestCase):
+    def setUp(self):
+        self.limiter = RateLimiter()
+        self.limiter._script = False
+
+    def test_parse_rate(self):
+        """Test that DRF style rates are understood"""
+        self.assertEqual(parse_rate('10/min'), (10, 60))
+        self.assertEqual(parse_rate('3/hour'), (3, 3600))
+        self.assertEqual(parse_rate('1/s'), (1, 1))
+
+    def test_bucket_refills(self):
+        """Test that a bucket allows its capacity at once, then refills over the period"""
+        buckets = [('a', 2, 60)]
+        self.assertEqual(self.limiter._hit_local(buckets, 0), 0)
+        self.assertEqual(self.limiter._hit_local(buckets, 0), 0)
+        self.assertAlmostEqual(self.limiter._hit_local(buckets, 0), 30)
+        self.assertAlmostEqual(self.limiter._hit_local(buckets, 20), 10)
+        self.assertEqual(self.limiter._hit_local(buckets, 30), 0)
+
+    def test_rejection_takes_no_tokens(self):
+        """Test that a request rejected by one bucket leaves the others untouched"""
+        self.limiter._hit_local([('user', 1, 60)], 0)
+        self.assertTrue(self.limiter._hit_local([('ip', 1, 60), ('user', 1, 60)], 0))
+        self.assertEqual(self.limiter._hit_local([('ip', 1, 60)], 0), 0)
+
+    def test_redis_script(self):
+        """Test that all buckets are decided in one script call with capacities and periods in ms"""
+        connection = mock.Mock()
+        connection.register_script.return_value.return_value = 1500
+        with mock.patch('django_redis.get_redis_connection', return_value=connection):
+            limiter = RateLimiter()
+            wait = limiter.hit([('ip', 5, 60), ('user', 2, 3600)])
+        self.assertEqual(wait, 1.5)
+        connection.register_script.assert_called_once_with(TOKEN_BUCKET_SCRIPT)
+        connection.register_script.return_value.assert_called_once_with(
+            keys=['ip', 'user'], args=[5, 60000, 2, 3600000])
+
+    def test_redis_errors_fail_open(self):
+        """Test that the limiter lets requests through while Redis is down"""
+        connection = mock.Mock()
+        connection.register_script.return_value.side_effect = ConnectionError('down')
+        with mock.patch('django_redis.get_redis_connection', return_value=connection):
+            self.assertEqual(RateLimiter().hit([('ip', 5, 60)]), 0)
+
+    def test_in_process_without_redis(self):
+        """Test that cache backends other than Redis use in-process buckets"""
+        with mock.patch('django_redis.get_redis_connection', side_effect=NotImplementedError):
+            limiter = RateLimiter()
+            self.assertEqual(limiter.hit([('ip', 1, 60)]), 0)
+            self.assertTrue(limiter.hit([('ip', 1, 60)]))
+
+
+@override_settings(RATE_LIMIT_ENABLED=True, RATE_LIMITS=RATE_LIMITS)
+class TestThrottledViews(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.keycloak = mock.Mock()
+        self.keycloak.token.return_value = keycloak_response(401)
+        patcher = mock.patch('api.views.get_client', return_value=self.keycloak)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ratelimit._reset_after_fork()
+
+    def login(self, username, **extra):
+        return self.client.post(reverse('login'), {'username': username, 'password': 'bad'}, format='json', **extra)
+
+    def test_login_limited_per_username(self):
+        """Test that guessing one account's password is throttled before reaching Keycloak"""
+        self.assertEqual(self.login('alice').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.login('Alice').status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.login('alice', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(self.keycloak.token.call_count, 2)
+        self.assertEqual(self.login('bob').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_login_limited_per_ip(self):
+        """Test that one client spraying many usernames is throttled"""
+        for i in range(5):
+            self.assertEqual(self.login(f'user{i}').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.login('user5').status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.login('user5', REMOTE_ADDR='10.0.0.2').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_spoofed_forwarded_for_ignored(self):
+        """Test that clients can't get a fresh IP bucket by sending their own X-Forwarded-For"""
+        for i in range(5):
+            self.assertEqual(self.login(f'user{i}', HTTP_X_FORWARDED_FOR=f'203.0.113.{i}').status_code,
+                             status.HTTP_401_UNAUTHORIZED)
+        response = self.login('user5', HTTP_X_FORWARDED_FOR='203.0.113.99')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_forwarded_for_behind_proxy(self):
+        """Test that behind NUM_PROXIES proxies the address the proxy appended is the client IP"""
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            for i in range(5):
+                # Whatever the client sends, the proxy appends the address it saw
+                response = self.login(f'user{i}', HTTP_X_FORWARDED_FOR=f'203.0.113.{i}, 198.51.100.7')
+                self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            response = self.login('user5', HTTP_X_FORWARDED_FOR='203.0.113.99, 198.51.100.7')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            response = self.login('user5', HTTP_X_FORWARDED_FOR='198.51.100.8')
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_forgot_password_limited_per_email(self):
+        """Test that reset emails to one address are throttled"""
+        UserFactory(email='alice@example.com')
+        url = reverse('forgot_password')
+        self.assertEqual(self.client.post(url, {'email': 'alice@example.com'}).status_code, status.HTTP_200_OK)
+        response = self.client.post(url, {'email': 'ALICE@example.com'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(RATE_LIMIT_ENABLED=False)
+    def test_disabled(self):
+        """Test that RATE_LIMIT_ENABLED turns the limits off"""
+        for _ in range(3):
+            self.assertEqual(self.login('alice').status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(RATE_LIMIT_ENABLED=True, RATE_LIMITS=RATE_LIMITS)
+class TestAsyncThrottledViews(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.keycloak = mock.Mock()
+        self.keycloak.token = mock.AsyncMock(return_value=keycloak_response(401))
+        patcher = mock.patch('api.async_views.get_async_client', return_value=self.keycloak)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ratelimit._reset_after_fork()
+
+    async def test_login_limited(self):
+        """Test that the async login is throttled the same way"""
+        for _ in range(2):
+            request = self.factory.post(
+                '/api/login/', json.dumps({'username': 'alice', 'password': 'bad'}), content_type='application/json')
+            response = await async_views.login(request)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        request = self.factory.post(
+            '/api/login/', json.dumps({'username': 'alice', 'password': 'bad'}), content_type='application/json')
+        response = await async_views.login(request)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(self.keycloak.token.await_count, 2)
@@ -0,0 +1,174 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api import admin_token
+from api.keycloak import KeycloakUnavailable
+from users.tests.factories import UserFactory
+
+
+def keycloak_response(status_code, json=None, headers=None):
+    response = mock.Mock(status_code=status_code, text='', headers=headers or {})
+    response.json.return_value = json
+    return response
+
+
+class KeycloakViewTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.keycloak = mock.Mock()
+        for target in ('api.views.get_client', 'api.admin_token.get_client'):
+            patcher = mock.patch(target, return_value=self.keycloak)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        admin_token._reset_after_fork()
+        cache.clear()
+
+
+class TestLogin(KeycloakViewTestCase):
+    def test_login_success(self):
+        """Test that Keycloak tokens are returned on a successful password grant"""
+        self.keycloak.token.return_value = keycloak_response(
+            200, {'access_token': 'access', 'refresh_token': 'refresh'})
+        response = self.client.post(reverse('login'), {'username': 'alice', 'password': 'pw'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'token': 'access', 'refresh_token': 'refresh'})
+        self.assertEqual(self.keycloak.token.call_args.args[0]['username'], 'alice')
+
+    def test_login_invalid_credentials(self):
+        """Test that rejected credentials are reported as 401"""
+        self.keycloak.token.return_value = keycloak_response(401)
+        response = self.client.post(reverse('login'), {'username': 'alice', 'password': 'bad'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_login_missing_fields(self):
+        """Test that username and password are required"""
+        response = self.client.post(reverse('login'), {'username': 'alice'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.keycloak.token.assert_not_called()
+
+
+    def test_login_keycloak_unavailable(self):
+        """Test that logins fail fast with a 503 while Keycloak's circuit is open"""
+        self.keycloak.token.side_effect = KeycloakUnavailable('token', 12)
+        response = self.client.post(reverse('login'), {'username': 'alice', 'password': 'pw'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '12')
+
+
+class TestRegister(KeycloakViewTestCase):
+    payload = {'username': 'newuser', 'email': 'newuser@example.com', 'password': 'S3cure-pass'}
+
+    def setUp(self):
+        super().setUp()
+        self.keycloak.admin_token.return_value = keycloak_response(200, {'access_token': 'admin', 'expires_in': 60})
+        self.keycloak.create_user.return_value = keycloak_response(
+            201, headers={'Location': 'http://keycloak:8080/admin/realms/test-realm/users/kc-new'})
+        self.keycloak.delete_user.return_value = keycloak_response(204)
+
+    def test_register_success(self):
+        """Test that a user is created in Keycloak and Django with the Keycloak ID"""
+        response = self.client.post(reverse('register'), self.payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        user = User.objects.get(username='newuser')
+        self.assertEqual(user.email, 'newuser@example.com')
+        self.assertEqual(user.userprofile.keycloak_id, 'kc-new')
+        self.keycloak.find_users.assert_not_called()
+        self.assertFalse(user.has_usable_password())
+
+    @override_settings(KEYCLOAK_MANAGED_PASSWORDS=False)
+    def test_register_local_password(self):
+        """Test that the password is also hashed locally when Keycloak doesn't own it"""
+        self.client.post(reverse('register'), self.payload, format='json')
+        self.assertTrue(User.objects.get(username='newuser').check_password('S3cure-pass'))
+
+    def test_register_queries(self):
+        """Test that registration runs one uniqueness check and the inserts in one transaction"""
+        # SAVEPOINT + RELEASE wrap the user and profile inserts
+        with self.assertNumQueries(5):
+            response = self.client.post(reverse('register'), self.payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_register_database_failure_compensates(self):
+        """Test that the Keycloak user is removed when the Django insert fails"""
+        with mock.patch('users.models.UserProfile.objects.create', side_effect=RuntimeError('db down')):
+            response = self.client.post(reverse('register'), self.payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.keycloak.delete_user.assert_called_once_with('admin', 'kc-new')
+        self.assertFalse(User.objects.filter(username='newuser').exists())
+
+    def test_register_without_location_compensates(self):
+        """Test that a Keycloak user created without a usable Location is found by username and removed"""
+        self.keycloak.create_user.return_value = keycloak_response(201)
+        self.keycloak.find_users.return_value = keycloak_response(200, [
+            {'id': 'kc-other', 'username': 'newuser2'},
+            {'id': 'kc-new', 'username': 'newuser'},
+        ])
+        response = self.client.post(reverse('register'), self.payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.keycloak.find_users.assert_called_once_with('admin', username='newuser', exact='true')
+        self.keycloak.delete_user.assert_called_once_with('admin', 'kc-new')
+        self.assertFalse(User.objects.filter(username='newuser').exists())
+
+    def test_register_duplicate_username(self):
+        """Test that an existing username is rejected before calling Keycloak"""
+        UserFactory(username='newuser')
+        response = self.client.post(reverse('register'), self.payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], 'Username already exists')
+        self.keycloak.create_user.assert_not_called()
+
+    def test_register_duplicate_email(self):
+        """Test that an existing email is rejected before calling Keycloak"""
+        UserFactory(email='newuser@example.com')
+        response = self.client.post(reverse('register'), self.payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], 'Email already exists')
+
+    def test_register_duplicate_email_other_case(self):
+        """Test that emails differing only in letter case count as taken"""
+        UserFactory(email='NewUser@Example.com')
+        response = self.client.post(reverse('register'), self.payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], 'Email already exists')
+
+    def test_register_keycloak_failure(self):
+        """Test that no Django user is created when Keycloak rejects the user"""
+        self.keycloak.create_user.return_value = keycloak_response(409)
+        response = self.client.post(reverse('register'), self.payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertFalse(User.objects.filter(username='newuser').exists())
+
+    def test_register_reuses_admin_token(self):
+        """Test that consecutive registrations share one admin token"""
+        self.client.post(reverse('register'), self.payload, format='json')
+        self.client.post(reverse('register'), dict(self.payload, username='other', email='other@example.com'), format='json')
+        self.keycloak.admin_token.assert_called_once()
+        self.assertEqual(self.keycloak.create_user.call_count, 2)
+
+    def test_register_admin_login_failure(self):
+        """Test that a failed admin login is reported"""
+        self.keycloak.admin_token.return_value = keycloak_response(401)
+        response = self.client.post(reverse('register'), self.payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(response.data['error'], 'Failed to authenticate with Keycloak admin')
+
+
+class TestForgotPassword(TestCase):
+    def test_email_any_case(self):
+        """Test that the account is found whatever the letter case of the email"""
+        UserFactory(email='Someone@Example.com')
+        response = APIClient().post(reverse('forgot_password'), {'email': 'someone@example.COM'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_unknown_email(self):
+        """Test that unknown emails are reported"""
+        response = APIClient().post(reverse('forgot_password'), {'email': 'nobody@example.com'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
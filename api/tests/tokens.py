@@ -0,0 +1,37 @@
+import json
+import time
+import uuid
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+
+# One throwaway realm key for the whole test run
+SIGNING_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+KID = 'test-kid'
+
+
+def public_jwk(key=SIGNING_KEY, kid=KID):
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+    jwk.update({'kid': kid, 'use': 'sig', 'alg': 'RS256'})
+    return jwk
+
+
+JWKS = {'keys': [public_jwk()]}
+
+
+def make_token(key=SIGNING_KEY, kid=KID, **claims):
+    """Build an access token shaped like the ones Keycloak issues"""
+    now = int(time.time())
+    payload = {
+        'exp': now + 300,
+        'iat': now,
+        'iss': settings.KEYCLOAK_ISSUER,
+        'aud': 'account',
+        'azp': settings.KEYCLOAK_AUDIENCE,
+        'sub': str(uuid.uuid4()),
+        'preferred_username': 'kcuser',
+        'email': 'kcuser@example.com',
+    }
+    payload.update(claims)
+    return jwt.encode(payload, key, algorithm='RS256', headers={'kid': kid})
@@ -1,12 +1,18 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from users.views import user_directory
+from . import async_views, views
+
+# Under ASGI the Keycloak-bound endpoints are served by native async views
+auth_views = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
-    path('register/', views.register, name='register'),
-    path('login/', views.login, name='login'),
+    path('register/', auth_views.register, name='register'),
+    path('login/', auth_views.login, name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('forgot-password/', views.forgot_password, name='forgot_password'),
     path('reset-password/', views.reset_password, name='reset_password'),
     path('keycloak-check/', views.keycloak_check, name='keycloak_check'),
     path('admin-check/', views.admin_check, name='admin_check'),
+    path('users/', user_directory, name='user_directory'),
 ] 
\ No newline at end of file
@@ -1,9 +1,11 @@
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from django.contrib.auth.models import User
 from django.contrib.auth import logout, authenticate
+from django.db import transaction
+from django.db.models import Q
 from django.core.mail import send_mail
 from django.conf import settings
 import logging
@@ -11,7 +13,15 @@ import random
 import string
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
-import requests
+from core import deadline
+from core.deadline import DeadlineExceeded
+from core.limiter import limiter_stats
+from users.models import email_is
+from .authentication import token_cache
+from .admin_token import AdminTokenError, call_with_admin_token, get_admin_token
+from .circuit_breaker import breaker_states
+from .keycloak import KeycloakUnavailable, get_client
+from .ratelimit import ForgotPasswordRateThrottle, LoginRateThrottle, RegisterRateThrottle
 
 # Initialize logger
 logger = logging.getLogger(__name__)
@@ -80,6 +90,7 @@ login_schema = openapi.Schema(
 )
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([RegisterRateThrottle])
 def register(request):
     username = request.data.get('username')
     email = request.data.get('email')
@@ -89,101 +100,114 @@ def register(request):
         logger.error("Registration failed: Missing fields")
         return Response({'error': 'All fields are required'}, status=status.HTTP_400_BAD_REQUEST)
 
-    if User.objects.filter(username=username).exists():
-        logger.error(f"Registration failed: Username {username} already exists")
-        return Response({'error': 'Username already exists'}, status=status.HTTP_400_BAD_REQUEST)
-
-    if User.objects.filter(email=email).exists():
-        logger.error(f"Registration failed: Email {email} already exists")
+    # One query checks both unique fields
+    taken = User.objects.filter(Q(username=username) | Q(email_is(email))).values_list('username', flat=True)[:2]
+    if taken:
+        if username in taken:
+            logger.error("Registration failed: Username %s already exists", username)
+            return Response({'error': 'Username already exists'}, status=status.HTTP_400_BAD_REQUEST)
+        logger.error("Registration failed: Email %s already exists", email)
         return Response({'error': 'Email already exists'}, status=status.HTTP_400_BAD_REQUEST)
 
     # Register user in Keycloak
     try:
-        # Get admin token from Keycloak
-        admin_token_response = requests.post(
-            f"{settings.KEYCLOAK_URL}/realms/master/protocol/openid-connect/token",
-            data={
-                'grant_type': 'password',
-                'client_id': 'admin-cli',
-                'username': 'admin',
-                'password': 'admin',
-            },
-            headers={
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-        )
-        logger.debug(f"Admin token response: {admin_token_response.status_code} - {admin_token_response.text}")
+        client = get_client()
 
-        if admin_token_response.status_code != 200:
-            logger.error("Failed to authenticate with Keycloak admin")
-            return Response({'error': 'Failed to authenticate with Keycloak admin'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        
-        admin_token = admin_token_response.json()['access_token']
-        
-        # Create user in Keycloak
-        create_user_response = requests.post(
-            f"{settings.KEYCLOAK_URL}/admin/realms/{settings.KEYCLOAK_REALM}/users",
-            json={
-                'username': username,
-                'email': email,
-                'enabled': True,
-                'emailVerified': True,
-                'credentials': [
-                    {
-                        'type': 'password',
-                        'value': password,
-                        'temporary': False
-                    }
-                ]
-            },
-            headers={
-                'Authorization': f'Bearer {admin_token}',
-                'Content-Type': 'application/json'
-            }
-        )
+        # Create user in Keycloak with the shared admin token
+        create_user_response = call_with_admin_token(
+            client.create_user, keycloak_user_representation(username, email, password))
 
         if create_user_response.status_code != 201:
-            logger.error(f"Failed to create user in Keycloak: {create_user_response.text}")
+            logger.error("Failed to create user in Keycloak: %.200s", create_user_response.text)
             return Response({'error': 'Failed to create user in Keycloak'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Get the created user's ID from Keycloak
-        user_id_response = requests.get(
-            f"{settings.KEYCLOAK_URL}/admin/realms/{settings.KEYCLOAK_REALM}/users",
-            params={'username': username},
-            headers={
-                'Authorization': f'Bearer {admin_token}',
-                'Content-Type': 'application/json'
-            }
-        )
-
-        if user_id_response.status_code != 200:
-            logger.error(f"Failed to get user ID from Keycloak: {user_id_response.text}")
+        keycloak_id = created_user_id(create_user_response)
+        if not keycloak_id:
+            logger.error("Keycloak did not return the created user's location, removing user %s", username)
+            with deadline.suspended():
+                remove_created_user(client, username)
             return Response({'error': 'Failed to get user ID from Keycloak'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        keycloak_users = user_id_response.json()
-        if not keycloak_users:
-            logger.error("User not found in Keycloak after creation")
-            return Response({'error': 'User not found in Keycloak after creation'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-        keycloak_id = keycloak_users[0]['id']
-
-        # Create user in Django with the Keycloak ID
-        user = User.objects.create_user(
-            username=username,
-            email=email,
-            password=password
-        )
-        
-        # Update the user's profile with the Keycloak ID
-        user.userprofile.keycloak_id = keycloak_id
-        user.userprofile.save()
+        try:
+            create_local_user(username, email, password, keycloak_id)
+        except Exception as e:
+            # Don't leave an account in Keycloak that Django doesn't know about
+            logger.error("Failed to create user %s in Django, removing it from Keycloak: %s", username, e)
+            with deadline.suspended():
+                delete_created_user(client, keycloak_id)
+            raise
 
-        logger.info(f"User {username} created successfully with Keycloak ID: {keycloak_id}")
+        logger.info("User %s created successfully with Keycloak ID: %s", username, keycloak_id)
         return Response({'message': 'User registered successfully'}, status=status.HTTP_201_CREATED)
-        
+
+    except AdminTokenError:
+        logger.error("Failed to authenticate with Keycloak admin")
+        return Response({'error': 'Failed to authenticate with Keycloak admin'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except KeycloakUnavailable as e:
+        return keycloak_unavailable(e)
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return Response({'error': f'Registration error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+def keycloak_unavailable(exc):
+    # Fail fast while the Keycloak circuit is open instead of tying up the worker
+    logger.warning("Keycloak %s unavailable, retry after %ss", exc.operation, exc.wait)
+    return Response({'error': str(exc.detail)}, status=exc.status_code, headers={'Retry-After': str(exc.wait)})
+
+def keycloak_user_representation(username, email, password):
+    return {
+        'username': username,
+        'email': email,
+        'enabled': True,
+        'emailVerified': True,
+        'credentials': [
+            {
+                'type': 'password',
+                'value': password,
+                'temporary': False
+            }
+        ]
+    }
+
+def created_user_id(response):
+    # Keycloak returns the new user's URL, ending with its ID
+    return response.headers.get('Location', '').rstrip('/').rsplit('/', 1)[-1]
+
+def delete_created_user(client, keycloak_id):
+    delete_response = call_with_admin_token(client.delete_user, keycloak_id)
+    if delete_response.status_code not in (204, 404):
+        logger.error("Failed to remove Keycloak user %s: %s", keycloak_id, delete_response.status_code)
+
+def remove_created_user(client, username):
+    """
+    Delete a user just created in Keycloak whose ID we didn't get, found by
+    its exact username
+    """
+    response = call_with_admin_token(client.find_users, username=username, exact='true')
+    if response.status_code != 200:
+        logger.error("Failed to look up Keycloak user %s for removal: %s", username, response.status_code)
+        return
+    # Keycloak stores usernames in lower case
+    for user in response.json():
+        if user.get('username', '').lower() == username.lower():
+            delete_created_user(client, user['id'])
+
+def create_local_user(username, email, password, keycloak_id):
+    """
+    Create the Django user for a new Keycloak account, the profile is inserted
+    together with it by the post_save signal
+    """
+    with transaction.atomic():
+        user = User(username=username, email=User.objects.normalize_email(email))
+        if settings.KEYCLOAK_MANAGED_PASSWORDS:
+            user.set_unusable_password()
+        else:
+            user.set_password(password)
+        user.keycloak_id = keycloak_id
+        user.save()
+    return user
+
 @swagger_auto_schema(
     method='post',
     responses={200: 'Successfully logged out'},
@@ -221,13 +245,14 @@ def logout_view(request):
 )
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([ForgotPasswordRateThrottle])
 def forgot_password(request):
     email = request.data.get('email')
     if not email:
         return Response({'error': 'Email is required'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        user = User.objects.get(email=email)
+        user = User.objects.filter(email_is(email)).earliest('pk')
         # Generate a random token
         token = ''.join(random.choices(string.ascii_letters + string.digits, k=32))
         # Store token in session or cache
@@ -273,7 +298,7 @@ def reset_password(request):
         return Response({'error': 'Invalid or expired token'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        user = User.objects.get(email=email)
+        user = User.objects.filter(email_is(email)).earliest('pk')
         user.set_password(new_password)
         user.save()
         # Remove the token from session
@@ -312,10 +337,11 @@ def reset_password(request):
 )
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([LoginRateThrottle])
 def login(request):
     username = request.data.get('username')
     password = request.data.get('password')
-    logger.debug(f"Login attempt for user: {username}")
+    logger.debug("Login attempt for user: %s", username)
 
     if not all([username, password]):
         logger.error("Login failed: Missing fields")
@@ -323,22 +349,10 @@ def login(request):
 
     # Get token from Keycloak
     try:
-        response = requests.post(
-            settings.OIDC_OP_TOKEN_ENDPOINT,
-            data={
-                'grant_type': 'password',
-                'client_id': settings.OIDC_RP_CLIENT_ID,
-                'client_secret': settings.OIDC_RP_CLIENT_SECRET,
-                'username': username,
-                'password': password,
-            },
-            headers={
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-        )
+        response = get_client().token(password_grant(username, password))
         
         if response.status_code != 200:
-            logger.error(f"Login failed: {response.status_code} - {response.text}")
+            logger.error("Login failed: %s - %.200s", response.status_code, response.text)
             if response.status_code == 401:
                 return Response({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
             else:
@@ -346,15 +360,28 @@ def login(request):
             return Response({'error': 'Authentication failed'}, status=status.HTTP_401_UNAUTHORIZED)
         
         token_data = response.json()
-        logger.info(f"User {username} logged in successfully")
+        logger.info("User %s logged in successfully", username)
         return Response({
             'token': token_data['access_token'],
             'refresh_token': token_data.get('refresh_token'),
         })
+    except KeycloakUnavailable as e:
+        return keycloak_unavailable(e)
+    except DeadlineExceeded:
+        raise
     except Exception as e:
-        logger.error(f"Login error: {str(e)}")
+        logger.error("Login error: %s", e)
         return Response({'error': f'Authentication error: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+def password_grant(username, password):
+    return {
+        'grant_type': 'password',
+        'client_id': settings.OIDC_RP_CLIENT_ID,
+        'client_secret': settings.OIDC_RP_CLIENT_SECRET,
+        'username': username,
+        'password': password,
+    }
+
 @swagger_auto_schema(
     method='get',
     responses={200: 'Keycloak configuration status'},
@@ -377,35 +404,22 @@ def login(request):
 def keycloak_check(request):
     """Check Keycloak configuration"""
     try:
+        client = get_client()
+
         # Test connection to Keycloak server
-        server_response = requests.get(
-            f"{settings.KEYCLOAK_URL}/realms/{settings.KEYCLOAK_REALM}/.well-known/openid-configuration"
-        )
+        server_response = client.discovery()
         
         # Test admin authentication
-        admin_token_response = requests.post(
-            f"{settings.KEYCLOAK_URL}/realms/master/protocol/openid-connect/token",
-            data={
-                'grant_type': 'password',
-                'client_id': 'admin-cli',
-                'username': 'admin',
-                'password': 'admin',
-            },
-            headers={
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-        )
+        try:
+            get_admin_token()
+            admin_status = 200
+        except AdminTokenError as e:
+            admin_status = e.status_code
         
         # Try to get client info
         client_info = None
-        if admin_token_response.status_code == 200:
-            admin_token = admin_token_response.json()['access_token']
-            client_response = requests.get(
-                f"{settings.KEYCLOAK_URL}/admin/realms/{settings.KEYCLOAK_REALM}/clients",
-                headers={
-                    'Authorization': f'Bearer {admin_token}'
-                }
-            )
+        if admin_status == 200:
+            client_response = call_with_admin_token(client.get_clients)
             client_info = client_response.json() if client_response.status_code == 200 else None
         
         return Response({
@@ -414,8 +428,8 @@ def keycloak_check(request):
                 'message': 'Connected' if server_response.status_code == 200 else 'Failed'
             },
             'admin_auth': {
-                'status': admin_token_response.status_code,
-                'message': 'Authenticated' if admin_token_response.status_code == 200 else 'Failed'
+                'status': admin_status,
+                'message': 'Authenticated' if admin_status == 200 else 'Failed'
             },
             'client_info': {
                 'status': 'Available' if client_info else 'Not available',
@@ -425,8 +439,17 @@ def keycloak_check(request):
                 'keycloak_url': settings.KEYCLOAK_URL,
                 'realm': settings.KEYCLOAK_REALM,
                 'client_id': settings.OIDC_RP_CLIENT_ID,
-            }
+            },
+            'token_cache': token_cache.stats(),
+            'circuit_breakers': breaker_states(),
+            'concurrency_limits': limiter_stats(),
         })
+    except KeycloakUnavailable as e:
+        response = keycloak_unavailable(e)
+        response.data['circuit_breakers'] = breaker_states()
+        return response
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -0,0 +1,83 @@
+import tracemalloc
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+
+from api import jwks
+from api.authentication import token_cache
+from api.tests.tokens import JWKS
+from users.cache import user_cache
+
+# Rounds the allocation measurement is averaged over, kept apart from the
+# timed rounds since tracing slows every allocation down
+ALLOCATION_ROUNDS = 50
+
+
+class StubKeycloak:
+    """
+    In-process stand-in for the Keycloak client: serves the test realm's JWKS
+    and userinfo without any network round trip
+    """
+
+    def __init__(self, user_info=None):
+        self.user_info = user_info or {}
+
+    def jwks(self):
+        return self.response(200, JWKS)
+
+    def userinfo(self, access_token):
+        return self.response(200, self.user_info)
+
+    @staticmethod
+    def response(status_code, json):
+        response = mock.Mock(status_code=status_code)
+        response.json.return_value = json
+        return response
+
+
+@pytest.fixture
+def keycloak():
+    stub = StubKeycloak()
+    with mock.patch('api.jwks.get_client', return_value=stub), \
+            mock.patch('api.authentication.get_client', return_value=stub):
+        jwks._reset_after_fork()
+        yield stub
+    jwks._reset_after_fork()
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    cache.clear()
+    token_cache.clear_local()
+    user_cache.clear_local()
+
+
+@pytest.fixture
+def record_allocations(benchmark):
+    """
+    Store the peak and retained bytes allocated by one call of ``func`` in
+    the benchmark's extra_info, so they end up in the JSON report next to
+    the timings
+    """
+    def record(func, setup=None):
+        measure_allocations(benchmark, func, setup)
+    return record
+
+
+def measure_allocations(benchmark, func, setup):
+    peak = retained = 0
+    tracemalloc.start()
+    try:
+        for _ in range(ALLOCATION_ROUNDS):
+            args = setup()[0] if setup else ()
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func(*args)
+            current, round_peak = tracemalloc.get_traced_memory()
+            peak += round_peak - before
+            retained += current - before
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info['alloc_peak_bytes'] = peak // ALLOCATION_ROUNDS
+    benchmark.extra_info['alloc_retained_bytes'] = retained // ALLOCATION_ROUNDS
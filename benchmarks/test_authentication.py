@@ -0,0 +1,69 @@
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.core.cache import cache
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIRequestFactory
+
+from api.authentication import KeycloakAuthentication, token_cache
+from api.tests.tokens import make_token
+from users.cache import user_cache
+from users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+factory = APIRequestFactory()
+
+
+def bearer_request(token):
+    return factory.get('/users/api/profile/', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+
+@pytest.fixture
+def profile():
+    profile = UserFactory(username='kcuser').userprofile
+    profile.keycloak_id = 'kc-bench'
+    profile.save()
+    return profile
+
+
+def test_authenticate_cold(benchmark, record_allocations, keycloak, profile):
+    """A token seen for the first time: signature check and user lookup in the database"""
+    auth = KeycloakAuthentication()
+
+    def setup():
+        cache.clear()
+        token_cache.clear_local()
+        user_cache.clear_local()
+        return (bearer_request(make_token(sub='kc-bench')),), {}
+
+    benchmark.pedantic(auth.authenticate, setup=setup, rounds=200)
+    record_allocations(auth.authenticate, setup)
+
+
+def test_authenticate_warm(benchmark, record_allocations, keycloak, profile):
+    """A token and user already in the in-process caches"""
+    auth = KeycloakAuthentication()
+    request = bearer_request(make_token(sub='kc-bench'))
+    auth.authenticate(request)
+
+    user, _ = benchmark(auth.authenticate, request)
+    assert user.pk == profile.user.pk
+    record_allocations(auth.authenticate, lambda: ((request,), {}))
+
+
+def test_authenticate_invalid_token(benchmark, record_allocations, keycloak):
+    """A token signed with a key the realm doesn't publish"""
+    auth = KeycloakAuthentication()
+    other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    request = bearer_request(make_token(key=other_key))
+
+    def authenticate():
+        try:
+            auth.authenticate(request)
+        except AuthenticationFailed:
+            pass
+        else:
+            raise AssertionError('Token was accepted')
+
+    benchmark(authenticate)
+    record_allocations(authenticate)
@@ -0,0 +1,112 @@
+import datetime
+import os
+
+import pytest
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from users.models import UserProfile, email_is, get_user_by_subject
+from users.pagination import KeysetPagination
+
+pytestmark = pytest.mark.django_db
+
+# Users in the table during the lookups, e.g. BENCHMARK_LOOKUP_USERS=1000,1000000,3000000
+# for the full curve. Each size is inserted once for all the benchmarks of this module
+POPULATIONS = [int(size) for size in os.environ.get('BENCHMARK_LOOKUP_USERS', '1000,100000').split(',')]
+
+INSERT_BATCH = 10000
+
+
+def insert_users(count):
+    # One signup a second up to now, stored as the ORM would store them since
+    # the directory compares created_at with its cursors
+    joined = timezone.now() - datetime.timedelta(seconds=count)
+    # One hash for all, hashing millions of passwords would take hours
+    password = make_password(None)
+    with connection.cursor() as cursor:
+        for start in range(0, count, INSERT_BATCH):
+            cursor.executemany(
+                'INSERT INTO auth_user (password, is_superuser, username, first_name, last_name, email, '
+                'is_staff, is_active, date_joined) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
+                [
+                    (password, False, f'bench-{i}', '', '', f'Bench.User{i}@Example.com', False, True,
+                     connection.ops.adapt_datetimefield_value(joined + datetime.timedelta(seconds=i)))
+                    for i in range(start, min(start + INSERT_BATCH, count))
+                ],
+            )
+        # Signals don't run for raw inserts, add the profiles in one statement
+        cursor.execute(
+            "INSERT INTO users_userprofile (user_id, keycloak_id, mfa_enabled, created_at, updated_at) "
+            "SELECT id, 'kc-' || username, %s, date_joined, date_joined FROM auth_user WHERE username LIKE 'bench-%%'",
+            [False],
+        )
+
+
+def delete_users():
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM users_userprofile WHERE keycloak_id LIKE 'kc-bench-%%'")
+        cursor.execute("DELETE FROM auth_user WHERE username LIKE 'bench-%%'")
+
+
+@pytest.fixture(scope='module', params=POPULATIONS, ids=lambda size: f'{size}-users')
+def population(request, django_db_setup, django_db_blocker):
+    with django_db_blocker.unblock():
+        insert_users(request.param)
+        try:
+            yield request.param
+        finally:
+            delete_users()
+
+
+@pytest.mark.benchmark(group='user-by-subject')
+def test_user_by_subject(benchmark, population):
+    """Authentication cache miss: user and profile by the token's sub"""
+    subject = f'kc-bench-{population // 2}'
+
+    user = benchmark(get_user_by_subject, subject)
+    assert user.userprofile.keycloak_id == subject
+    benchmark.extra_info['users'] = population
+
+
+@pytest.mark.benchmark(group='user-by-email')
+def test_user_by_email(benchmark, population):
+    """Password reset: user by email in any letter case"""
+    email = f'bench.user{population // 2}@example.com'
+
+    user = benchmark(lambda: User.objects.filter(email_is(email)).earliest('pk'))
+    assert user.username == f'bench-{population // 2}'
+    benchmark.extra_info['users'] = population
+
+
+@pytest.mark.benchmark(group='registration-check')
+def test_registration_check(benchmark, population):
+    """Registration: is the username or email taken"""
+    def taken():
+        return list(User.objects.filter(Q(username='newcomer') | Q(email_is('NEWCOMER@example.com')))
+                    .values_list('username', flat=True)[:2])
+
+    assert benchmark(taken) == []
+    benchmark.extra_info['users'] = population
+
+
+@pytest.mark.benchmark(group='directory-page')
+@pytest.mark.parametrize('depth', ['first', 'deep'])
+def test_directory_page(benchmark, population, depth):
+    """User directory: the first page and one past 90% of the users"""
+    params = {'limit': 50}
+    if depth == 'deep':
+        # The oldest users come last, bench-0 is on the last page
+        profile = UserProfile.objects.get(keycloak_id=f'kc-bench-{population // 10}')
+        params['cursor'] = KeysetPagination().encode_cursor((profile.created_at, profile.pk))
+    request = Request(APIRequestFactory().get('/api/users/', params))
+
+    def page():
+        return KeysetPagination().paginate_queryset(UserProfile.objects.select_related('user'), request)
+
+    assert len(benchmark(page)) == 50
+    benchmark.extra_info['users'] = population
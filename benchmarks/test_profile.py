@@ -0,0 +1,49 @@
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from users import views
+from users.tests.factories import UserFactory
+
+pytestmark = pytest.mark.django_db
+
+factory = APIRequestFactory()
+
+
+@pytest.fixture
+def user():
+    return UserFactory()
+
+
+def authenticated(request, user):
+    force_authenticate(request, user=user)
+    return request
+
+
+def test_get_user_profile(benchmark, record_allocations, user):
+    """Profile read with the profile already loaded, as the authentication leaves it"""
+    request = authenticated(factory.get('/users/api/profile/'), user)
+
+    response = benchmark(views.get_user_profile, request)
+    assert response.status_code == 200
+    record_allocations(views.get_user_profile, lambda: ((request,), {}))
+
+
+def test_toggle_mfa(benchmark, record_allocations, user):
+    """MFA toggle, one profile update per call"""
+    request = authenticated(factory.post('/users/api/toggle-mfa/'), user)
+
+    response = benchmark(views.toggle_mfa, request)
+    assert response.status_code == 200
+    record_allocations(views.toggle_mfa, lambda: ((request,), {}))
+
+
+def test_update_phone(benchmark, record_allocations, user):
+    """Phone number update including parsing the JSON body"""
+    def setup():
+        # The request body can only be parsed once
+        request = factory.post('/users/api/update-phone/', {'phone_number': '+15550001111'}, format='json')
+        return (authenticated(request, user),), {}
+
+    response = benchmark.pedantic(views.update_phone, setup=setup, rounds=500)
+    assert response.status_code == 200
+    record_allocations(views.update_phone, setup)
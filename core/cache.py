@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+
+from core.metrics import CACHE_LOOKUPS
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+
+class TwoTierCache:
+    """
+    In-process LRU in front of a shared Django cache (Redis in production).
+
+    Entries carry their own expiry so a value promoted from the shared tier
+    never outlives the timeout it was stored with. Shared tier errors are
+    logged and treated as misses, the caller then falls back to the source.
+    """
+
+    def __init__(self, prefix, max_entries=10000, local_ttl=None, alias='default'):
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+        self.alias = alias
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        # Bound once, lookups are on the request path
+        self._local_hit_metric = CACHE_LOOKUPS.labels(prefix, 'local_hit')
+        self._shared_hit_metric = CACHE_LOOKUPS.labels(prefix, 'shared_hit')
+        self._miss_metric = CACHE_LOOKUPS.labels(prefix, 'miss')
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def make_key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def get(self, key):
+        now = time.time()
+        value = self._get_local(key, now)
+        if value is not None:
+            return value
+        try:
+            entry = self.shared.get(self.make_key(key))
+        except Exception as e:
+            logger.warning("Shared cache unavailable for %s: %s", self.prefix, e)
+            entry = None
+        return self._promote(key, entry, now)
+
+    async def aget(self, key):
+        """
+        get() for async code, local hits don't leave the event loop
+        """
+        now = time.time()
+        value = self._get_local(key, now)
+        if value is not None:
+            return value
+        try:
+            # Django's own aget() runs on the single thread-sensitive executor
+            entry = await sync_to_async(self.shared.get, thread_sensitive=False)(self.make_key(key))
+        except Exception as e:
+            logger.warning("Shared cache unavailable for %s: %s", self.prefix, e)
+            entry = None
+        return self._promote(key, entry, now)
+
+    def set(self, key, value, timeout):
+        now = time.time()
+        expires_at = now + timeout
+        self._set_local(key, value, expires_at, now)
+        try:
+            self.shared.set(self.make_key(key), (expires_at, value), max(int(timeout), 1))
+        except Exception as e:
+            logger.warning("Shared cache unavailable for %s: %s", self.prefix, e)
+
+    async def aset(self, key, value, timeout):
+        now = time.time()
+        expires_at = now + timeout
+        self._set_local(key, value, expires_at, now)
+        try:
+            await sync_to_async(self.shared.set, thread_sensitive=False)(
+                self.make_key(key), (expires_at, value), max(int(timeout), 1))
+        except Exception as e:
+            logger.warning("Shared cache unavailable for %s: %s", self.prefix, e)
+
+    def add(self, key, value, timeout):
+        """
+        set() unless the shared tier already has the key, so a value read
+        from the source can't overwrite one written since
+        """
+        now = time.time()
+        expires_at = now + timeout
+        try:
+            added = self.shared.add(self.make_key(key), (expires_at, value), max(int(timeout), 1))
+        except Exception as e:
+            logger.warning("Shared cache unavailable for %s: %s", self.prefix, e)
+            added = True
+        if added:
+            self._set_local(key, value, expires_at, now)
+        return added
+
+    async def aadd(self, key, value, timeout):
+        now = time.time()
+        expires_at = now + timeout
+        try:
+            added = await sync_to_async(self.shared.add, thread_sensitive=False)(
+                self.make_key(key), (expires_at, value), max(int(timeout), 1))
+        except Exception as e:
+            logger.warning("Shared cache unavailable for %s: %s", self.prefix, e)
+            added = True
+        if added:
+            self._set_local(key, value, expires_at, now)
+        return added
+
+    def delete(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+        try:
+            self.shared.delete(self.make_key(key))
+        except Exception as e:
+            logger.warning("Shared cache unavailable for %s: %s", self.prefix, e)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+        try:
+            self.shared.delete_many([self.make_key(key) for key in keys])
+        except Exception as e:
+            logger.warning("Shared cache unavailable for %s: %s", self.prefix, e)
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+    def reset_stats(self):
+        with self._lock:
+            self.local_hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.local_hits + self.shared_hits + self.misses
+            return {
+                'size': len(self._local),
+                'max_entries': self.max_entries,
+                'local_hits': self.local_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.local_hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+
+    def _get_local(self, key, now):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._local.move_to_end(key)
+                    self.local_hits += 1
+                    self._local_hit_metric.inc()
+                    return entry[1]
+                del self._local[key]
+        return None
+
+    def _promote(self, key, entry, now):
+        # Copy a shared tier entry into the local tier, None on a miss
+        if entry is None or entry[0] <= now:
+            with self._lock:
+                self.misses += 1
+            self._miss_metric.inc()
+            return None
+        self._set_local(key, entry[1], entry[0], now)
+        with self._lock:
+            self.shared_hits += 1
+        self._shared_hit_metric.inc()
+        return entry[1]
+
+    def _set_local(self, key, value, expires_at, now):
+        if self.local_ttl is not None:
+            expires_at = min(expires_at, now + self.local_ttl)
+        with self._lock:
+            self._local[key] = (expires_at, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
@@ -0,0 +1,236 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.backends.signals import connection_created
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+# Monotonic time at which the current request's budget runs out
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(APIException):
+    status_code = status.HTTP_504_GATEWAY_TIMEOUT
+    default_detail = 'The request took too long and was abandoned'
+    default_code = 'deadline_exceeded'
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Run the block with a time budget of ``seconds``, never extending an
+    enclosing one
+    """
+    expires_at = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        expires_at = min(expires_at, current)
+    token = _deadline.set(expires_at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextlib.contextmanager
+def suspended():
+    """
+    Run the block without a deadline, for cleanup that must finish anyway
+    """
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """
+    Seconds left in the current request's budget, None outside a request
+    """
+    expires_at = _deadline.get()
+    if expires_at is None:
+        return None
+    return expires_at - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check():
+    if expired():
+        raise DeadlineExceeded()
+
+
+def limit_timeout(timeout):
+    """
+    Cap a timeout (seconds, or a (connect, read) tuple) at the remaining budget
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded()
+    if isinstance(timeout, tuple):
+        return tuple(min(part, left) for part in timeout)
+    return min(timeout, left)
+
+
+def request_budget(request):
+    """
+    The edge proxy's X-Request-Timeout-Ms if set (capped at REQUEST_DEADLINE_MAX),
+    otherwise the budget configured for the URL name
+    """
+    header = request.headers.get('X-Request-Timeout-Ms')
+    if header:
+        try:
+            return min(int(header) / 1000, settings.REQUEST_DEADLINE_MAX)
+        except ValueError:
+            logger.warning("Ignoring malformed X-Request-Timeout-Ms: %s", header)
+    return settings.REQUEST_DEADLINES.get(url_name(request), settings.REQUEST_DEADLINE_DEFAULT)
+
+
+def url_name(request):
+    """
+    Name of the URL pattern the request resolves to, for middleware running
+    before Django's own URL resolution
+    """
+    if not hasattr(request, '_url_name'):
+        try:
+            request._url_name = resolve(request.path_info).url_name
+        except Resolver404:
+            request._url_name = None
+    return request._url_name
+
+
+def deadline_exceeded_response():
+    return JsonResponse({'detail': DeadlineExceeded.default_detail}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+
+
+class DeadlineMiddleware:
+    """
+    Give every request a time budget that Keycloak calls and database queries
+    respect, and answer 504 once it is spent.
+
+    Under ASGI the view is also cancelled when the budget runs out, sync
+    views stop at their next Keycloak call or query.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with deadline(request_budget(request)):
+            try:
+                return self.get_response(request)
+            except DeadlineExceeded:
+                return deadline_exceeded_response()
+
+    async def __acall__(self, request):
+        budget = request_budget(request)
+        with deadline(budget):
+            try:
+                async with asyncio.timeout(max(budget, 0)):
+                    return await self.get_response(request)
+            except (DeadlineExceeded, TimeoutError):
+                logger.warning("Request to %s cancelled after its %ss budget", request.path, budget)
+                return deadline_exceeded_response()
+
+
+# How much longer than the time left the session's statement_timeout may be
+# before it is lowered again (seconds). Without it every query of a request
+# would send its own SET as the time left shrinks
+STATEMENT_TIMEOUT_SLACK = 1
+
+
+def execute_with_deadline(execute, sql, params, many, context):
+    """
+    Database execute wrapper: refuse queries once the budget is spent and, on
+    PostgreSQL, keep statement_timeout within the time that's left
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded()
+
+    connection = context['connection']
+    if connection.vendor == 'postgresql':
+        set_statement_timeout(connection, context['cursor'].cursor, left)
+    if left is None:
+        return execute(sql, params, many, context)
+    try:
+        return execute(sql, params, many, context)
+    except DatabaseError as e:
+        if expired():
+            raise DeadlineExceeded() from e
+        raise
+
+
+def set_statement_timeout(connection, raw_cursor, left):
+    """
+    Send SET statement_timeout only when the one the session has is too long
+    for the ``left`` seconds of the request (by more than the slack), or
+    shorter than needed: lowered by an earlier request, or outside a request
+    where DATABASE_STATEMENT_TIMEOUT applies
+    """
+    if connection.statement_timeout_unconfirmed and not connection.in_atomic_block:
+        # Set in a transaction that was rolled back, along with the SET
+        connection.statement_timeout_ms = None
+        connection.statement_timeout_unconfirmed = False
+
+    default_ms = int(settings.DATABASE_STATEMENT_TIMEOUT * 1000)
+    current_ms = connection.statement_timeout_ms
+    if left is None:
+        wanted_ms = default_ms
+        slack_ms = 0
+    else:
+        wanted_ms = max(int(left * 1000), 1)
+        if default_ms:
+            wanted_ms = min(wanted_ms, default_ms)
+        slack_ms = STATEMENT_TIMEOUT_SLACK * 1000
+    if current_ms == wanted_ms:
+        return
+    # 0 turns the timeout off, it is only close to itself
+    if current_ms and wanted_ms and abs(current_ms - wanted_ms) <= slack_ms:
+        return
+
+    raw_cursor.execute('SET statement_timeout = %s', [wanted_ms])
+    connection.statement_timeout_ms = wanted_ms
+    if connection.in_atomic_block:
+        connection.statement_timeout_unconfirmed = True
+        transaction.on_commit(lambda: confirm_statement_timeout(connection, wanted_ms), using=connection.alias)
+
+
+def confirm_statement_timeout(connection, value):
+    if connection.statement_timeout_ms == value:
+        connection.statement_timeout_unconfirmed = False
+
+
+def install_execute_wrapper(sender, connection, **kwargs):
+    if execute_with_deadline not in connection.execute_wrappers:
+        connection.execute_wrappers.append(execute_with_deadline)
+    # New connections start with the statement_timeout of the connection options
+    connection.statement_timeout_ms = int(settings.DATABASE_STATEMENT_TIMEOUT * 1000)
+    connection.statement_timeout_unconfirmed = False
+
+
+connection_created.connect(install_execute_wrapper)
@@ -0,0 +1,259 @@
+import asyncio
+import collections
+import logging
+import math
+import os
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework import status
+
+from core.deadline import remaining, url_name
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+
+class _Waiter:
+    """
+    A request queued for a slot, woken either as a thread or as a coroutine
+    """
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit for a group of routes, adjusted from observed latency.
+
+    AIMD: each request that completes within ``latency_target`` while the
+    limit is in use raises the limit by one; a slower or failed (503/504)
+    request multiplies it by ``backoff_ratio``, at most once per
+    ``latency_target`` so a burst of requests slowed down together backs off
+    once rather than once per request. Requests over the limit wait
+    in a FIFO queue of at most ``max_queue`` entries for up to
+    ``queue_timeout`` seconds (or what is left of their deadline) and are
+    rejected after that.
+    """
+
+    def __init__(self, name, initial_limit=20, min_limit=1, max_limit=200, latency_target=0.5,
+                 backoff_ratio=0.9, max_queue=50, queue_timeout=1.0):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.rejected = 0
+        self._last_decrease = -math.inf
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """
+        Take a slot, waiting up to ``timeout`` seconds; False when rejected
+        """
+        with self._lock:
+            if self._try_acquire():
+                return True
+            waiter = self._enqueue(None)
+            if waiter is None:
+                return False
+        waiter.event.wait(timeout)
+        return self._settle(waiter)
+
+    async def aacquire(self, timeout):
+        with self._lock:
+            if self._try_acquire():
+                return True
+            waiter = self._enqueue(asyncio.get_running_loop())
+            if waiter is None:
+                return False
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if self._settle(waiter):
+                self.release(0, overloaded=False, sample=False)
+            raise
+        return self._settle(waiter)
+
+    def release(self, latency, overloaded=False, sample=True):
+        with self._lock:
+            if sample:
+                self._adjust(latency, overloaded)
+            self.inflight -= 1
+            self._grant()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': int(self.limit),
+                'inflight': self.inflight,
+                'queued': len(self._waiters),
+                'rejected': self.rejected,
+            }
+
+    def _try_acquire(self):
+        # Must be called with self._lock held; queued requests go first
+        if not self._waiters and self.inflight < int(self.limit):
+            self.inflight += 1
+            return True
+        return False
+
+    def _enqueue(self, loop):
+        # Must be called with self._lock held, None when the queue is full
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            return None
+        waiter = _Waiter(loop)
+        self._waiters.append(waiter)
+        return waiter
+
+    def _settle(self, waiter):
+        # A slot may be granted between the timeout and taking the lock
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            return False
+
+    def _grant(self):
+        # Must be called with self._lock held
+        while self._waiters and self.inflight < int(self.limit):
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+            self.inflight += 1
+            waiter.wake()
+
+    def _adjust(self, latency, overloaded):
+        # Must be called with self._lock held
+        if overloaded or latency > self.latency_target:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.latency_target:
+                self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                self._last_decrease = now
+        elif self.inflight * 2 >= self.limit:
+            # Only grow a limit that is actually being used
+            self.limit = min(self.max_limit, self.limit + 1)
+
+
+# One limiter per route group, shared by every thread of the process
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(group):
+    limiter = _limiters.get(group)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(group)
+            if limiter is None:
+                limiter = _limiters[group] = AdaptiveLimiter(group, **settings.CONCURRENCY_LIMITS[group])
+    return limiter
+
+
+def limiter_stats():
+    return {group: limiter.stats() for group, limiter in sorted(_limiters.items())}
+
+
+def _reset_after_fork():
+    global _limiters, _limiters_lock
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class ConcurrencyLimitMiddleware:
+    """
+    Shed load per route group (CONCURRENCY_ROUTE_GROUPS) so a login storm
+    waiting on Keycloak doesn't slow down endpoints served locally.
+
+    Requests that get no slot in time are answered with 503 and Retry-After.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        limiter = self.limiter_for(request)
+        if limiter is None:
+            return self.get_response(request)
+        if not limiter.acquire(self.queue_timeout(limiter)):
+            return self.rejected(request, limiter)
+        started = time.monotonic()
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            limiter.release(time.monotonic() - started, self.overloaded(response))
+
+    async def __acall__(self, request):
+        limiter = self.limiter_for(request)
+        if limiter is None:
+            return await self.get_response(request)
+        if not await limiter.aacquire(self.queue_timeout(limiter)):
+            return self.rejected(request, limiter)
+        started = time.monotonic()
+        response = None
+        try:
+            response = await self.get_response(request)
+            return response
+        finally:
+            limiter.release(time.monotonic() - started, self.overloaded(response))
+
+    def limiter_for(self, request):
+        group = settings.CONCURRENCY_ROUTE_GROUPS.get(url_name(request))
+        return get_limiter(group) if group else None
+
+    def queue_timeout(self, limiter):
+        # Don't queue past the request's own deadline
+        left = remaining()
+        return limiter.queue_timeout if left is None else max(min(limiter.queue_timeout, left), 0)
+
+    def overloaded(self, response):
+        # Errors and timeouts waiting on Keycloak count as congestion
+        return response is None or response.status_code in (503, 504)
+
+    def rejected(self, request, limiter):
+        logger.warning("Shedding %s: %s concurrency limit %d reached", request.path, limiter.name, limiter.limit)
+        return JsonResponse(
+            {'detail': 'Server is busy, try again later'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={'Retry-After': str(math.ceil(settings.CONCURRENCY_RETRY_AFTER))},
+        )
@@ -0,0 +1,194 @@
+import copy
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import weakref
+
+# Attributes every LogRecord has, anything else was passed with extra=
+RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+REDACTED = '[REDACTED]'
+
+REDACTIONS = [
+    # Authorization header values
+    (re.compile(r'\b(Bearer|Basic)\s+[A-Za-z0-9\-._~+/]+=*', re.IGNORECASE), rf'\1 {REDACTED}'),
+    # JWTs (access, refresh and ID tokens) wherever they appear
+    (re.compile(r'\beyJ[A-Za-z0-9_-]*\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*'), REDACTED),
+    # password=..., "client_secret": "...", access_token=... in bodies and query strings
+    (re.compile(r'''(["']?\b\w*(?:password|passwd|secret|token|authorization)["']?\s*[:=]\s*["']?)'''
+                r'''(?!(?:Bearer|Basic)\s|\[REDACTED\])[^"'&,;\s}]+''', re.IGNORECASE), rf'\1{REDACTED}'),
+]
+
+
+def redact(text):
+    """
+    Mask tokens, passwords and client secrets in ``text``
+    """
+    for pattern, replacement in REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line with the record's extra= attributes as fields
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Let through at most ``burst`` records per ``period`` seconds from each
+    logging call site at ``level`` or below, warnings and errors always pass.
+
+    The number of records dropped in a period is reported as ``suppressed``
+    on the first record of the call site in the next one.
+    """
+
+    def __init__(self, burst=50, period=10, level=logging.INFO, max_sites=1000):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.level = level
+        self.max_sites = max_sites
+        # (pathname, lineno, levelno) -> [period start, records let through, records dropped]
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.burst <= 0 or record.levelno > self.level:
+            return True
+        site = (record.pathname, record.lineno, record.levelno)
+        now = time.monotonic()
+        with self.lock:
+            window = self.sites.get(site)
+            if window is None or now - window[0] >= self.period:
+                if window is None and len(self.sites) >= self.max_sites:
+                    self.sites.clear()
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                window = self.sites[site] = [now, 0, 0]
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+# Live handlers, restarted in forked workers
+_handlers = weakref.WeakSet()
+
+
+class BackgroundHandler(logging.Handler):
+    """
+    Hand records to a writer thread through a bounded queue so formatting,
+    redaction and the write itself stay off the request.
+
+    The calling thread only merges the message with its arguments. When the
+    queue is full records are dropped rather than blocking, and the number
+    dropped is reported as ``dropped`` on the next record that gets through.
+    """
+
+    def __init__(self, queue_size=10000, stream=None):
+        super().__init__()
+        self.target = logging.StreamHandler(stream)
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.start()
+        _handlers.add(self)
+
+    def start(self):
+        self.queue = queue.Queue(self.queue_size)
+        self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Arguments may be changed by the caller once it moves on
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            dropped = self.dropped
+            if dropped:
+                record.dropped = dropped
+            self.queue.put_nowait(record)
+            self.dropped -= dropped
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            try:
+                self.write(record)
+            except Exception:
+                self.handleError(record)
+
+    def write(self, record):
+        record.msg = record.message = redact(record.message)
+        if record.exc_info:
+            formatter = self.formatter or logging.Formatter()
+            record.exc_text = redact(formatter.formatException(record.exc_info))
+        for key, value in vars(record).items():
+            if key in RECORD_ATTRS or key.startswith('_') or value is None or isinstance(value, (bool, int, float)):
+                continue
+            setattr(record, key, redact(str(value)))
+        self.target.handle(record)
+
+    def close(self):
+        # Called by logging.shutdown() at exit, write out what is still queued
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                self.thread.join(timeout=5)
+            except queue.Full:
+                pass
+        self.target.close()
+        super().close()
+
+
+def _reset_after_fork():
+    # The writer thread doesn't survive the fork, and the queue may hold the
+    # parent's records or a lock it held
+    for handler in list(_handlers):
+        handler.dropped = 0
+        handler.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
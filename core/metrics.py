@@ -0,0 +1,97 @@
+import os
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+from core.deadline import url_name
+from core.query_budget import request_queries
+
+# Metrics are kept in mmap files under PROMETHEUS_MULTIPROC_DIR when it is set
+# (see gunicorn.conf.py), so /metrics reports every worker process and not just
+# the one that happened to serve the scrape
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    'Time spent handling a request, by URL name',
+    ['view', 'method', 'status'],
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries',
+    'Database queries run while handling a request, by URL name',
+    ['view'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+KEYCLOAK_LATENCY = Histogram(
+    'keycloak_request_duration_seconds',
+    'Time spent on a Keycloak call including retries, by operation and final status',
+    ['operation', 'status'],
+)
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total',
+    'Cache lookups by cache and result (local_hit, shared_hit or miss)',
+    ['cache', 'result'],
+)
+
+def observe_keycloak(operation, status, started):
+    KEYCLOAK_LATENCY.labels(operation, str(status)).observe(time.monotonic() - started)
+
+
+class MetricsMiddleware:
+    """
+    Record the latency and number of database queries of every request.
+
+    Views are labelled by URL name to keep the number of series bounded.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.monotonic()
+        # Counted by core.query_budget's execute wrapper, whose log the query
+        # budget middleware further down shares
+        with request_queries() as queries:
+            response = None
+            try:
+                response = self.get_response(request)
+                return response
+            finally:
+                self.observe(request, response, started, queries)
+
+    async def __acall__(self, request):
+        started = time.monotonic()
+        with request_queries() as queries:
+            response = None
+            try:
+                response = await self.get_response(request)
+                return response
+            finally:
+                self.observe(request, response, started, queries)
+
+    def observe(self, request, response, started, queries):
+        view = url_name(request) or 'unmatched'
+        status = response.status_code if response is not None else 500
+        REQUEST_LATENCY.labels(view, request.method, str(status)).observe(time.monotonic() - started)
+        REQUEST_QUERIES.labels(view).observe(queries.count)
+
+
+def metrics_view(request):
+    """
+    Prometheus exposition of the metrics of all worker processes
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,147 @@
+import hmac
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import admin
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
+from django.shortcuts import render
+
+from core.deadline import url_name
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+# Profiles are numbered from a shared counter, so listing them needs no index
+# that concurrent workers could overwrite
+COUNTER_KEY = 'profiles:last'
+
+
+def profile_key(profile_id):
+    return f'profiles:{profile_id}'
+
+
+def store_profile(request, response, session, started_at):
+    """
+    Save a profiling session with a summary of the request, returns its id
+    """
+    cache.add(COUNTER_KEY, 0, None)
+    profile_id = cache.incr(COUNTER_KEY)
+    cache.set(profile_key(profile_id), {
+        'id': profile_id,
+        'started_at': started_at,
+        'method': request.method,
+        'path': request.path,
+        'view': url_name(request),
+        'status': response.status_code if response is not None else None,
+        'duration': session.duration,
+        'session': session.to_json(),
+    }, settings.PROFILING_TTL)
+    return profile_id
+
+
+def recent_profiles():
+    """
+    Stored profiles, newest first, without their sessions
+    """
+    last = cache.get(COUNTER_KEY) or 0
+    ids = range(last, max(last - settings.PROFILING_MAX_LISTED, 0), -1)
+    stored = cache.get_many([profile_key(profile_id) for profile_id in ids])
+    return [
+        {name: value for name, value in stored[profile_key(profile_id)].items() if name != 'session'}
+        for profile_id in ids if profile_key(profile_id) in stored
+    ]
+
+
+class ProfilingMiddleware:
+    """
+    Profile a sample of requests (PROFILING_SAMPLE_RATE) and requests sending
+    the X-Profile-Token header with PROFILING_TOKEN, with pyinstrument's
+    sampling profiler. Profiles are stored in the cache for PROFILING_TTL
+    seconds and listed in the admin.
+
+    Requests that aren't profiled only pay for the trigger check.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.triggered(request):
+            return self.get_response(request)
+        profiler, started_at = self.start()
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            self.save(request, response, profiler.stop(), started_at)
+
+    async def __acall__(self, request):
+        if not self.triggered(request):
+            return await self.get_response(request)
+        profiler, started_at = self.start()
+        response = None
+        try:
+            response = await self.get_response(request)
+            return response
+        finally:
+            await sync_to_async(self.save, thread_sensitive=False)(request, response, profiler.stop(), started_at)
+
+    def triggered(self, request):
+        token = request.headers.get('X-Profile-Token')
+        if token and settings.PROFILING_TOKEN:
+            return hmac.compare_digest(token, settings.PROFILING_TOKEN)
+        return settings.PROFILING_SAMPLE_RATE > 0 and random.random() < settings.PROFILING_SAMPLE_RATE
+
+    def start(self):
+        from pyinstrument import Profiler
+        profiler = Profiler(interval=settings.PROFILING_INTERVAL, async_mode='enabled')
+        profiler.start()
+        return profiler, time.time()
+
+    def save(self, request, response, session, started_at):
+        try:
+            profile_id = store_profile(request, response, session, started_at)
+        except Exception as e:
+            logger.warning("Could not store profile of %s: %s", request.path, e)
+            return
+        logger.info("Stored profile %s of %s %s", profile_id, request.method, request.path)
+
+
+def profile_list(request):
+    return render(request, 'admin/profiles.html', {
+        **admin.site.each_context(request),
+        'title': 'Request profiles',
+        'profiles': recent_profiles(),
+    })
+
+
+def profile_download(request, profile_id, fmt):
+    from pyinstrument.renderers import PstatsRenderer, SpeedscopeRenderer
+    from pyinstrument.session import Session
+
+    stored = cache.get(profile_key(profile_id))
+    if stored is None:
+        raise Http404('Profile expired or not found')
+    session = Session.from_json(stored['session'])
+    if fmt == 'speedscope':
+        content = SpeedscopeRenderer().render(session)
+        content_type, extension = 'application/json', 'speedscope.json'
+    else:
+        # The renderer returns the marshalled bytes as a surrogate-escaped str
+        content = PstatsRenderer().render(session).encode('utf-8', errors='surrogateescape')
+        content_type, extension = 'application/octet-stream', 'prof'
+    response = HttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="profile-{profile_id}.{extension}"'
+    return response
@@ -0,0 +1,140 @@
+import collections
+import contextlib
+import contextvars
+import logging
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from core.deadline import url_name
+
+# Initialize logger
+logger = logging.getLogger(__name__)
+
+# Queries of the current request, None outside a request
+_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+SAVEPOINT_STATEMENTS = ('SAVEPOINT ', 'RELEASE SAVEPOINT ', 'ROLLBACK TO SAVEPOINT ')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryLog:
+    """
+    SQL run by one request; shared by reference with the sync_to_async
+    threads of the request, which get a copy of its context
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = collections.Counter()
+
+    def add(self, sql, many):
+        # Savepoints are transaction control, as are the BEGIN and COMMIT
+        # that Django doesn't send through execute()
+        if sql.startswith(SAVEPOINT_STATEMENTS):
+            return
+        self.count += 1
+        # executemany() runs one statement for all its rows
+        if not many:
+            self.statements[sql] += 1
+
+    def repeated(self, threshold):
+        """
+        Statements run at least ``threshold`` times with different parameters,
+        usually a query in a loop (N+1)
+        """
+        return [(sql, count) for sql, count in self.statements.most_common() if count >= threshold]
+
+
+@contextlib.contextmanager
+def request_queries():
+    """
+    Record the queries run in the block in a QueryLog, or in the one of the
+    enclosing block, so the metrics and the query budget of a request share
+    one log and one execute wrapper
+    """
+    queries = _queries.get()
+    if queries is not None:
+        yield queries
+        return
+    queries = QueryLog()
+    token = _queries.set(queries)
+    try:
+        yield queries
+    finally:
+        _queries.reset(token)
+
+
+def log_queries(execute, sql, params, many, context):
+    """
+    Database execute wrapper recording the queries of the current request
+    """
+    queries = _queries.get()
+    if queries is not None:
+        queries.add(sql, many)
+    return execute(sql, params, many, context)
+
+
+def install_execute_wrapper(sender, connection, **kwargs):
+    if log_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_queries)
+
+
+connection_created.connect(install_execute_wrapper)
+
+
+class QueryBudgetMiddleware:
+    """
+    Check each request against the query budget of its URL name (QUERY_BUDGETS)
+    and look for statements repeated QUERY_REPEAT_THRESHOLD times or more.
+
+    Violations are logged, or raised as QueryBudgetExceeded with
+    QUERY_BUDGET_STRICT (the test settings) so regressions fail the tests.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+        # Connections opened before the middleware was loaded (the test
+        # database, management commands) missed connection_created
+        for connection in connections.all(initialized_only=True):
+            install_execute_wrapper(None, connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with request_queries() as queries:
+            response = self.get_response(request)
+        self.check(request, queries)
+        return response
+
+    async def __acall__(self, request):
+        with request_queries() as queries:
+            response = await self.get_response(request)
+        self.check(request, queries)
+        return response
+
+    def check(self, request, queries):
+        view = url_name(request)
+        problems = []
+        budget = settings.QUERY_BUDGETS.get(view)
+        if budget is not None and queries.count > budget:
+            problems.append(f'{queries.count} queries, budget is {budget}')
+        for sql, count in queries.repeated(settings.QUERY_REPEAT_THRESHOLD):
+            problems.append(f'{count}x {sql}')
+        if not problems:
+            return
+        message = f"Query budget of {view or request.path} exceeded: {'; '.join(problems)}"
+        if settings.QUERY_BUDGET_STRICT:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
@@ -48,6 +48,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
+    'core.profiling.ProfilingMiddleware',
+    'core.deadline.DeadlineMiddleware',
+    'core.limiter.ConcurrencyLimitMiddleware',
+    'core.query_budget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -86,6 +91,14 @@ DATABASES = {
     'default': env.db('DATABASE_URL')
 }
 
+# No query runs longer than this (seconds, 0 disables it); queries issued close
+# to a request's deadline get only the time the request has left
+DATABASE_STATEMENT_TIMEOUT = env.float('DATABASE_STATEMENT_TIMEOUT', default=30)
+if 'postgresql' in DATABASES['default']['ENGINE']:
+    DATABASES['default'].setdefault('OPTIONS', {})['options'] = (
+        f"-c statement_timeout={int(DATABASE_STATEMENT_TIMEOUT * 1000)}"
+    )
+
 # Cache
 CACHES = {
     'default': {
@@ -117,6 +130,20 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Password hashing, only used by local accounts (superusers and the Django admin);
+# Keycloak owns the credentials of users it provisions. Run
+# `manage.py benchmark_hashers` to pick PASSWORD_HASH_ITERATIONS for the host,
+# 0 keeps Django's default
+PASSWORD_HASHERS = [
+    'users.hashers.TunedPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+PASSWORD_HASH_ITERATIONS = env.int('PASSWORD_HASH_ITERATIONS', default=0)
+
 # Internationalization
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
@@ -144,6 +171,10 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # Reverse proxies in front of the app that append to X-Forwarded-For. The
+    # client IP of the rate limits is read from that header only when this is
+    # set, otherwise any client could pick its own IP (and a fresh bucket)
+    'NUM_PROXIES': env.int('NUM_PROXIES', default=0),
 }
 
 # CORS settings
@@ -167,30 +198,63 @@ CORS_ALLOW_HEADERS = [
     'authorization',
     'content-type',
     'dnt',
+    'if-match',
+    'if-modified-since',
+    'if-none-match',
     'origin',
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
 ]
 
+# Lets the frontend read the profile version for If-Match
+CORS_EXPOSE_HEADERS = ['etag', 'last-modified']
+
+# Logging goes through a queue to a writer thread (core.log.BackgroundHandler)
+# as one JSON object per line, or plain text with LOG_FORMAT=text. Tokens and
+# passwords are redacted, and each DEBUG/INFO call site is sampled to
+# LOG_SAMPLE_BURST records per LOG_SAMPLE_PERIOD seconds (0 disables sampling).
+LOG_LEVEL = env('LOG_LEVEL', default='INFO')
+LOG_FORMAT = env('LOG_FORMAT', default='json')
+LOG_SAMPLE_BURST = env.int('LOG_SAMPLE_BURST', default=50)
+LOG_SAMPLE_PERIOD = env.float('LOG_SAMPLE_PERIOD', default=10.0)
+# Records queued for the writer beyond this are dropped instead of blocking
+LOG_QUEUE_SIZE = env.int('LOG_QUEUE_SIZE', default=10000)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'core.log.JsonFormatter',
+        },
+        'text': {
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'core.log.SamplingFilter',
+            'burst': LOG_SAMPLE_BURST,
+            'period': LOG_SAMPLE_PERIOD,
+        },
+    },
     'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
+        'background': {
+            'class': 'core.log.BackgroundHandler',
+            'formatter': LOG_FORMAT,
+            'filters': ['sampling'],
+            'queue_size': LOG_QUEUE_SIZE,
         },
     },
+    'root': {
+        'handlers': ['background'],
+        'level': LOG_LEVEL,
+    },
     'loggers': {
         'django': {
-            'handlers': ['console'],
             'level': 'INFO',
         },
-        'api.views': {
-            'handlers': ['console'],
-            'level': 'DEBUG',  # Ensure this is set to DEBUG
-            'propagate': False,
-        },
     },
 }
 
@@ -206,6 +270,168 @@ OIDC_OP_JWKS_ENDPOINT = f"{KEYCLOAK_URL}/realms/{KEYCLOAK_REALM}/protocol/openid
 OIDC_RP_SIGN_ALGO = 'RS256'
 OIDC_OP_LOGOUT_ENDPOINT = f"{KEYCLOAK_URL}/realms/{KEYCLOAK_REALM}/protocol/openid-connect/logout"
 
+# Admin account used for user provisioning through the Keycloak admin API
+KEYCLOAK_ADMIN_USERNAME = env('KEYCLOAK_ADMIN_USERNAME', default='admin')
+KEYCLOAK_ADMIN_PASSWORD = env('KEYCLOAK_ADMIN_PASSWORD', default='admin')
+# Admin tokens are shared by all workers through Redis and renewed SKEW seconds
+# before they expire
+KEYCLOAK_ADMIN_TOKEN_SKEW = env.int('KEYCLOAK_ADMIN_TOKEN_SKEW', default=30)
+# Users registered through Keycloak get an unusable local password instead of a
+# second (PBKDF2) hash of a credential only Keycloak checks
+KEYCLOAK_MANAGED_PASSWORDS = env.bool('KEYCLOAK_MANAGED_PASSWORDS', default=True)
+
+# Pooled HTTP client used for every Keycloak call (timeouts in seconds; retries
+# with exponential backoff apply to idempotent requests)
+KEYCLOAK_HTTP_POOL_SIZE = env.int('KEYCLOAK_HTTP_POOL_SIZE', default=10)
+KEYCLOAK_HTTP_CONNECT_TIMEOUT = env.float('KEYCLOAK_HTTP_CONNECT_TIMEOUT', default=3.05)
+KEYCLOAK_HTTP_READ_TIMEOUT = env.float('KEYCLOAK_HTTP_READ_TIMEOUT', default=10)
+KEYCLOAK_HTTP_RETRIES = env.int('KEYCLOAK_HTTP_RETRIES', default=2)
+KEYCLOAK_HTTP_BACKOFF = env.float('KEYCLOAK_HTTP_BACKOFF', default=0.2)
+
+# Circuit breaker per Keycloak operation: after FAILURE_THRESHOLD consecutive
+# failures (connection errors, timeouts, 5xx) calls fail fast with a 503 for
+# RECOVERY_TIMEOUT seconds, then a probe call decides whether to close it again.
+# THRESHOLDS overrides the threshold per operation, e.g. "token=10;jwks=3"
+KEYCLOAK_BREAKER_FAILURE_THRESHOLD = env.int('KEYCLOAK_BREAKER_FAILURE_THRESHOLD', default=5)
+KEYCLOAK_BREAKER_RECOVERY_TIMEOUT = env.float('KEYCLOAK_BREAKER_RECOVERY_TIMEOUT', default=30)
+KEYCLOAK_BREAKER_THRESHOLDS = env.dict(
+    'KEYCLOAK_BREAKER_THRESHOLDS', cast={'value': int}, default={'token': 10, 'userinfo': 10})
+
+# Time budget in seconds for each request, per URL name. Keycloak calls and
+# database queries only get what is left of it and the request is answered with
+# a 504 once it is spent. The edge proxy may set X-Request-Timeout-Ms instead,
+# capped at REQUEST_DEADLINE_MAX
+REQUEST_DEADLINE_DEFAULT = env.float('REQUEST_DEADLINE_DEFAULT', default=30)
+REQUEST_DEADLINE_MAX = env.float('REQUEST_DEADLINE_MAX', default=60)
+REQUEST_DEADLINES = {
+    'login': 10,
+    'register': 15,
+    'keycloak_check': 15,
+    'api_profile': 5,
+    'toggle_mfa': 5,
+    'update_phone': 5,
+}
+
+# Most queries a view may run per request, by URL name (core.query_budget), and
+# how often one statement may repeat within a request before it's reported as
+# a likely N+1. Exceeding either is logged, or raised under QUERY_BUDGET_STRICT.
+# Budgets include the user lookup of session authentication, which requests
+# from a browser holding a session pay even on endpoints open to anyone
+QUERY_BUDGETS = {
+    'login': 1,
+    'register': 4,
+    'forgot_password': 2,
+    'reset_password': 4,
+    'keycloak_check': 1,
+    # Profile writes are one UPDATE ... RETURNING, plus a locking SELECT for
+    # writes with If-Match
+    'api_profile': 3,
+    'toggle_mfa': 3,
+    'update_phone': 3,
+    # One query per page of the directory, whatever its depth
+    'user_directory': 3,
+}
+QUERY_REPEAT_THRESHOLD = env.int('QUERY_REPEAT_THRESHOLD', default=5)
+QUERY_BUDGET_STRICT = env.bool('QUERY_BUDGET_STRICT', default=False)
+
+# Adaptive concurrency limits per route group (per worker process): endpoints
+# waiting on Keycloak are limited separately from those served locally, each
+# limit grows while requests finish within LATENCY_TARGET seconds and shrinks
+# when they don't. Requests queue for at most QUEUE_TIMEOUT seconds and are
+# then answered with a 503
+CONCURRENCY_ROUTE_GROUPS = {
+    'login': 'idp',
+    'register': 'idp',
+    'keycloak_check': 'idp',
+    'api_profile': 'local',
+    'toggle_mfa': 'local',
+    'update_phone': 'local',
+    'user_directory': 'local',
+}
+CONCURRENCY_LIMITS = {
+    'idp': {
+        'initial_limit': env.int('IDP_CONCURRENCY_LIMIT', default=20),
+        'max_limit': env.int('IDP_CONCURRENCY_MAX_LIMIT', default=100),
+        'latency_target': env.float('IDP_LATENCY_TARGET', default=1.0),
+        'queue_timeout': env.float('IDP_QUEUE_TIMEOUT', default=0.5),
+    },
+    'local': {
+        'initial_limit': env.int('LOCAL_CONCURRENCY_LIMIT', default=50),
+        'max_limit': env.int('LOCAL_CONCURRENCY_MAX_LIMIT', default=500),
+        'latency_target': env.float('LOCAL_LATENCY_TARGET', default=0.1),
+        'queue_timeout': env.float('LOCAL_QUEUE_TIMEOUT', default=0.2),
+    },
+}
+CONCURRENCY_RETRY_AFTER = env.int('CONCURRENCY_RETRY_AFTER', default=1)
+
+# Token buckets in Redis shared by all workers, so a rejected login or reset
+# request costs one Redis round trip instead of a Keycloak password grant or
+# an email. Rates use DRF's "<count>/<sec|min|hour|day>" format and apply to
+# the client IP and to the username or email the request is for.
+RATE_LIMIT_ENABLED = env.bool('RATE_LIMIT_ENABLED', default=True)
+RATE_LIMITS = {
+    'login': {
+        'ip': env('LOGIN_RATE_LIMIT_IP', default='30/min'),
+        'username': env('LOGIN_RATE_LIMIT_USERNAME', default='10/min'),
+    },
+    'register': {
+        'ip': env('REGISTER_RATE_LIMIT_IP', default='10/hour'),
+    },
+    'forgot_password': {
+        'ip': env('FORGOT_PASSWORD_RATE_LIMIT_IP', default='10/hour'),
+        'email': env('FORGOT_PASSWORD_RATE_LIMIT_EMAIL', default='3/hour'),
+    },
+}
+
+# Request profiling (core.profiling): a sample of requests, plus requests that
+# send X-Profile-Token with PROFILING_TOKEN, is profiled with pyinstrument and
+# kept in the cache for PROFILING_TTL seconds, listed at admin/profiles/
+PROFILING_SAMPLE_RATE = env.float('PROFILING_SAMPLE_RATE', default=0.0)
+PROFILING_TOKEN = env('PROFILING_TOKEN', default='')
+PROFILING_INTERVAL = env.float('PROFILING_INTERVAL', default=0.001)
+PROFILING_TTL = env.int('PROFILING_TTL', default=86400)
+PROFILING_MAX_LISTED = env.int('PROFILING_MAX_LISTED', default=100)
+
+# Route login, registration and the profile API to the async views; enabled by
+# core/asgi.py so uvicorn workers don't hold a thread per Keycloak call
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+
+# WhiteNoise's middleware is sync-only, Django would run every async request
+# through it in a thread. core/asgi.py serves the static files instead
+if ASYNC_VIEWS:
+    MIDDLEWARE.remove('whitenoise.middleware.WhiteNoiseMiddleware')
+
+# Bearer token verification for the API: 'jwks' checks the signature and claims
+# locally against the realm signing keys, 'userinfo' asks Keycloak on every request
+KEYCLOAK_TOKEN_VERIFICATION = env('KEYCLOAK_TOKEN_VERIFICATION', default='jwks')
+KEYCLOAK_ISSUER = env('KEYCLOAK_ISSUER', default=f"{KEYCLOAK_URL}/realms/{KEYCLOAK_REALM}")
+KEYCLOAK_AUDIENCE = env('KEYCLOAK_AUDIENCE', default=OIDC_RP_CLIENT_ID)
+KEYCLOAK_TOKEN_LEEWAY = env.int('KEYCLOAK_TOKEN_LEEWAY', default=10)
+
+# Realm signing keys: refreshed in the background REFRESH_AHEAD seconds before
+# MAX_AGE runs out; unknown kids refetch at most once per MIN_REFETCH_INTERVAL
+KEYCLOAK_JWKS_MAX_AGE = env.int('KEYCLOAK_JWKS_MAX_AGE', default=300)
+KEYCLOAK_JWKS_REFRESH_AHEAD = env.int('KEYCLOAK_JWKS_REFRESH_AHEAD', default=60)
+KEYCLOAK_JWKS_MIN_REFETCH_INTERVAL = env.int('KEYCLOAK_JWKS_MIN_REFETCH_INTERVAL', default=30)
+
+# Verified token claims are cached in-process (LRU bounded by SIZE) and in Redis,
+# for at most TTL seconds and never past the token's exp
+KEYCLOAK_TOKEN_CACHE_SIZE = env.int('KEYCLOAK_TOKEN_CACHE_SIZE', default=10000)
+KEYCLOAK_TOKEN_CACHE_TTL = env.int('KEYCLOAK_TOKEN_CACHE_TTL', default=300)
+
+# Users resolved from token subjects are cached in Redis for TTL seconds and
+# in-process for LOCAL_TTL seconds; profile saves invalidate the Redis entry
+USER_CACHE_SIZE = env.int('USER_CACHE_SIZE', default=10000)
+USER_CACHE_TTL = env.int('USER_CACHE_TTL', default=300)
+USER_CACHE_LOCAL_TTL = env.int('USER_CACHE_LOCAL_TTL', default=5)
+
+# Profile API payloads are read through Redis and an in-process tier; profile
+# saves write the new payload through, so TTL only bounds what Redis keeps and
+# LOCAL_TTL how long other workers may serve the previous one
+PROFILE_CACHE_SIZE = env.int('PROFILE_CACHE_SIZE', default=10000)
+PROFILE_CACHE_TTL = env.int('PROFILE_CACHE_TTL', default=3600)
+PROFILE_CACHE_LOCAL_TTL = env.int('PROFILE_CACHE_LOCAL_TTL', default=5)
+
 # Authentication backends
 AUTHENTICATION_BACKENDS = (
     'django.contrib.auth.backends.ModelBackend',
@@ -8,6 +8,13 @@ DATABASES = {
     }
 }
 
+# Keep the cache in-process so tests don't need Redis
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Add the app templates directory
 TEMPLATES[0]['DIRS'].append(os.path.join(BASE_DIR, 'users/templates'))
 
@@ -16,6 +23,12 @@ PASSWORD_HASHERS = [
     'django.contrib.auth.hashers.MD5PasswordHasher',
 ]
 
+# Tests that exercise the rate limits enable them explicitly
+RATE_LIMIT_ENABLED = False
+
+# Fail tests that go over a view's query budget
+QUERY_BUDGET_STRICT = True
+
 # Disable CSRF for testing API endpoints
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -24,6 +37,7 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'NUM_PROXIES': 0,
 }
 
 # Test-specific environment variables
@@ -3,9 +3,15 @@ from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 from api.schema import api_schema_view
+from core.metrics import metrics_view
+from core.profiling import profile_download, profile_list
 
 urlpatterns = [
+    path('admin/profiles/', admin.site.admin_view(profile_list), name='admin_profiles'),
+    re_path(r'^admin/profiles/(?P<profile_id>\d+)/(?P<fmt>speedscope|pstats)/$',
+            admin.site.admin_view(profile_download), name='admin_profile_download'),
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('api/', include('api.urls')),
     path('users/', include('users.urls')),
     path('oidc/', include('mozilla_django_oidc.urls')),
@@ -0,0 +1,18 @@
+import os
+import shutil
+
+# Loaded by gunicorn from the working directory. Workers write their metrics
+# to files in PROMETHEUS_MULTIPROC_DIR so /metrics can add them up across the
+# whole worker pool; set here so it's in place before the app is imported.
+multiproc_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+
+
+def on_starting(server):
+    # Files left by a previous run would be counted again
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
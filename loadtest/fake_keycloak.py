@@ -0,0 +1,356 @@
+"""
+Local stand-in for the Keycloak endpoints the app calls, for load tests.
+
+Implements discovery, JWKS, the token endpoint (password, refresh_token and
+client_credentials grants), userinfo and the admin users/clients endpoints,
+in memory. Every response can be delayed by a latency with jitter and
+replaced by a 503 at a given error rate, to see how the app behaves when
+its identity provider slows down or fails.
+
+    python -m loadtest.fake_keycloak --port 8180 --latency-ms 50 --jitter-ms 20 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import re
+import secrets
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+KID = 'loadtest'
+TOKEN_LIFETIME = 300
+
+
+class FakeKeycloak:
+    """
+    Users, sessions and the signing key of the fake realms, plus the latency
+    and error profile applied to every request
+    """
+
+    def __init__(self, realm='loadtest', client_id='django-client', latency=0.0, jitter=0.0, error_rate=0.0,
+                 endpoint_latency=None, admin_username='admin', admin_password='admin'):
+        self.realm = realm
+        self.client_id = client_id
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.endpoint_latency = endpoint_latency or {}
+        self.admin_username = admin_username
+        self.admin_password = admin_password
+        self.base_url = None
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.users = {}
+        self.usernames = {}
+        self.refresh_tokens = {}
+        self.lock = threading.Lock()
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.key.public_key()))
+        jwk.update({'kid': KID, 'use': 'sig', 'alg': 'RS256'})
+        self.jwks = {'keys': [jwk]}
+
+    def delay(self, endpoint):
+        latency = self.endpoint_latency.get(endpoint, self.latency)
+        if self.jitter:
+            latency += random.uniform(-self.jitter, self.jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    def failed(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def issuer(self, realm):
+        return f'{self.base_url}/realms/{realm}'
+
+    def create_user(self, representation):
+        username = representation.get('username', '').lower()
+        with self.lock:
+            if not username or username in self.usernames:
+                return None
+            user_id = str(uuid.uuid4())
+            password = next((c.get('value') for c in representation.get('credentials', [])
+                             if c.get('type') == 'password'), None)
+            self.users[user_id] = {
+                'id': user_id,
+                'username': username,
+                'email': representation.get('email'),
+                'enabled': representation.get('enabled', True),
+                'password': password,
+            }
+            self.usernames[username] = user_id
+            return user_id
+
+    def issue_tokens(self, realm, subject, username, email, client_id):
+        now = int(time.time())
+        claims = {
+            'exp': now + TOKEN_LIFETIME,
+            'iat': now,
+            'jti': str(uuid.uuid4()),
+            'iss': self.issuer(realm),
+            'aud': 'account',
+            'azp': client_id,
+            'sub': subject,
+            'typ': 'Bearer',
+            'preferred_username': username,
+            'email': email,
+        }
+        refresh_token = secrets.token_urlsafe(32)
+        with self.lock:
+            self.refresh_tokens[refresh_token] = (realm, subject, username, email, client_id)
+        return {
+            'access_token': jwt.encode(claims, self.key, algorithm='RS256', headers={'kid': KID}),
+            'expires_in': TOKEN_LIFETIME,
+            'refresh_token': refresh_token,
+            'refresh_expires_in': TOKEN_LIFETIME * 6,
+            'token_type': 'Bearer',
+        }
+
+    def verify(self, token):
+        try:
+            return jwt.decode(token, self.key.public_key(), algorithms=['RS256'], options={'verify_aud': False})
+        except jwt.PyJWTError:
+            return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        ('GET', re.compile(r'^/realms/(?P<realm>[^/]+)/\.well-known/openid-configuration$'), 'discovery'),
+        ('GET', re.compile(r'^/realms/(?P<realm>[^/]+)/protocol/openid-connect/certs$'), 'jwks'),
+        ('POST', re.compile(r'^/realms/(?P<realm>[^/]+)/protocol/openid-connect/token$'), 'token'),
+        ('GET', re.compile(r'^/realms/(?P<realm>[^/]+)/protocol/openid-connect/userinfo$'), 'userinfo'),
+        ('POST', re.compile(r'^/admin/realms/(?P<realm>[^/]+)/users$'), 'create_user'),
+        ('GET', re.compile(r'^/admin/realms/(?P<realm>[^/]+)/users$'), 'find_users'),
+        ('DELETE', re.compile(r'^/admin/realms/(?P<realm>[^/]+)/users/(?P<user_id>[^/]+)$'), 'delete_user'),
+        ('GET', re.compile(r'^/admin/realms/(?P<realm>[^/]+)/clients$'), 'clients'),
+    ]
+
+    @property
+    def keycloak(self):
+        return self.server.keycloak
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+        for route_method, pattern, endpoint in self.ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                self.keycloak.delay(endpoint)
+                if self.keycloak.failed():
+                    return self.send_json(503, {'error': 'injected failure'})
+                return getattr(self, endpoint)(**match.groupdict())
+        self.send_json(404, {'error': 'Not found'})
+
+    def send_json(self, status, data=None, headers=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        if data is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def form(self):
+        return {name: values[0] for name, values in parse_qs(self.body.decode('utf-8')).items()}
+
+    def bearer_claims(self):
+        header = self.headers.get('Authorization', '')
+        if not header.startswith('Bearer '):
+            return None
+        return self.keycloak.verify(header[len('Bearer '):])
+
+    def admin_claims(self):
+        claims = self.bearer_claims()
+        if claims is None or claims.get('iss') != self.keycloak.issuer('master'):
+            self.send_json(401, {'error': 'HTTP 401 Unauthorized'})
+            return None
+        return claims
+
+    # Realm endpoints
+
+    def discovery(self, realm):
+        issuer = self.keycloak.issuer(realm)
+        self.send_json(200, {
+            'issuer': issuer,
+            'authorization_endpoint': f'{issuer}/protocol/openid-connect/auth',
+            'token_endpoint': f'{issuer}/protocol/openid-connect/token',
+            'userinfo_endpoint': f'{issuer}/protocol/openid-connect/userinfo',
+            'jwks_uri': f'{issuer}/protocol/openid-connect/certs',
+            'end_session_endpoint': f'{issuer}/protocol/openid-connect/logout',
+        })
+
+    def jwks(self, realm):
+        self.send_json(200, self.keycloak.jwks)
+
+    def token(self, realm):
+        data = self.form()
+        grant_type = data.get('grant_type')
+        client_id = data.get('client_id', '')
+        if grant_type == 'password':
+            if realm == 'master':
+                valid = (data.get('username') == self.keycloak.admin_username
+                         and data.get('password') == self.keycloak.admin_password)
+                identity = ('admin', data.get('username'), None) if valid else None
+            else:
+                user_id = self.keycloak.usernames.get((data.get('username') or '').lower())
+                user = self.keycloak.users.get(user_id)
+                valid = user is not None and user['enabled'] and user['password'] == data.get('password')
+                identity = (user['id'], user['username'], user['email']) if valid else None
+            if identity is None:
+                return self.send_json(401, {'error': 'invalid_grant', 'error_description': 'Invalid user credentials'})
+        elif grant_type == 'refresh_token':
+            with self.keycloak.lock:
+                session = self.keycloak.refresh_tokens.pop(data.get('refresh_token'), None)
+            if session is None or session[0] != realm:
+                return self.send_json(400, {'error': 'invalid_grant', 'error_description': 'Invalid refresh token'})
+            identity = session[1:4]
+        elif grant_type == 'client_credentials':
+            identity = (f'service-account-{client_id}', f'service-account-{client_id}', None)
+        else:
+            return self.send_json(400, {'error': 'unsupported_grant_type'})
+        self.send_json(200, self.keycloak.issue_tokens(realm, *identity, client_id))
+
+    def userinfo(self, realm):
+        claims = self.bearer_claims()
+        if claims is None or claims.get('iss') != self.keycloak.issuer(realm):
+            return self.send_json(401, {'error': 'invalid_token'})
+        self.send_json(200, {
+            'sub': claims['sub'],
+            'preferred_username': claims['preferred_username'],
+            'email': claims.get('email'),
+            'email_verified': True,
+        })
+
+    # Admin endpoints
+
+    def create_user(self, realm):
+        if self.admin_claims() is None:
+            return
+        try:
+            representation = json.loads(self.body or b'{}')
+        except ValueError:
+            return self.send_json(400, {'error': 'invalid json'})
+        user_id = self.keycloak.create_user(representation)
+        if user_id is None:
+            return self.send_json(409, {'errorMessage': 'User exists with same username'})
+        location = f'{self.keycloak.base_url}/admin/realms/{realm}/users/{user_id}'
+        self.send_json(201, headers={'Location': location})
+
+    def find_users(self, realm):
+        if self.admin_claims() is None:
+            return
+        username = (self.query.get('username') or [''])[0].lower()
+        email = (self.query.get('email') or [''])[0].lower()
+        users = [
+            {name: value for name, value in user.items() if name != 'password'}
+            for user in list(self.keycloak.users.values())
+            if (not username or user['username'] == username)
+            and (not email or (user['email'] or '').lower() == email)
+        ]
+        self.send_json(200, users)
+
+    def delete_user(self, realm, user_id):
+        if self.admin_claims() is None:
+            return
+        with self.keycloak.lock:
+            user = self.keycloak.users.pop(user_id, None)
+            if user is not None:
+                self.keycloak.usernames.pop(user['username'], None)
+        self.send_json(204 if user else 404)
+
+    def clients(self, realm):
+        if self.admin_claims() is None:
+            return
+        self.send_json(200, [{'id': str(uuid.uuid5(uuid.NAMESPACE_URL, self.keycloak.client_id)),
+                              'clientId': self.keycloak.client_id, 'enabled': True}])
+
+    def log_message(self, format, *args):
+        # One line per request would drown the load test output
+        pass
+
+
+class FakeKeycloakServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open many connections at once
+    request_queue_size = 1024
+
+    def __init__(self, keycloak, host='127.0.0.1', port=0):
+        super().__init__((host, port), Handler)
+        self.keycloak = keycloak
+        keycloak.base_url = f'http://{host}:{self.server_address[1]}'
+
+    def start(self):
+        """
+        Serve from a daemon thread, returns the base URL
+        """
+        threading.Thread(target=self.serve_forever, name='fake-keycloak', daemon=True).start()
+        return self.keycloak.base_url
+
+
+def parse_latencies(value):
+    """
+    'token=200,userinfo=50' -> {'token': 0.2, 'userinfo': 0.05}
+    """
+    latencies = {}
+    for item in filter(None, value.split(',')):
+        endpoint, ms = item.split('=')
+        latencies[endpoint.strip()] = float(ms) / 1000
+    return latencies
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('fake Keycloak')
+    group.add_argument('--realm', default='loadtest')
+    group.add_argument('--client-id', default='django-client')
+    group.add_argument('--latency-ms', type=float, default=20, help='Delay added to every response')
+    group.add_argument('--jitter-ms', type=float, default=10, help='Random +/- variation of the delay')
+    group.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with a 503')
+    group.add_argument('--endpoint-latency', type=parse_latencies, default={},
+                       help='Per endpoint delays overriding --latency-ms, e.g. token=200,userinfo=50')
+
+
+def from_arguments(args):
+    return FakeKeycloak(
+        realm=args.realm,
+        client_id=args.client_id,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        endpoint_latency=args.endpoint_latency,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8180)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = FakeKeycloakServer(from_arguments(args), args.host, args.port)
+    print(f'Fake Keycloak serving realm {args.realm} at {server.keycloak.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""
+End-to-end load test: boots the app under gunicorn against the fake Keycloak
+of loadtest.fake_keycloak, drives logins, profile reads and registration
+bursts at it and reports throughput and latency percentiles per endpoint.
+
+The app still needs its database and Redis (DATABASE_URL, REDIS_URL from the
+environment or .env, e.g. `docker-compose up -d db redis`):
+
+    python -m loadtest.run --server asgi --workers 4 --concurrency 50 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import httpx
+
+from loadtest import fake_keycloak
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'wsgi': ['core.wsgi:application'],
+    'asgi': ['core.asgi:application', '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+PASSWORD = 'Loadtest-Password-1'
+
+
+class Stats:
+    """
+    Latencies and outcomes per endpoint
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def record(self, endpoint, status, latency):
+        self.latencies[endpoint].append(latency)
+        self.statuses[endpoint][status] += 1
+
+    def report(self, elapsed):
+        report = {}
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            statuses = self.statuses[endpoint]
+            errors = sum(count for status, count in statuses.items() if status == 'error' or status >= 500)
+            report[endpoint] = {
+                'requests': len(latencies),
+                'errors': errors,
+                'throughput': len(latencies) / elapsed,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p90_ms': percentile(latencies, 90) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+                'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+            }
+        return report
+
+
+def percentile(values, p):
+    # Nearest rank on sorted values
+    index = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class LoadTest:
+    def __init__(self, base_url, args):
+        self.base_url = base_url
+        self.args = args
+        self.stats = Stats()
+        self.users = []
+        self.tokens = {}
+
+    async def call(self, client, endpoint, method, path, **kwargs):
+        started = time.monotonic()
+        try:
+            response = await client.request(method, path, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            response, status = None, 'error'
+        self.stats.record(endpoint, status, time.monotonic() - started)
+        return response
+
+    async def register(self, client):
+        username = f'lt-{uuid.uuid4().hex[:12]}'
+        response = await self.call(client, 'register', 'POST', '/api/register/', json={
+            'username': username, 'email': f'{username}@loadtest.example', 'password': PASSWORD,
+        })
+        if response is not None and response.status_code == 201:
+            self.users.append(username)
+
+    async def login(self, client, username):
+        response = await self.call(client, 'login', 'POST', '/api/login/', json={
+            'username': username, 'password': PASSWORD,
+        })
+        if response is not None and response.status_code == 200:
+            self.tokens[username] = response.json()['token']
+
+    async def read_profile(self, client, username):
+        token = self.tokens.get(username)
+        if token is None:
+            return await self.login(client, username)
+        response = await self.call(client, 'profile', 'GET', '/users/api/profile/',
+                                   headers={'Authorization': f'Bearer {token}'})
+        if response is not None and response.status_code == 401:
+            # Expired, log in again next time
+            self.tokens.pop(username, None)
+
+    async def seed(self, client):
+        """
+        Register the accounts the virtual users log in with
+        """
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def register():
+            async with semaphore:
+                await self.register(client)
+
+        await asyncio.gather(*(register() for _ in range(self.args.users)))
+        if not self.users:
+            raise SystemExit('Seeding failed, no account could be registered')
+        await asyncio.gather(*(self.login(client, username) for username in self.users[:self.args.concurrency]))
+
+    async def virtual_user(self, client, stop_at):
+        while time.monotonic() < stop_at:
+            username = random.choice(self.users)
+            if random.random() < self.args.login_ratio:
+                await self.login(client, username)
+            else:
+                await self.read_profile(client, username)
+            if self.args.think_ms:
+                await asyncio.sleep(random.expovariate(1000 / self.args.think_ms))
+
+    async def register_bursts(self, client, stop_at):
+        next_burst = time.monotonic() + self.args.burst_interval
+        while next_burst < stop_at:
+            await asyncio.sleep(next_burst - time.monotonic())
+            next_burst += self.args.burst_interval
+            await asyncio.gather(*(self.register(client) for _ in range(self.args.burst_size)))
+
+    async def run(self):
+        limits = httpx.Limits(max_connections=self.args.concurrency + self.args.burst_size)
+        timeout = httpx.Timeout(self.args.timeout)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=timeout) as client:
+            await self.seed(client)
+            self.stats = Stats()
+            started = time.monotonic()
+            stop_at = started + self.args.duration
+            tasks = [self.virtual_user(client, stop_at) for _ in range(self.args.concurrency)]
+            if self.args.burst_size:
+                tasks.append(self.register_bursts(client, stop_at))
+            await asyncio.gather(*tasks)
+            return self.stats.report(time.monotonic() - started)
+
+
+def app_environment(args, keycloak_url):
+    env = dict(os.environ)
+    env.update({
+        'KEYCLOAK_URL': keycloak_url,
+        'KEYCLOAK_REALM': args.realm,
+        'KEYCLOAK_CLIENT_ID': args.client_id,
+        'KEYCLOAK_CLIENT_SECRET': 'loadtest',
+        'KEYCLOAK_ADMIN_USERNAME': 'admin',
+        'KEYCLOAK_ADMIN_PASSWORD': 'admin',
+        'KEYCLOAK_ISSUER': f'{keycloak_url}/realms/{args.realm}',
+        'ALLOWED_HOSTS': '127.0.0.1,localhost',
+        'DEBUG': 'False',
+        # The load generator is a single client IP logging in over and over
+        'RATE_LIMIT_ENABLED': str(args.rate_limits),
+    })
+    env.setdefault('SECRET_KEY', 'loadtest-insecure-secret-key')
+    return env
+
+
+def start_app(args, env):
+    subprocess.run([sys.executable, 'manage.py', 'migrate', '--noinput'],
+                   cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    command = [
+        sys.executable, '-m', 'gunicorn', *SERVERS[args.server],
+        '--bind', f'127.0.0.1:{args.port}',
+        '--workers', str(args.workers),
+        '--threads', str(args.threads),
+        '--log-level', 'warning',
+    ]
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+
+def wait_until_ready(base_url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'The app exited with status {process.returncode}')
+        try:
+            httpx.get(f'{base_url}/metrics', timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise SystemExit(f'The app did not start within {timeout}s')
+
+
+def print_report(report, args):
+    print(f'\n{args.server} x {args.workers} workers, {args.concurrency} virtual users, {args.duration}s')
+    print(f"{'endpoint':<10} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8}  statuses")
+    for endpoint, row in report.items():
+        statuses = ' '.join(f'{status}:{count}' for status, count in row['statuses'].items())
+        print(f"{endpoint:<10} {row['requests']:>9} {row['errors']:>7} {row['throughput']:>8.1f} "
+              f"{row['p50_ms']:>8.1f} {row['p90_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}  {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    app = parser.add_argument_group('app')
+    app.add_argument('--server', choices=sorted(SERVERS), default='asgi')
+    app.add_argument('--workers', type=int, default=2)
+    app.add_argument('--threads', type=int, default=4, help='Threads per worker (wsgi only)')
+    app.add_argument('--port', type=int, default=8765)
+    app.add_argument('--url', help='Test an app that is already running instead of starting one')
+    app.add_argument('--rate-limits', action='store_true', help='Keep the login and registration rate limits on')
+    traffic = parser.add_argument_group('traffic')
+    traffic.add_argument('--duration', type=float, default=30, help='Seconds of traffic after seeding')
+    traffic.add_argument('--concurrency', type=int, default=20, help='Virtual users')
+    traffic.add_argument('--users', type=int, default=50, help='Accounts registered before the test')
+    traffic.add_argument('--login-ratio', type=float, default=0.2,
+                         help='Share of virtual user actions that are logins, the rest are profile reads')
+    traffic.add_argument('--think-ms', type=float, default=0, help='Mean pause between actions of a virtual user')
+    traffic.add_argument('--burst-size', type=int, default=10, help='Registrations per burst, 0 for none')
+    traffic.add_argument('--burst-interval', type=float, default=5, help='Seconds between registration bursts')
+    traffic.add_argument('--timeout', type=float, default=30, help='Client timeout per request')
+    traffic.add_argument('--json', help='Also write the report to this file')
+    fake_keycloak.add_arguments(parser)
+    args = parser.parse_args()
+
+    keycloak = fake_keycloak.FakeKeycloakServer(fake_keycloak.from_arguments(args))
+    keycloak_url = keycloak.start()
+
+    process = None
+    base_url = args.url
+    if base_url is None:
+        base_url = f'http://127.0.0.1:{args.port}'
+        process = start_app(args, app_environment(args, keycloak_url))
+    try:
+        if process is not None:
+            wait_until_ready(base_url, process)
+        report = asyncio.run(LoadTest(base_url, args).run())
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=30)
+        keycloak.shutdown()
+
+    print_report(report, args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'endpoints': report}, f, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from api import admin_token, circuit_breaker, jwks, keycloak
+from api.admin_token import call_with_admin_token
+from api.authentication import KeycloakAuthentication
+from api.keycloak import get_client
+from api.views import created_user_id, remove_created_user
+from loadtest.fake_keycloak import FakeKeycloak, FakeKeycloakServer
+
+PASSWORD = 'Fake-Password-1'
+
+
+class TestFakeKeycloak(SimpleTestCase):
+    """
+    The app's Keycloak client, JWKS verification and admin calls against the
+    fake the load tests run on
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.keycloak = FakeKeycloak(realm='test-realm', client_id='test-client')
+        cls.server = FakeKeycloakServer(cls.keycloak)
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+        base_url = cls.server.start()
+        realm_url = f'{base_url}/realms/test-realm'
+        cls.enterClassContext(override_settings(
+            KEYCLOAK_URL=base_url,
+            OIDC_OP_TOKEN_ENDPOINT=f'{realm_url}/protocol/openid-connect/token',
+            OIDC_OP_USER_ENDPOINT=f'{realm_url}/protocol/openid-connect/userinfo',
+            OIDC_OP_JWKS_ENDPOINT=f'{realm_url}/protocol/openid-connect/certs',
+            KEYCLOAK_ISSUER=realm_url,
+            KEYCLOAK_AUDIENCE='test-client',
+            KEYCLOAK_ADMIN_USERNAME='admin',
+            KEYCLOAK_ADMIN_PASSWORD='admin',
+        ))
+
+    def setUp(self):
+        cache.clear()
+        for module in (keycloak, jwks, admin_token, circuit_breaker):
+            module._reset_after_fork()
+            self.addCleanup(module._reset_after_fork)
+
+    def create_user(self, username):
+        response = call_with_admin_token(get_client().create_user, {
+            'username': username,
+            'email': f'{username}@example.com',
+            'enabled': True,
+            'credentials': [{'type': 'password', 'value': PASSWORD, 'temporary': False}],
+        })
+        self.assertEqual(response.status_code, 201)
+        return created_user_id(response)
+
+    def login(self, username):
+        response = get_client().token({
+            'grant_type': 'password',
+            'client_id': 'test-client',
+            'username': username,
+            'password': PASSWORD,
+        })
+        self.assertEqual(response.status_code, 200)
+        return response.json()['access_token']
+
+    def test_token_verified_with_jwks(self):
+        """Test that a token of the fake passes the app's local JWKS verification"""
+        keycloak_id = self.create_user('alice')
+        claims = KeycloakAuthentication().decode_token(self.login('alice'))
+        self.assertEqual(claims['sub'], keycloak_id)
+        self.assertEqual(claims['preferred_username'], 'alice')
+        self.assertEqual(claims['azp'], 'test-client')
+
+    def test_userinfo(self):
+        """Test that the fake's userinfo endpoint verifies the token for the app"""
+        keycloak_id = self.create_user('bob')
+        user_info = KeycloakAuthentication().fetch_userinfo(self.login('bob'))
+        self.assertEqual(user_info['sub'], keycloak_id)
+        self.assertEqual(user_info['preferred_username'], 'bob')
+        self.assertEqual(user_info['email'], 'bob@example.com')
+
+    def test_wrong_password(self):
+        """Test that the fake refuses a login with the wrong password"""
+        self.create_user('carol')
+        response = get_client().token({
+            'grant_type': 'password', 'client_id': 'test-client', 'username': 'carol', 'password': 'wrong',
+        })
+        self.assertEqual(response.status_code, 401)
+
+    def test_admin_users(self):
+        """Test that the admin client creates, finds and deletes users of the fake"""
+        keycloak_id = self.create_user('Dave')
+        response = call_with_admin_token(get_client().create_user, {'username': 'dave'})
+        self.assertEqual(response.status_code, 409)
+
+        response = call_with_admin_token(get_client().find_users, username='dave', exact='true')
+        self.assertEqual([user['id'] for user in response.json()], [keycloak_id])
+
+        remove_created_user(get_client(), 'Dave')
+        self.assertNotIn(keycloak_id, self.keycloak.users)
+        response = call_with_admin_token(get_client().delete_user, keycloak_id)
+        self.assertEqual(response.status_code, 404)
+
+    def test_admin_token_reused(self):
+        """Test that the admin calls share the token the fake issued"""
+        client = get_client()
+        first = admin_token.get_admin_token()
+        call_with_admin_token(client.get_clients)
+        self.assertEqual(admin_token.get_admin_token(), first)
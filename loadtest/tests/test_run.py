@@ -0,0 +1,59 @@
+import httpx
+from django.test import SimpleTestCase
+
+from loadtest.run import LoadTest, Stats, percentile
+
+
+class TestStats(SimpleTestCase):
+    def test_percentile(self):
+        """Test that percentiles use the nearest rank"""
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([7], 90), 7)
+
+    def test_report(self):
+        """Test that the report aggregates latencies and errors per endpoint"""
+        stats = Stats()
+        for latency in (0.01, 0.02, 0.03, 0.04):
+            stats.record('login', 200, latency)
+        stats.record('login', 503, 0.5)
+        stats.record('login', 'error', 1.0)
+        stats.record('profile', 401, 0.002)
+
+        report = stats.report(elapsed=2)
+        self.assertEqual(list(report), ['login', 'profile'])
+        login = report['login']
+        self.assertEqual(login['requests'], 6)
+        self.assertEqual(login['errors'], 2)
+        self.assertEqual(login['throughput'], 3)
+        self.assertEqual(login['p50_ms'], 30)
+        self.assertEqual(login['max_ms'], 1000)
+        self.assertEqual(login['statuses'], {'200': 4, '503': 1, 'error': 1})
+        # Client errors aren't counted as failures
+        self.assertEqual(report['profile']['errors'], 0)
+
+
+class TestLoadTest(SimpleTestCase):
+    async def test_virtual_user_recorded(self):
+        """Test that the runner's calls end up in the report, connection errors included"""
+        def handler(request):
+            if request.url.path == '/api/login/':
+                return httpx.Response(200, json={'token': 'token'})
+            if request.url.path == '/users/api/profile/':
+                raise httpx.ConnectError('connection refused', request=request)
+            return httpx.Response(201)
+
+        load_test = LoadTest('http://app', args=None)
+        async with httpx.AsyncClient(base_url='http://app', transport=httpx.MockTransport(handler)) as client:
+            await load_test.register(client)
+            username = load_test.users[0]
+            await load_test.read_profile(client, username)
+            await load_test.read_profile(client, username)
+
+        report = load_test.stats.report(elapsed=1)
+        self.assertEqual(report['register']['statuses'], {'201': 1})
+        self.assertEqual(report['login']['statuses'], {'200': 1})
+        self.assertEqual(report['profile']['statuses'], {'error': 1})
+        self.assertEqual(report['profile']['errors'], 1)
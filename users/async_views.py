@@ -0,0 +1,62 @@
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.decorators import permission_classes
+from rest_framework.permissions import IsAuthenticated
+
+from api.decorators import async_api_view
+from .cache import aget_profile_entry, profile_entry
+from .conditional import aupdate_profile, not_modified, set_profile_validators, set_validators
+from .models import UserProfile
+from .serializers import ProfileUpdateSerializer
+
+# Async versions of the profile API, served instead of the DRF views in
+# users.views when ASYNC_VIEWS is enabled (the ASGI entry point)
+
+
+@async_api_view(['GET', 'PATCH'])
+@permission_classes([IsAuthenticated])
+async def get_user_profile(request):
+    if request.method == 'PATCH':
+        return await patch_user_profile(request)
+    try:
+        entry = await aget_profile_entry(request.user)
+        response = not_modified(request, entry)
+        if response is None:
+            response = set_validators(JsonResponse(entry['payload']), entry['etag'], entry['last_modified'])
+        return response
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+async def patch_user_profile(request):
+    serializer = ProfileUpdateSerializer(data=request.data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    profile, failed = await aupdate_profile(request, serializer.validated_data)
+    if failed is not None:
+        return failed
+    entry = profile_entry(request.user, profile)
+    return set_validators(JsonResponse(entry['payload']), entry['etag'], entry['last_modified'])
+
+
+@async_api_view(['POST'])
+@permission_classes([IsAuthenticated])
+async def toggle_mfa(request):
+    profile, failed = await aupdate_profile(request, {'mfa_enabled': UserProfile.TOGGLE_MFA})
+    if failed is not None:
+        return failed
+    return set_profile_validators(JsonResponse({'mfa_enabled': profile.mfa_enabled}), request.user, profile)
+
+
+@async_api_view(['POST'])
+@permission_classes([IsAuthenticated])
+async def update_phone(request):
+    phone_number = request.data.get('phone_number')
+    if not phone_number:
+        return JsonResponse({'error': 'Phone number is required'}, status=400)
+
+    profile, failed = await aupdate_profile(request, {'phone_number': phone_number})
+    if failed is not None:
+        return failed
+    return set_profile_validators(JsonResponse({'phone_number': profile.phone_number}), request.user, profile)
@@ -0,0 +1,139 @@
+import hashlib
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from core.cache import TwoTierCache
+
+# Users resolved by the API authentication, keyed by Keycloak subject (sub)
+user_cache = TwoTierCache(
+    'users:subject',
+    max_entries=settings.USER_CACHE_SIZE,
+    local_ttl=settings.USER_CACHE_LOCAL_TTL,
+)
+
+# Bump when the profile API payload changes, entries of the previous shape are
+# then simply never read again
+PROFILE_PAYLOAD_VERSION = 2
+
+# Profile API payloads with their validators, keyed by user id
+profile_cache = TwoTierCache(
+    f'users:profile:v{PROFILE_PAYLOAD_VERSION}',
+    max_entries=settings.PROFILE_CACHE_SIZE,
+    local_ttl=settings.PROFILE_CACHE_LOCAL_TTL,
+)
+
+
+def _field_values(instance):
+    return {field.attname: getattr(instance, field.attname) for field in instance._meta.concrete_fields}
+
+
+def dump_user(user):
+    """
+    Plain field values of the user and its profile, safe to share between threads
+    """
+    return (_field_values(user), _field_values(user.userprofile))
+
+
+def load_user(entry):
+    """
+    Rebuild a fresh User with its profile attached, as select_related would
+    """
+    user_values, profile_values = entry
+    user = User.from_db('default', list(user_values), list(user_values.values()))
+    profile_model = apps.get_model('users', 'UserProfile')
+    user.userprofile = profile_model.from_db('default', list(profile_values), list(profile_values.values()))
+    return user
+
+
+def get_cached_user(keycloak_id):
+    entry = user_cache.get(keycloak_id)
+    return load_user(entry) if entry is not None else None
+
+
+async def aget_cached_user(keycloak_id):
+    entry = await user_cache.aget(keycloak_id)
+    return load_user(entry) if entry is not None else None
+
+
+def cache_user(keycloak_id, user):
+    user_cache.set(keycloak_id, dump_user(user), settings.USER_CACHE_TTL)
+
+
+def invalidate_user(keycloak_id):
+    if keycloak_id:
+        user_cache.delete(keycloak_id)
+
+
+def profile_payload(user, profile):
+    return {
+        'username': user.username,
+        'email': user.email,
+        'mfa_enabled': profile.mfa_enabled,
+        'phone_number': profile.phone_number,
+    }
+
+
+def profile_etag(user, profile):
+    """
+    Strong ETag of the profile payload: it changes with the profile's
+    updated_at and with the user fields the payload carries
+    """
+    version = f'{PROFILE_PAYLOAD_VERSION}:{user.pk}:{profile.updated_at.isoformat()}:{user.username}:{user.email}'
+    return '"%s"' % hashlib.sha256(version.encode()).hexdigest()[:32]
+
+
+def profile_entry(user, profile):
+    """
+    Payload of the profile API with the ETag and Last-Modified timestamp it
+    is served with, so conditional requests are answered without it
+    """
+    return {
+        'etag': profile_etag(user, profile),
+        'last_modified': int(profile.updated_at.timestamp()),
+        'payload': profile_payload(user, profile),
+    }
+
+
+def get_profile_entry(user):
+    """
+    profile_entry() of the user, read through the profile cache.
+
+    Misses are filled from the database rather than from ``user``: the request
+    user may come from another worker's in-process user cache, and would put
+    the username and email it had before a change back into the shared tier
+    """
+    entry = profile_cache.get(user.pk)
+    if entry is None:
+        profile_model = apps.get_model('users', 'UserProfile')
+        profile = profile_model.objects.select_related('user').get(user_id=user.pk)
+        entry = profile_entry(profile.user, profile)
+        profile_cache.add(user.pk, entry, settings.PROFILE_CACHE_TTL)
+    return entry
+
+
+async def aget_profile_entry(user):
+    entry = await profile_cache.aget(user.pk)
+    if entry is None:
+        profile_model = apps.get_model('users', 'UserProfile')
+        profile = await profile_model.objects.select_related('user').aget(user_id=user.pk)
+        entry = profile_entry(profile.user, profile)
+        await profile_cache.aadd(user.pk, entry, settings.PROFILE_CACHE_TTL)
+    return entry
+
+
+def cache_profile(profile):
+    """
+    Write a saved profile through to the profile cache, when it comes with
+    the user it was saved with
+    """
+    profile_model = apps.get_model('users', 'UserProfile')
+    if profile_model.user.is_cached(profile):
+        profile_cache.set(profile.user_id, profile_entry(profile.user, profile), settings.PROFILE_CACHE_TTL)
+    else:
+        # Not worth a query for the username and email
+        profile_cache.delete(profile.user_id)
+
+
+def invalidate_profile(user_id):
+    profile_cache.delete(user_id)
@@ -0,0 +1,76 @@
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .cache import profile_etag
+from .models import PROFILE_USER_FIELDS, UserProfile, profile_changed
+
+# Conditional request support for the profile API: reads are answered with
+# 304 from the cached validators, writes carrying preconditions are checked
+# against the stored profile under a row lock
+
+PRECONDITION_HEADERS = ('HTTP_IF_MATCH', 'HTTP_IF_UNMODIFIED_SINCE', 'HTTP_IF_NONE_MATCH')
+
+
+def set_validators(response, etag, last_modified):
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def set_profile_validators(response, user, profile):
+    return set_validators(response, profile_etag(user, profile), int(profile.updated_at.timestamp()))
+
+
+def not_modified(request, entry):
+    """
+    304 (or 412) response to a conditional read of a profile entry, None
+    when the payload has to be sent
+    """
+    response = get_conditional_response(request, etag=entry['etag'], last_modified=entry['last_modified'])
+    if response is not None:
+        set_validators(response, entry['etag'], entry['last_modified'])
+    return response
+
+
+def has_preconditions(request):
+    return any(header in request.META for header in PRECONDITION_HEADERS)
+
+
+def update_profile(request, values):
+    """
+    Apply ``values`` to the user's profile with a single UPDATE that also
+    returns the new state.
+
+    Writes with preconditions (If-Match, If-Unmodified-Since) lock the row
+    first and check them against the stored profile, so two clients updating
+    the same version can't both succeed. Returns the updated profile and
+    None, or the profile as stored and a 412 response.
+    """
+    # The request user may come from another worker's in-process user cache,
+    # the username and email of the payload are read along with the profile
+    profiles = UserProfile.objects.filter(user_id=request.user.pk)
+    if has_preconditions(request):
+        with transaction.atomic():
+            current = profiles.select_related('user').select_for_update().get()
+            failed = get_conditional_response(
+                request, etag=profile_etag(current.user, current), last_modified=int(current.updated_at.timestamp()))
+            if failed is not None:
+                return current, set_profile_validators(failed, current.user, current)
+            updated = profiles.update_returning(user_fields=PROFILE_USER_FIELDS, **values)
+    else:
+        updated = profiles.update_returning(user_fields=PROFILE_USER_FIELDS, **values)
+    if not updated:
+        raise UserProfile.DoesNotExist('User has no profile')
+    profile = updated[0]
+    # update_returning() sends no post_save
+    profile_changed(profile)
+    request.user.username, request.user.email = profile.user.username, profile.user.email
+    request.user.userprofile = profile
+    return profile, None
+
+
+async def aupdate_profile(request, values):
+    # The UPDATE ... RETURNING goes through a cursor, which is sync only
+    return await sync_to_async(update_profile)(request, values)
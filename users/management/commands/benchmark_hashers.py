@@ -0,0 +1,58 @@
+import time
+
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, get_hashers
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Time the configured password hashers and recommend PASSWORD_HASH_ITERATIONS for a target latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-ms', type=float, default=250,
+                            help='Time one local login may spend hashing the password')
+        parser.add_argument('--min-iterations', type=int, default=600000,
+                            help='Never recommend fewer PBKDF2 iterations than this (OWASP minimum)')
+        parser.add_argument('--rounds', type=int, default=3,
+                            help='Hashes timed per hasher, the fastest one is reported')
+        parser.add_argument('--sample-iterations', type=int, default=100000,
+                            help='PBKDF2 iterations used to measure the per-iteration cost')
+
+    def handle(self, *args, **options):
+        rounds = options['rounds']
+
+        self.stdout.write('Configured hashers:')
+        for hasher in get_hashers():
+            name = type(hasher).__name__
+            try:
+                elapsed = self.time_hash(hasher, rounds)
+            except ValueError:
+                # Argon2/bcrypt hashers raise when their library isn't installed
+                self.stdout.write(f'  {name:<28} library not installed')
+                continue
+            self.stdout.write(f'  {name:<28} {elapsed * 1000:8.1f} ms')
+
+        sample = PBKDF2PasswordHasher()
+        sample.iterations = options['sample_iterations']
+        per_iteration = self.time_hash(sample, rounds) / sample.iterations
+        recommended = int(options['target_ms'] / 1000 / per_iteration)
+        recommended = max(recommended, options['min_iterations'])
+        # Round to a readable number, hashes only need the order of magnitude
+        recommended = round(recommended, -4) or recommended
+
+        self.stdout.write('')
+        self.stdout.write(
+            f"PBKDF2 costs {per_iteration * 1e6:.3f} us per iteration on this machine; "
+            f"{recommended} iterations take about {recommended * per_iteration * 1000:.0f} ms"
+        )
+        self.stdout.write(self.style.SUCCESS(f'PASSWORD_HASH_ITERATIONS={recommended}'))
+
+    @staticmethod
+    def time_hash(hasher, rounds):
+        salt = hasher.salt()
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            hasher.encode('benchmark-password', salt)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
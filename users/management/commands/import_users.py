@@ -0,0 +1,331 @@
+import contextlib
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+
+from api.admin_token import AdminTokenError, call_with_admin_token
+from api.keycloak import get_client
+from users.cache import profile_cache, user_cache
+from users.models import UserProfile
+
+# Optional input columns, updated on users that already exist when the record
+# has them
+USER_FIELDS = ('email', 'first_name', 'last_name')
+PROFILE_FIELDS = ('phone_number', 'mfa_enabled')
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Import users from a CSV or NDJSON file: create them in Keycloak and upsert '
+        'their Django user and profile rows in batches'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV or NDJSON file, '-' reads standard input")
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='Input format, guessed from the file extension by default')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Records provisioned and written per batch')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Concurrent Keycloak create requests')
+        parser.add_argument('--partial-import', action='store_true',
+                            help="Create each batch with one call to the realm's partialImport API")
+        parser.add_argument('--checkpoint',
+                            help='File recording progress after every batch; an interrupted import resumes from it')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+        checkpoint = options['checkpoint']
+        processed = self.load_checkpoint(checkpoint, path)
+        if processed:
+            self.stdout.write(f'Resuming after {processed} records')
+
+        self.client = get_client()
+        self.stats = Counter()
+        started = time.monotonic()
+        skipped = processed
+
+        with self.open_input(path) as stream, ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            records = itertools.islice(self.read_records(stream, fmt), processed, None)
+            while True:
+                batch = list(itertools.islice(records, options['batch_size']))
+                if not batch:
+                    break
+                self.import_batch(batch, executor, options['partial_import'])
+                processed += len(batch)
+                if checkpoint:
+                    self.save_checkpoint(checkpoint, path, processed)
+                self.report(processed, processed - skipped, started)
+
+        elapsed = time.monotonic() - started
+        imported = processed - skipped
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} records in {elapsed:.1f}s ({imported / elapsed if elapsed else 0:.0f} records/s): '
+            f"{self.stats['created']} created, {self.stats['updated']} updated, "
+            f"{self.stats['keycloak_created']} new in Keycloak, {self.stats['failed']} failed"
+        ))
+
+    # Input
+
+    @contextlib.contextmanager
+    def open_input(self, path):
+        if path == '-':
+            yield sys.stdin
+            return
+        try:
+            stream = open(path, newline='', encoding='utf-8-sig')
+        except OSError as e:
+            raise CommandError(f'Cannot read {path}: {e}')
+        with stream:
+            yield stream
+
+    def read_records(self, stream, fmt):
+        """
+        Yield one dict per record without loading the whole file
+        """
+        if fmt == 'csv':
+            rows = csv.DictReader(stream)
+        else:
+            rows = (json.loads(line) for line in stream if line.strip())
+        for row in rows:
+            yield {
+                key.strip(): value.strip() if isinstance(value, str) else value
+                for key, value in row.items()
+                if key and value not in (None, '')
+            }
+
+    # Checkpoints
+
+    def load_checkpoint(self, checkpoint, path):
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+        with open(checkpoint) as f:
+            state = json.load(f)
+        if state.get('path') != os.path.abspath(path):
+            raise CommandError(f"Checkpoint {checkpoint} belongs to {state.get('path')}")
+        return state['processed']
+
+    def save_checkpoint(self, checkpoint, path, processed):
+        # Write then rename so a crash never leaves a truncated checkpoint
+        tmp = f'{checkpoint}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'path': os.path.abspath(path), 'processed': processed}, f)
+        os.replace(tmp, checkpoint)
+
+    # Batches
+
+    def import_batch(self, batch, executor, partial_import):
+        records = {}
+        for record in batch:
+            if not record.get('username'):
+                self.stats['failed'] += 1
+                self.stderr.write(f'Skipping record without username: {record}')
+                continue
+            if record['username'] in records:
+                # One user can't be upserted twice in a bulk_create
+                self.stats['failed'] += 1
+                self.stderr.write(f"Skipping duplicate of {record['username']} in the same batch")
+                continue
+            records[record['username']] = record
+
+        # Users already linked to Keycloak (e.g. from a previous run) aren't created again
+        existing = dict(
+            User.objects.filter(username__in=list(records)).values_list('username', 'userprofile__keycloak_id')
+        )
+        keycloak_ids = {
+            username: record.get('keycloak_id') or existing.get(username)
+            for username, record in records.items()
+        }
+        to_create = [record for username, record in records.items() if not keycloak_ids[username]]
+        if to_create:
+            if partial_import:
+                created = self.partial_import(to_create)
+            else:
+                created = self.create_concurrently(to_create, executor)
+            keycloak_ids.update(created)
+
+        rows = [(records[username], keycloak_id) for username, keycloak_id in keycloak_ids.items() if keycloak_id]
+        self.stats['failed'] += len(records) - len(rows)
+        if rows:
+            self.upsert(rows, existing)
+
+    def create_concurrently(self, records, executor):
+        futures = [(record, executor.submit(self.create_in_keycloak, record)) for record in records]
+        created = {}
+        for record, future in futures:
+            try:
+                keycloak_id, is_new = future.result()
+            except (ProvisioningError, AdminTokenError) as e:
+                self.stderr.write(f"Failed to create {record['username']} in Keycloak: {e}")
+            except Exception as e:
+                self.stderr.write(f"Failed to create {record['username']} in Keycloak: {e!r}")
+            else:
+                created[record['username']] = keycloak_id
+                self.stats['keycloak_created'] += is_new
+        return created
+
+    def create_in_keycloak(self, record):
+        # Runs in the worker threads, returns (keycloak_id, created)
+        response = call_with_admin_token(self.client.create_user, self.representation(record))
+        if response.status_code == 201:
+            return response.headers['Location'].rstrip('/').rsplit('/', 1)[-1], True
+        if response.status_code == 409:
+            # Created by an earlier, interrupted run
+            response = call_with_admin_token(self.client.find_users, username=record['username'], exact='true')
+            if response.status_code == 200 and response.json():
+                return response.json()[0]['id'], False
+        raise ProvisioningError(f'Keycloak answered {response.status_code}')
+
+    def partial_import(self, records):
+        try:
+            response = call_with_admin_token(self.client.partial_import, {
+                'ifResourceExists': 'SKIP',
+                'users': [self.representation(record) for record in records],
+            })
+        except AdminTokenError as e:
+            self.stderr.write(f'Partial import failed: {e}')
+            return {}
+        if response.status_code != 200:
+            self.stderr.write(f'Partial import failed: Keycloak answered {response.status_code}')
+            return {}
+
+        # Keycloak stores usernames in lower case
+        imported = {}
+        for result in response.json().get('results', []):
+            if result.get('resourceType') == 'USER':
+                imported[result['resourceName']] = result['id']
+                if result.get('action') == 'ADDED':
+                    self.stats['keycloak_created'] += 1
+        return {
+            record['username']: imported[record['username'].lower()]
+            for record in records
+            if record['username'].lower() in imported
+        }
+
+    def representation(self, record):
+        representation = {
+            'username': record['username'],
+            'email': record.get('email'),
+            'firstName': record.get('first_name'),
+            'lastName': record.get('last_name'),
+            'enabled': True,
+            'emailVerified': parse_bool(record.get('email_verified', True)),
+        }
+        if record.get('password'):
+            representation['credentials'] = [
+                {'type': 'password', 'value': record['password'], 'temporary': False}
+            ]
+        return {key: value for key, value in representation.items() if value is not None}
+
+    def upsert(self, rows, existing):
+        try:
+            with transaction.atomic():
+                user_ids = self.write_rows(rows)
+        except IntegrityError as e:
+            # Usually a keycloak_id already linked to another user, write the
+            # records one at a time to reject only those in conflict
+            self.stderr.write(f'Batch rejected by the database, writing its records one by one: {e}')
+            user_ids = {}
+            written = []
+            for row in rows:
+                try:
+                    with transaction.atomic():
+                        user_ids.update(self.write_rows([row]))
+                except IntegrityError as e:
+                    self.stats['failed'] += 1
+                    self.stderr.write(f"Failed to write {row[0]['username']}: {e}")
+                else:
+                    written.append(row)
+            rows = written
+
+        records = [record for record, _ in rows]
+        # bulk_create sends no signals, drop cached copies of updated users ourselves
+        user_cache.delete_many([keycloak_id for record, keycloak_id in rows if record['username'] in existing])
+        profile_cache.delete_many([user_ids[record['username']] for record in records if record['username'] in existing])
+        updated = sum(1 for record in records if record['username'] in existing)
+        self.stats['updated'] += updated
+        self.stats['created'] += len(records) - updated
+
+    def write_rows(self, rows):
+        """
+        Upsert the users and profiles of ``rows``, returning their user ids.
+
+        Existing users only get the columns their record has: records are
+        written in groups sharing the same optional fields, so a record
+        without a phone number doesn't clear the one on file.
+        """
+        groups = defaultdict(list)
+        for record, keycloak_id in rows:
+            fields = (
+                tuple(field for field in USER_FIELDS if field in record),
+                tuple(field for field in PROFILE_FIELDS if field in record),
+            )
+            groups[fields].append((record, keycloak_id))
+
+        user_ids = {}
+        for (user_fields, profile_fields), group in groups.items():
+            records = [record for record, _ in group]
+            users = [
+                User(
+                    username=record['username'],
+                    email=User.objects.normalize_email(record.get('email', '')),
+                    first_name=record.get('first_name', ''),
+                    last_name=record.get('last_name', ''),
+                    # Keycloak owns the credentials
+                    password=make_password(None),
+                )
+                for record in records
+            ]
+            if user_fields:
+                User.objects.bulk_create(users, update_conflicts=True, unique_fields=['username'],
+                                         update_fields=list(user_fields))
+            else:
+                User.objects.bulk_create(users, ignore_conflicts=True)
+
+            group_ids = dict(
+                User.objects.filter(username__in=[record['username'] for record in records]).values_list('username', 'id')
+            )
+            UserProfile.objects.bulk_create(
+                [
+                    UserProfile(
+                        user_id=group_ids[record['username']],
+                        keycloak_id=keycloak_id,
+                        phone_number=record.get('phone_number'),
+                        mfa_enabled=parse_bool(record.get('mfa_enabled', False)),
+                    )
+                    for record, keycloak_id in group
+                ],
+                update_conflicts=True,
+                unique_fields=['user'],
+                update_fields=['keycloak_id', 'updated_at', *profile_fields],
+            )
+            user_ids.update(group_ids)
+        return user_ids
+
+    def report(self, processed, imported, started):
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f"{processed} records processed, {self.stats['created']} created, {self.stats['updated']} updated, "
+            f"{self.stats['failed']} failed, {imported / elapsed if elapsed else 0:.0f} records/s"
+        )
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
@@ -0,0 +1,61 @@
+# Generated by Django 5.0.2 on 2026-10-18 16:35
+
+from django.db import migrations, models
+
+CONSTRAINT_NAME = 'users_userprofile_keycloak_id_key'
+
+
+def blank_keycloak_ids_to_null(apps, schema_editor):
+    # Unlinked profiles may hold '' instead of NULL, which the unique index
+    # would count as duplicates
+    UserProfile = apps.get_model('users', 'UserProfile')
+    UserProfile.objects.filter(keycloak_id='').update(keycloak_id=None)
+
+
+def create_unique_index(apps, schema_editor):
+    table = schema_editor.quote_name('users_userprofile')
+    column = schema_editor.quote_name('keycloak_id')
+    if schema_editor.connection.vendor == 'postgresql':
+        # Don't block profile writes while the index is built on a large
+        # table. An earlier build that failed leaves an invalid index behind.
+        # Turning the index into the constraint takes only a brief lock
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {CONSTRAINT_NAME}')
+        schema_editor.execute(f'CREATE UNIQUE INDEX CONCURRENTLY {CONSTRAINT_NAME} ON {table} ({column})')
+        schema_editor.execute(
+            f'ALTER TABLE {table} ADD CONSTRAINT {CONSTRAINT_NAME} UNIQUE USING INDEX {CONSTRAINT_NAME}')
+    else:
+        schema_editor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {CONSTRAINT_NAME} ON {table} ({column})')
+
+
+def drop_unique_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        table = schema_editor.quote_name('users_userprofile')
+        schema_editor.execute(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {CONSTRAINT_NAME}')
+    else:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {CONSTRAINT_NAME}')
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(blank_keycloak_ids_to_null, migrations.RunPython.noop),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_unique_index, drop_unique_index),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='userprofile',
+                    name='keycloak_id',
+                    field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+                ),
+            ],
+        ),
+    ]
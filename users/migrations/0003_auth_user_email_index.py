@@ -0,0 +1,39 @@
+from django.db import migrations
+
+INDEX_NAME = 'users_auth_user_email_upper'
+
+
+def create_email_index(apps, schema_editor):
+    # auth_user belongs to django.contrib.auth, so the index can't be declared
+    # on the model. Lookups compare UPPER(email) (users.models.email_is),
+    # which this index serves on PostgreSQL and SQLite alike
+    table = schema_editor.quote_name('auth_user')
+    column = schema_editor.quote_name('email')
+    if schema_editor.connection.vendor == 'postgresql':
+        # Don't block logins while the index is built on a large table
+        schema_editor.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDEX_NAME} ON {table} (UPPER({column}))')
+    else:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {INDEX_NAME} ON {table} (UPPER({column}))')
+
+
+def drop_email_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}')
+    else:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {INDEX_NAME}')
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0002_unique_keycloak_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_email_index, drop_email_index),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations
+
+OLD_INDEX_NAME = 'users_auth_user_email_upper'
+INDEX_NAME = 'users_auth_user_email_upper_pattern'
+
+
+def create_pattern_index(apps, schema_editor):
+    # Under a collation other than C, PostgreSQL only serves the user
+    # directory's email prefix search (UPPER(email) LIKE 'PREFIX%') from an
+    # index with the pattern operator class. That index also serves the
+    # equality lookups of users.models.email_is, so it replaces the one of
+    # migration 0003. SQLite has no operator classes and keeps that one
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name('auth_user')
+    column = schema_editor.quote_name('email')
+    # An earlier build that failed leaves an invalid index behind
+    schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}')
+    schema_editor.execute(
+        f'CREATE INDEX CONCURRENTLY {INDEX_NAME} ON {table} (UPPER({column}) text_pattern_ops)')
+    schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {OLD_INDEX_NAME}')
+
+
+def drop_pattern_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name('auth_user')
+    column = schema_editor.quote_name('email')
+    schema_editor.execute(
+        f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {OLD_INDEX_NAME} ON {table} (UPPER({column}))')
+    schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}')
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('users', '0004_userprofile_created_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_pattern_index, drop_pattern_index),
+    ]
@@ -1,24 +1,190 @@
-from django.db import models
+from django.db import connections, models, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models import BooleanField, ExpressionWrapper, Q, Value
+from django.db.models.functions import Upper
+from django.db.models.lookups import Exact
+from django.db.models.signals import post_delete, post_init, post_save
+from django.db.models.sql import UpdateQuery
 from django.dispatch import receiver
+from django.utils import timezone
+from .cache import cache_profile, invalidate_profile, invalidate_user
+
+def can_return_rows_from_update(connection):
+    """
+    Whether UPDATE ... RETURNING works on the connection. Django has no
+    feature flag for it: MariaDB and Oracle can return columns from an INSERT
+    but not with this syntax from an UPDATE, SQLite can since 3.35 like it
+    can from an INSERT
+    """
+    if connection.vendor == 'sqlite':
+        return connection.features.can_return_columns_from_insert
+    return connection.vendor == 'postgresql'
+
+class UserProfileQuerySet(models.QuerySet):
+    def update_returning(self, user_fields=(), **values):
+        """
+        update() that also returns the updated rows, as read back by the
+        UPDATE statement itself (RETURNING) where the database supports it.
+        The ``user_fields`` of their users are read back along with them.
+
+        auto_now fields are set like save() would. Like update(), no signals
+        are sent.
+        """
+        if self.query.is_sliced:
+            raise TypeError('Cannot update a query once a slice has been taken.')
+        fields = self.model._meta.concrete_fields
+        for field in fields:
+            if getattr(field, 'auto_now', False):
+                values.setdefault(field.name, timezone.now())
+        # Route to the write database, as update() does
+        self._for_write = True
+        connection = connections[self.db]
+        if not can_return_rows_from_update(connection):
+            with transaction.atomic(using=self.db):
+                pks = list(self.select_for_update().values_list('pk', flat=True))
+                self.model._base_manager.using(self.db).filter(pk__in=pks).update(**values)
+                updated = self.model._base_manager.using(self.db).filter(pk__in=pks)
+                if user_fields:
+                    updated = updated.select_related('user').only(
+                        *(field.name for field in fields), *(f'user__{name}' for name in user_fields))
+                return list(updated)
+
+        query = self.query.chain(UpdateQuery)
+        query.add_update_values(values)
+        # Neither is used by an UPDATE, and annotations would end up in subqueries
+        query.clear_ordering(force=True)
+        query.annotations = {}
+        compiler = query.get_compiler(self.db)
+        sql, params = compiler.as_sql()
+        quote_name = connection.ops.quote_name
+        columns = [quote_name(field.column) for field in fields]
+        # Users are read by subqueries, an UPDATE can't join
+        user_table = quote_name(User._meta.db_table)
+        user_link = f'{user_table}.{quote_name(User._meta.pk.column)} = ' \
+            f'{quote_name(self.model._meta.db_table)}.{quote_name(self.model.user.field.column)}'
+        related = [User._meta.get_field(name) for name in user_fields]
+        columns += [f'(SELECT {quote_name(field.column)} FROM {user_table} WHERE {user_link})' for field in related]
+        with transaction.mark_for_rollback_on_error(using=self.db), connection.cursor() as cursor:
+            cursor.execute(f'{sql} RETURNING {", ".join(columns)}', params)
+            rows = cursor.fetchall()
+        self._result_cache = None
+        converters = compiler.get_converters([field.get_col(self.model._meta.db_table) for field in fields]
+                                             + [field.get_col(User._meta.db_table) for field in related])
+        if converters:
+            rows = compiler.apply_converters(rows, converters)
+        names = [field.attname for field in fields]
+        profiles = []
+        for row in rows:
+            row = list(row)
+            profile = self.model.from_db(self.db, names, row[:len(names)])
+            if related:
+                profile.user = User.from_db(self.db, [User._meta.pk.attname] + [field.attname for field in related],
+                                            [profile.user_id] + row[len(names):])
+            profiles.append(profile)
+        return profiles
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    keycloak_id = models.CharField(max_length=255, blank=True, null=True)
+    # Keycloak subject (sub) of the user, NULL until linked
+    keycloak_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
     mfa_enabled = models.BooleanField(default=False)
     phone_number = models.CharField(max_length=20, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = UserProfileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the user directory, newest first
+            models.Index(fields=['created_at', 'id'], name='users_profile_created_id'),
+        ]
+
+    # Update value flipping mfa_enabled in the database
+    TOGGLE_MFA = ExpressionWrapper(~Q(mfa_enabled=True), output_field=BooleanField())
+
     def __str__(self):
         return f"{self.user.username}'s profile"
 
+def email_is(email):
+    """
+    Case-insensitive match on User.email for filter() and Q(), served by the
+    UPPER(email) index of migration 0003
+    """
+    return Exact(Upper('email'), Upper(Value(email)))
+
+def get_user_by_subject(keycloak_id):
+    """
+    User, with its profile, linked to the Keycloak subject (the token's sub)
+    through the unique keycloak_id index; None if there is none
+    """
+    try:
+        return User.objects.select_related('userprofile').get(userprofile__keycloak_id=keycloak_id)
+    except User.DoesNotExist:
+        return None
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
-        UserProfile.objects.create(user=instance)
+        # Users provisioned from a Keycloak token carry their subject along
+        UserProfile.objects.create(user=instance, keycloak_id=getattr(instance, 'keycloak_id', None))
+
+# User fields the profile payload carries
+PROFILE_USER_FIELDS = ('username', 'email')
+# User fields the permissions of a cached user depend on
+ACCESS_USER_FIELDS = ('is_active', 'is_staff', 'is_superuser')
+
+def tracked_user_fields(user):
+    # Deferred fields are left out rather than loaded
+    return {name: user.__dict__[name] for name in PROFILE_USER_FIELDS + ACCESS_USER_FIELDS if name in user.__dict__}
+
+@receiver(post_init, sender=User)
+def remember_tracked_user_fields(sender, instance, **kwargs):
+    # Lets post_save tell what changed without a query
+    instance._tracked_user_fields = tracked_user_fields(instance)
 
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    instance.userprofile.save() 
\ No newline at end of file
+def invalidate_cached_user_of_user(sender, instance, created, update_fields=None, **kwargs):
+    # New users aren't cached yet and a stale last_login doesn't matter
+    if created or (update_fields is not None and set(update_fields) <= {'last_login'}):
+        return
+    current = tracked_user_fields(instance)
+    previous = instance._tracked_user_fields
+    changed = {name for name, value in current.items() if name not in previous or previous[name] != value}
+    if update_fields is not None:
+        changed &= set(update_fields)
+    instance._tracked_user_fields = current
+
+    profile_cached = User.userprofile.is_cached(instance)
+    if changed & set(PROFILE_USER_FIELDS):
+        # The profile payload carries them, and its Last-Modified is the
+        # profile's updated_at: move it along, reading the keycloak_id back
+        invalidate_profile(instance.pk)
+        profiles = UserProfile.objects.filter(user_id=instance.pk).update_returning()
+        keycloak_id = profiles[0].keycloak_id if profiles else None
+        if profiles and profile_cached:
+            instance.userprofile.updated_at = profiles[0].updated_at
+    elif profile_cached:
+        keycloak_id = instance.userprofile.keycloak_id
+    elif changed:
+        keycloak_id = UserProfile.objects.filter(user_id=instance.pk).values_list('keycloak_id', flat=True).first()
+    else:
+        # Other fields of a cached user catch up within USER_CACHE_TTL
+        return
+    invalidate_user(keycloak_id)
+
+@receiver(post_save, sender=UserProfile)
+def update_cached_profile(sender, instance, **kwargs):
+    profile_changed(instance)
+
+def profile_changed(profile):
+    """
+    Refresh the caches holding a profile after it was saved or updated
+    """
+    invalidate_user(profile.keycloak_id)
+    cache_profile(profile)
+
+@receiver(post_delete, sender=UserProfile)
+def invalidate_cached_user(sender, instance, **kwargs):
+    invalidate_user(instance.keycloak_id)
+    invalidate_profile(instance.user_id)
@@ -0,0 +1,101 @@
+import base64
+import binascii
+import json
+
+from django.db.models import DateTimeField, Field, Func, Value
+from django.db.models.lookups import LessThan
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class Row(Func):
+    """
+    Row value, compared column by column: (created_at, id) < (%s, %s)
+    """
+
+    template = '(%(expressions)s)'
+
+    def __init__(self, *expressions):
+        super().__init__(*expressions, output_field=Field())
+
+
+class KeysetPagination(BasePagination):
+    """
+    Newest first pagination of profiles on (created_at, id).
+
+    The cursor is the position of the last row of the page, and the next page
+    is read from the (created_at, id) index right after it, so any page costs
+    the same single query as the first one. There is no total count and no
+    going back, clients follow ``next`` until it is null.
+    """
+
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+        if position is not None:
+            created_at, pk = position
+            # PostgreSQL seeks the index straight to the row after the cursor,
+            # created_at < %s OR (created_at = %s AND id < %s) would only be
+            # bounded on created_at
+            queryset = queryset.filter(LessThan(
+                Row('created_at', 'pk'), Row(Value(created_at, output_field=DateTimeField()), Value(pk))))
+        # One more row than the page tells whether there is a next page
+        rows = list(queryset.order_by('-created_at', '-pk')[:page_size + 1])
+        page = rows[:page_size]
+        self.next_position = (page[-1].created_at, page[-1].pk) if len(rows) > page_size else None
+        return page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            created_at, pk = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (binascii.Error, TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None or timezone.is_naive(created_at):
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def encode_cursor(self, position):
+        created_at, pk = position
+        encoded = base64.urlsafe_b64encode(json.dumps([created_at.isoformat(), pk]).encode('ascii'))
+        return encoded.decode('ascii')
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,47 @@
+from rest_framework import serializers
+
+from .models import UserProfile
+
+
+class ProfileUpdateSerializer(serializers.Serializer):
+    """
+    Partial profile update (PATCH), at least one field is required
+    """
+
+    mfa_enabled = serializers.BooleanField(required=False)
+    phone_number = serializers.CharField(max_length=20, required=False, allow_null=True)
+
+    def validate(self, attrs):
+        unknown = set(self.initial_data) - set(self.fields)
+        if unknown:
+            raise serializers.ValidationError({field: ['This field cannot be updated.'] for field in sorted(unknown)})
+        if not attrs:
+            raise serializers.ValidationError('No profile fields to update.')
+        return attrs
+
+
+class DirectoryFilterSerializer(serializers.Serializer):
+    """
+    Filters of the user directory, all optional
+    """
+
+    email = serializers.CharField(required=False, help_text='Email prefix, in any letter case')
+    mfa_enabled = serializers.BooleanField(required=False)
+    keycloak_id = serializers.CharField(required=False)
+
+
+class DirectoryUserSerializer(serializers.ModelSerializer):
+    """
+    User directory entry, read from a profile and its user
+    """
+
+    id = serializers.IntegerField(source='user.id')
+    username = serializers.CharField(source='user.username')
+    email = serializers.EmailField(source='user.email')
+    is_active = serializers.BooleanField(source='user.is_active')
+
+    class Meta:
+        model = UserProfile
+        fields = ['id', 'username', 'email', 'is_active', 'keycloak_id', 'mfa_enabled', 'phone_number',
+                  'created_at']
+        read_only_fields = fields
@@ -0,0 +1,167 @@
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import AsyncRequestFactory, TestCase
+from rest_framework import status
+from rest_framework.authentication import SessionAuthentication
+
+from api.authentication import KeycloakAuthentication
+from api.keycloak import KeycloakUnavailable
+from users import async_views
+from users.models import UserProfile
+from users.tests.factories import UserFactory
+
+
+class TestAsyncUserViews(TestCase):
+    def setUp(self):
+        # The authentication of the production settings, bearer tokens then
+        # sessions; views take theirs from the settings when they are imported
+        for view in (async_views.get_user_profile, async_views.toggle_mfa, async_views.update_phone):
+            patcher = mock.patch.object(view.cls, 'authentication_classes',
+                                        [KeycloakAuthentication, SessionAuthentication])
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.factory = AsyncRequestFactory()
+        self.user = UserFactory()
+        self.authenticated_user = self.user
+        patcher = mock.patch('api.authentication.KeycloakAuthentication.aauthenticate',
+                             side_effect=self.aauthenticate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def aauthenticate(self, request):
+        if 'Authorization' not in request.headers:
+            return None
+        return (self.authenticated_user, 'token')
+
+    def get(self, path, **headers):
+        return self.factory.get(path, headers={'Authorization': 'Bearer token', **headers})
+
+    def post(self, path, data=None, **headers):
+        return self.factory.post(path, json.dumps(data or {}), content_type='application/json',
+                                 headers={'Authorization': 'Bearer token', **headers})
+
+    async def test_get_user_profile(self):
+        """Test getting the user profile from the async view"""
+        response = await async_views.get_user_profile(self.get('/users/api/profile/'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertEqual(data['username'], self.user.username)
+        self.assertFalse(data['mfa_enabled'])
+
+    async def test_profile_loaded_when_not_cached(self):
+        """Test that a user without a cached profile has it loaded with the async ORM"""
+        self.authenticated_user = await User.objects.aget(pk=self.user.pk)
+        response = await async_views.get_user_profile(self.get('/users/api/profile/'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    async def test_unauthenticated(self):
+        """Test that requests without a bearer token are rejected"""
+        response = await async_views.get_user_profile(self.factory.get('/users/api/profile/'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.headers['WWW-Authenticate'], 'Bearer')
+
+    async def test_session_authenticated(self):
+        """Test that session clients are authenticated as by the sync views"""
+        request = self.factory.get('/users/api/profile/')
+        # Set by AuthenticationMiddleware from the session
+        request.user = self.user
+        response = await async_views.get_user_profile(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['username'], self.user.username)
+
+    async def test_session_csrf_enforced(self):
+        """Test that session-authenticated writes still need a CSRF token"""
+        request = self.factory.post('/users/api/toggle-mfa/', '{}', content_type='application/json')
+        request.user = self.user
+        response = await async_views.toggle_mfa(request)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertIn('CSRF', json.loads(response.content)['detail'])
+
+    async def test_keycloak_unavailable(self):
+        """Test that an open Keycloak circuit during authentication is reported as 503"""
+        self.authenticated_user = None
+        with mock.patch('api.authentication.KeycloakAuthentication.aauthenticate',
+                        side_effect=KeycloakUnavailable('userinfo', 5)):
+            response = await async_views.get_user_profile(self.get('/users/api/profile/'))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers['Retry-After'], '5')
+
+    async def test_toggle_mfa(self):
+        """Test that toggling MFA is saved"""
+        response = await async_views.toggle_mfa(self.post('/users/api/toggle-mfa/'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(json.loads(response.content)['mfa_enabled'])
+        profile = await UserProfile.objects.aget(user_id=self.user.pk)
+        self.assertTrue(profile.mfa_enabled)
+
+    async def test_update_phone(self):
+        """Test that the phone number is saved"""
+        response = await async_views.update_phone(
+            self.post('/users/api/update-phone/', {'phone_number': '+1234567890'}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile = await UserProfile.objects.aget(user_id=self.user.pk)
+        self.assertEqual(profile.phone_number, '+1234567890')
+
+    async def test_update_phone_missing(self):
+        """Test that a phone number is required"""
+        response = await async_views.update_phone(self.post('/users/api/update-phone/'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_not_modified(self):
+        """Test that polling with the current ETag gets a 304"""
+        response = await async_views.get_user_profile(self.get('/users/api/profile/'))
+        etag = response.headers['ETag']
+        response = await async_views.get_user_profile(self.get('/users/api/profile/', If_None_Match=etag))
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    async def test_lost_update_prevented(self):
+        """Test that a write with an outdated If-Match is refused with 412"""
+        response = await async_views.get_user_profile(self.get('/users/api/profile/'))
+        etag = response.headers['ETag']
+        response = await async_views.toggle_mfa(self.post('/users/api/toggle-mfa/', If_Match=etag))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = await async_views.update_phone(
+            self.post('/users/api/update-phone/', {'phone_number': '+1234567890'}, If_Match=etag))
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        profile = await UserProfile.objects.aget(user_id=self.user.pk)
+        self.assertIsNone(profile.phone_number)
+
+    async def test_patch_profile(self):
+        """Test that the async view patches several fields at once"""
+        request = self.factory.patch('/users/api/profile/', json.dumps({'mfa_enabled': True, 'phone_number': '+1234'}),
+                                     content_type='application/json', headers={'Authorization': 'Bearer token'})
+        response = await async_views.get_user_profile(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertTrue(data['mfa_enabled'])
+        self.assertEqual(data['phone_number'], '+1234')
+        profile = await UserProfile.objects.aget(user_id=self.user.pk)
+        self.assertEqual(profile.phone_number, '+1234')
+
+    async def test_patch_profile_form(self):
+        """Test that a form-encoded PATCH body is parsed like a JSON one"""
+        request = self.factory.patch('/users/api/profile/', 'phone_number=%2B1234',
+                                     content_type='application/x-www-form-urlencoded',
+                                     headers={'Authorization': 'Bearer token'})
+        response = await async_views.get_user_profile(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['phone_number'], '+1234')
+        profile = await UserProfile.objects.aget(user_id=self.user.pk)
+        self.assertEqual(profile.phone_number, '+1234')
+
+    async def test_method_not_allowed(self):
+        """Test that other methods are refused with the view's allowed methods"""
+        request = self.factory.delete('/users/api/profile/', headers={'Authorization': 'Bearer token'})
+        response = await async_views.get_user_profile(request)
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        self.assertEqual(set(response.headers['Allow'].split(', ')), {'GET', 'PATCH', 'OPTIONS'})
+
+    async def test_patch_profile_invalid(self):
+        """Test that the async view validates the patch"""
+        request = self.factory.patch('/users/api/profile/', json.dumps({'mfa_enabled': 'maybe'}),
+                                     content_type='application/json', headers={'Authorization': 'Bearer token'})
+        response = await async_views.get_user_profile(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,105 @@
+import datetime
+from unittest import mock, skipUnless
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from users.models import UserProfile
+from users.pagination import KeysetPagination
+from users.tests.factories import UserFactory
+
+
+class TestUserDirectory(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.staff = UserFactory(is_staff=True)
+        self.client.force_authenticate(user=self.staff)
+        self.users = [UserFactory(username=f'member{i}', email=f'Member{i}@Example.com') for i in range(7)]
+        # Users created in the same instant only differ by id
+        start = timezone.now() - datetime.timedelta(days=1)
+        for i, user in enumerate([self.staff] + self.users):
+            UserProfile.objects.filter(user=user).update(created_at=start + datetime.timedelta(seconds=i // 3))
+
+    def pages(self, params):
+        url = reverse('user_directory')
+        pages = []
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append([entry['username'] for entry in response.data['results']])
+            url, params = response.data['next'], None
+        return pages
+
+    def test_pages_newest_first(self):
+        """Test that following next lists every user once, newest first, one query per page"""
+        pages = self.pages({'limit': 3})
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        expected = UserProfile.objects.order_by('-created_at', '-id').values_list('user__username', flat=True)
+        self.assertEqual(sum(pages, []), list(expected))
+
+    def test_entry(self):
+        """Test that entries carry the user and its profile"""
+        user = self.users[-1]
+        entry = self.client.get(reverse('user_directory'), {'limit': 1}).data['results'][0]
+        self.assertEqual(entry['id'], user.pk)
+        self.assertEqual(entry['username'], user.username)
+        self.assertEqual(entry['email'], user.email)
+        self.assertEqual(entry['mfa_enabled'], False)
+        self.assertIn('created_at', entry)
+
+    def test_filters(self):
+        """Test that users are filtered by email prefix in any letter case, MFA and Keycloak subject"""
+        UserProfile.objects.filter(user=self.users[1]).update(mfa_enabled=True, keycloak_id='kc-member1')
+        self.assertEqual(sum(self.pages({'email': 'member1@'}), []), ['member1'])
+        self.assertEqual(sum(self.pages({'mfa_enabled': 'true'}), []), ['member1'])
+        self.assertEqual(len(sum(self.pages({'mfa_enabled': 'false', 'limit': 2}), [])), 7)
+        self.assertEqual(sum(self.pages({'keycloak_id': 'kc-member1'}), []), ['member1'])
+        self.assertEqual(self.pages({'email': 'nobody'}), [[]])
+
+    def test_email_prefix_is_literal(self):
+        """Test that LIKE wildcards in the email prefix only match themselves"""
+        self.assertEqual(self.pages({'email': '%'}), [[]])
+
+    def test_invalid_filter(self):
+        """Test that unparseable filters are rejected"""
+        response = self.client.get(reverse('user_directory'), {'mfa_enabled': 'maybe'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('mfa_enabled', response.data)
+
+    def test_invalid_cursor(self):
+        """Test that cursors not handed out by the API are refused"""
+        for cursor in ['garbage', 'WzFd', 'WyIyMDI0LTAxLTAxVDAwOjAwOjAwIiwgMV0=']:
+            response = self.client.get(reverse('user_directory'), {'cursor': cursor})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, cursor)
+
+    def test_limit_capped(self):
+        """Test that the page size can't be raised past the maximum"""
+        with mock.patch.object(KeysetPagination, 'max_page_size', 2):
+            response = self.client.get(reverse('user_directory'), {'limit': 1000})
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_staff_only(self):
+        """Test that only staff can browse the directory"""
+        self.client.force_authenticate(user=self.users[0])
+        self.assertEqual(self.client.get(reverse('user_directory')).status_code, status.HTTP_403_FORBIDDEN)
+
+    @skipUnless(connection.vendor == 'sqlite', 'reads the SQLite query plan')
+    def test_page_read_from_index(self):
+        """Test that a deep page starts from the (created_at, id) index instead of sorting the table"""
+        paginator = KeysetPagination()
+        profile = UserProfile.objects.get(user=self.users[3])
+        request = mock.Mock(query_params={'cursor': paginator.encode_cursor((profile.created_at, profile.pk))})
+        with CaptureQueriesContext(connection) as queries:
+            paginator.paginate_queryset(UserProfile.objects.select_related('user'), request)
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {queries[0]["sql"]}')
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn('USING INDEX users_profile_created_id', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
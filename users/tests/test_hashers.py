@@ -0,0 +1,45 @@
+from io import StringIO
+
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, check_password, make_password
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from users.hashers import TunedPBKDF2PasswordHasher
+
+TUNED_HASHERS = [
+    'users.hashers.TunedPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+]
+
+
+@override_settings(PASSWORD_HASHERS=TUNED_HASHERS)
+class TestTunedPBKDF2PasswordHasher(TestCase):
+    @override_settings(PASSWORD_HASH_ITERATIONS=1000)
+    def test_configured_iterations(self):
+        """Test that new hashes use the tuned iteration count"""
+        encoded = make_password('secret')
+        self.assertTrue(encoded.startswith('pbkdf2_sha256$1000$'))
+        self.assertTrue(check_password('secret', encoded))
+
+    @override_settings(PASSWORD_HASH_ITERATIONS=0)
+    def test_default_iterations(self):
+        """Test that Django's iteration count is kept when nothing is tuned"""
+        self.assertEqual(TunedPBKDF2PasswordHasher().iterations, PBKDF2PasswordHasher.iterations)
+
+    @override_settings(PASSWORD_HASH_ITERATIONS=1000)
+    def test_existing_hashes_upgraded(self):
+        """Test that hashes made with another iteration count verify and get upgraded"""
+        legacy = PBKDF2PasswordHasher()
+        legacy.iterations = 2000
+        encoded = legacy.encode('secret', legacy.salt())
+        upgraded = []
+        self.assertTrue(check_password('secret', encoded, setter=upgraded.append))
+        self.assertEqual(len(upgraded), 1)
+
+    def test_benchmark_command(self):
+        """Test that the benchmark recommends an iteration count"""
+        out = StringIO()
+        call_command('benchmark_hashers', rounds=1, sample_iterations=1000, min_iterations=0,
+                     target_ms=10, stdout=out)
+        self.assertIn('TunedPBKDF2PasswordHasher', out.getvalue())
+        self.assertIn('PASSWORD_HASH_ITERATIONS=', out.getvalue())
@@ -0,0 +1,158 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+
+from api import admin_token
+from users.models import UserProfile
+from users.tests.factories import UserFactory
+
+
+def keycloak_response(status_code, json=None, headers=None):
+    response = mock.Mock(status_code=status_code, headers=headers or {})
+    response.json.return_value = json
+    return response
+
+
+class TestImportUsers(TestCase):
+    def setUp(self):
+        self.keycloak = mock.Mock()
+        self.keycloak.admin_token.return_value = keycloak_response(200, {'access_token': 'admin', 'expires_in': 60})
+        self.keycloak.create_user.side_effect = lambda token, rep: keycloak_response(
+            201, headers={'Location': f"http://keycloak/admin/realms/test/users/kc-{rep['username']}"})
+        for target in ('users.management.commands.import_users.get_client', 'api.admin_token.get_client'):
+            patcher = mock.patch(target, return_value=self.keycloak)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        admin_token._reset_after_fork()
+        cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def run_import(self, *args, **options):
+        out = StringIO()
+        call_command('import_users', *args, stdout=out, stderr=StringIO(), **options)
+        return out.getvalue()
+
+    def test_csv_import(self):
+        """Test that CSV records are created in Keycloak and Django"""
+        path = self.write('users.csv', 'username,email,phone_number\nalice,alice@example.com,+15550001\nbob,bob@example.com,\n')
+        output = self.run_import(path, batch_size=1)
+        alice = User.objects.get(username='alice')
+        self.assertEqual(alice.email, 'alice@example.com')
+        self.assertFalse(alice.has_usable_password())
+        self.assertEqual(alice.userprofile.keycloak_id, 'kc-alice')
+        self.assertEqual(alice.userprofile.phone_number, '+15550001')
+        self.assertEqual(User.objects.get(username='bob').userprofile.keycloak_id, 'kc-bob')
+        self.assertEqual(self.keycloak.create_user.call_count, 2)
+        self.assertIn('2 created, 0 updated', output)
+
+    def test_ndjson_partial_import(self):
+        """Test that NDJSON batches go through the partial import API"""
+        path = self.write('users.ndjson', '\n'.join(json.dumps(r) for r in [
+            {'username': 'Carol', 'email': 'carol@example.com'},
+            {'username': 'dave', 'email': 'dave@example.com', 'mfa_enabled': True},
+        ]))
+        self.keycloak.partial_import.return_value = keycloak_response(200, {'results': [
+            {'action': 'ADDED', 'resourceType': 'USER', 'resourceName': 'carol', 'id': 'kc-carol'},
+            {'action': 'SKIPPED', 'resourceType': 'USER', 'resourceName': 'dave', 'id': 'kc-dave'},
+        ]})
+        self.run_import(path, partial_import=True)
+        self.keycloak.partial_import.assert_called_once()
+        self.keycloak.create_user.assert_not_called()
+        self.assertEqual(User.objects.get(username='Carol').userprofile.keycloak_id, 'kc-carol')
+        self.assertTrue(User.objects.get(username='dave').userprofile.mfa_enabled)
+
+    def test_existing_users_updated(self):
+        """Test that linked users are updated in place without calling Keycloak"""
+        user = UserFactory(username='erin', email='old@example.com')
+        user.userprofile.keycloak_id = 'kc-erin'
+        user.userprofile.save()
+        path = self.write('users.csv', 'username,email\nerin,new@example.com\n')
+        output = self.run_import(path)
+        user.refresh_from_db()
+        self.assertEqual(user.email, 'new@example.com')
+        self.assertTrue(user.check_password('testpass123'))
+        self.keycloak.create_user.assert_not_called()
+        self.assertIn('0 created, 1 updated', output)
+
+    def test_existing_keycloak_user_linked(self):
+        """Test that users already in Keycloak are linked by username"""
+        self.keycloak.create_user.side_effect = None
+        self.keycloak.create_user.return_value = keycloak_response(409)
+        self.keycloak.find_users.return_value = keycloak_response(200, [{'id': 'kc-existing'}])
+        path = self.write('users.csv', 'username,email\nfrank,frank@example.com\n')
+        self.run_import(path)
+        self.assertEqual(User.objects.get(username='frank').userprofile.keycloak_id, 'kc-existing')
+
+    def test_duplicate_in_batch_fails(self):
+        """Test that a username repeated within a batch keeps its first record and counts the others as failed"""
+        path = self.write('users.csv', 'username,email\nalice,first@example.com\nbob,bob@example.com\n'
+                                       'alice,second@example.com\n')
+        output = self.run_import(path, batch_size=10)
+        self.assertEqual(User.objects.get(username='alice').email, 'first@example.com')
+        self.assertEqual(self.keycloak.create_user.call_count, 2)
+        self.assertIn('2 created, 0 updated, 2 new in Keycloak, 1 failed', output)
+
+    def test_failed_records_skipped(self):
+        """Test that records Keycloak rejects aren't written to Django"""
+        self.keycloak.create_user.side_effect = None
+        self.keycloak.create_user.return_value = keycloak_response(400)
+        path = self.write('users.csv', 'username,email\ngina,gina@example.com\n,nobody@example.com\n')
+        output = self.run_import(path)
+        self.assertFalse(User.objects.filter(username='gina').exists())
+        self.assertIn('2 failed', output)
+
+    def test_resume_from_checkpoint(self):
+        """Test that an interrupted import resumes after the last completed batch"""
+        path = self.write('users.csv', 'username,email\nhank,hank@example.com\nivy,ivy@example.com\n')
+        checkpoint = os.path.join(self.tmpdir.name, 'import.checkpoint')
+        with open(checkpoint, 'w') as f:
+            json.dump({'path': os.path.abspath(path), 'processed': 1}, f)
+        output = self.run_import(path, checkpoint=checkpoint)
+        self.assertIn('Resuming after 1 records', output)
+        self.assertFalse(User.objects.filter(username='hank').exists())
+        self.assertTrue(User.objects.filter(username='ivy').exists())
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)['processed'], 2)
+
+    def test_absent_fields_kept(self):
+        """Test that columns a record doesn't have, or leaves blank, keep their values on existing users"""
+        user = UserFactory(username='jane', email='jane@example.com', first_name='Jane')
+        UserProfile.objects.filter(user=user).update(keycloak_id='kc-jane', phone_number='+15550002',
+                                                     mfa_enabled=True)
+        path = self.write('users.csv', 'username,email,first_name,phone_number\n'
+                                       'jane,,,\n'
+                                       'kyle,kyle@example.com,Kyle,+15550003\n')
+        output = self.run_import(path)
+        user.refresh_from_db()
+        self.assertEqual((user.email, user.first_name), ('jane@example.com', 'Jane'))
+        self.assertEqual(user.userprofile.phone_number, '+15550002')
+        self.assertTrue(user.userprofile.mfa_enabled)
+        self.assertEqual(User.objects.get(username='kyle').userprofile.phone_number, '+15550003')
+        self.assertIn('1 created, 1 updated, 1 new in Keycloak, 0 failed', output)
+
+    def test_conflicting_keycloak_id_fails_record(self):
+        """Test that a record linked to another user's Keycloak subject fails without aborting its batch"""
+        UserProfile.objects.filter(user=UserFactory(username='liam')).update(keycloak_id='kc-taken')
+        path = self.write('users.ndjson', '\n'.join(json.dumps(r) for r in [
+            {'username': 'mia', 'keycloak_id': 'kc-taken'},
+            {'username': 'noah', 'keycloak_id': 'kc-noah'},
+        ]))
+        output = self.run_import(path)
+        self.assertFalse(User.objects.filter(username='mia').exists())
+        self.assertEqual(User.objects.get(username='noah').userprofile.keycloak_id, 'kc-noah')
+        self.assertEqual(UserProfile.objects.get(keycloak_id='kc-taken').user.username, 'liam')
+        self.assertIn('1 created, 0 updated, 0 new in Keycloak, 1 failed', output)
@@ -1,7 +1,16 @@
+import datetime
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
 import pytest
-from django.test import TestCase
+from django.contrib.auth.models import User, update_last_login
+from django.db import IntegrityError, connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from users.tests.factories import UserFactory, UserProfileFactory
-from users.models import UserProfile
+from users.models import UserProfile, can_return_rows_from_update, email_is, get_user_by_subject
+from users.cache import cache_user, get_cached_user
 
 class TestUserProfile(TestCase):
     def setUp(self):
@@ -37,4 +46,195 @@ class TestUserProfile(TestCase):
         profile_id = self.profile.id
         self.user.delete()
         with self.assertRaises(UserProfile.DoesNotExist):
-            UserProfile.objects.get(id=profile_id) 
\ No newline at end of file
+            UserProfile.objects.get(id=profile_id) 
+
+    def test_user_save_leaves_profile_alone(self):
+        """Test that saving a user doesn't write its profile again"""
+        self.user.first_name = 'Changed'
+        with self.assertNumQueries(1):
+            self.user.save()
+
+    def test_last_login_update_keeps_cached_user(self):
+        """Test that login touches don't query the profile or drop the cached user"""
+        self.profile.keycloak_id = 'kc-last-login'
+        self.profile.save()
+        user = User.objects.get(pk=self.user.pk)
+        cache_user('kc-last-login', self.user)
+        with self.assertNumQueries(1):
+            update_last_login(None, user)
+        self.assertIsNotNone(get_cached_user('kc-last-login'))
+
+    def test_user_save_without_profile(self):
+        """Test that saving a user loaded without its profile doesn't look the profile up"""
+        user = User.objects.get(pk=self.user.pk)
+        user.first_name = 'Changed'
+        user.set_password('new-password')
+        with self.assertNumQueries(1):
+            user.save()
+
+    def test_deactivation_drops_cached_user(self):
+        """Test that deactivating a user loaded without its profile drops its cached user"""
+        self.profile.keycloak_id = 'kc-deactivated'
+        self.profile.save()
+        cache_user('kc-deactivated', self.user)
+        user = User.objects.get(pk=self.user.pk)
+        user.is_active = False
+        with self.assertNumQueries(2):
+            user.save()
+        self.assertIsNone(get_cached_user('kc-deactivated'))
+
+    def test_email_change_reads_keycloak_id_back(self):
+        """Test that an email change bumps the profile and drops the cached user in one more query"""
+        self.profile.keycloak_id = 'kc-email'
+        self.profile.save()
+        cache_user('kc-email', self.user)
+        user = User.objects.get(pk=self.user.pk)
+        user.email = 'changed@example.com'
+        with self.assertNumQueries(2):
+            user.save()
+        self.assertIsNone(get_cached_user('kc-email'))
+
+
+class ReplicaRouter:
+    """
+    Reads from a replica that isn't configured, writes to the default database
+    """
+
+    def db_for_read(self, model, **hints):
+        return 'replica'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+
+class TestUpdateReturning(TestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.profile = self.user.userprofile
+
+    def test_returns_updated_rows(self):
+        """Test that the updated profiles come back from the UPDATE with database types"""
+        with self.assertNumQueries(1):
+            profiles = UserProfile.objects.filter(user=self.user).update_returning(
+                mfa_enabled=UserProfile.TOGGLE_MFA, phone_number='+15550001111')
+        self.assertEqual(len(profiles), 1)
+        profile = profiles[0]
+        self.assertEqual(profile.pk, self.profile.pk)
+        self.assertIs(profile.mfa_enabled, True)
+        self.assertEqual(profile.phone_number, '+15550001111')
+        self.assertIsInstance(profile.updated_at, datetime.datetime)
+        self.assertGreater(profile.updated_at, self.profile.updated_at)
+        self.assertEqual(profile.created_at, self.profile.created_at)
+
+    def test_user_fields(self):
+        """Test that the requested user fields are read back by the same UPDATE"""
+        User.objects.filter(pk=self.user.pk).update(email='changed@example.com')
+        with self.assertNumQueries(1):
+            [profile] = UserProfile.objects.filter(user=self.user).update_returning(
+                user_fields=('username', 'email'), mfa_enabled=True)
+            self.assertEqual(profile.user.email, 'changed@example.com')
+            self.assertEqual(profile.user.username, self.user.username)
+        self.assertTrue(profile.mfa_enabled)
+
+        with mock.patch('users.models.can_return_rows_from_update', return_value=False):
+            [profile] = UserProfile.objects.filter(user=self.user).update_returning(
+                user_fields=('username', 'email'), mfa_enabled=False)
+        self.assertEqual(profile.user.email, 'changed@example.com')
+
+    def test_no_rows(self):
+        """Test that an UPDATE matching nothing returns nothing"""
+        self.assertEqual(UserProfile.objects.filter(pk=0).update_returning(mfa_enabled=True), [])
+
+    def test_without_returning_support(self):
+        """Test the fallback for databases that can't return rows from an UPDATE"""
+        with mock.patch.object(connection.features, 'can_return_columns_from_insert', False):
+            profiles = UserProfile.objects.filter(user=self.user).update_returning(mfa_enabled=True)
+        self.assertTrue(profiles[0].mfa_enabled)
+        self.assertTrue(UserProfile.objects.get(pk=self.profile.pk).mfa_enabled)
+
+    def test_insert_returning_only(self):
+        """Test that databases returning rows only from an INSERT, like MariaDB, take the fallback"""
+        self.assertTrue(can_return_rows_from_update(SimpleNamespace(
+            vendor='postgresql', features=SimpleNamespace(can_return_columns_from_insert=True))))
+        self.assertFalse(can_return_rows_from_update(SimpleNamespace(
+            vendor='mysql', features=SimpleNamespace(can_return_columns_from_insert=True))))
+        with CaptureQueriesContext(connection) as queries, \
+                mock.patch('users.models.can_return_rows_from_update', return_value=False):
+            profiles = UserProfile.objects.filter(user=self.user).update_returning(mfa_enabled=True)
+        self.assertTrue(profiles[0].mfa_enabled)
+        self.assertFalse(any('RETURNING' in query['sql'] for query in queries))
+
+    def test_ordering_and_annotations_ignored(self):
+        """Test that ordered and annotated querysets update like update() would"""
+        profiles = (UserProfile.objects.filter(user=self.user).annotate(username=F('user__username'))
+                    .order_by('-username').update_returning(mfa_enabled=True))
+        self.assertEqual([profile.pk for profile in profiles], [self.profile.pk])
+        self.assertTrue(profiles[0].mfa_enabled)
+
+    @override_settings(DATABASE_ROUTERS=['users.tests.test_models.ReplicaRouter'])
+    def test_write_database(self):
+        """Test that the UPDATE goes to the database routed for writes, not the one for reads"""
+        profiles = UserProfile.objects.filter(user=self.user).update_returning(mfa_enabled=True)
+        self.assertTrue(profiles[0].mfa_enabled)
+
+
+class TestLookups(TestCase):
+    def test_keycloak_id_unique(self):
+        """Test that two profiles can't be linked to the same Keycloak subject"""
+        UserProfile.objects.filter(user=UserFactory()).update(keycloak_id='kc-taken')
+        with self.assertRaises(IntegrityError):
+            UserProfile.objects.filter(user=UserFactory()).update(keycloak_id='kc-taken')
+
+    def test_unlinked_profiles(self):
+        """Test that any number of profiles can be without a Keycloak subject"""
+        UserFactory()
+        UserFactory()
+        self.assertEqual(UserProfile.objects.filter(keycloak_id__isnull=True).count(), 2)
+
+    def test_get_user_by_subject(self):
+        """Test that the user and its profile are loaded by Keycloak subject in one query"""
+        user = UserFactory()
+        UserProfile.objects.filter(user=user).update(keycloak_id='kc-lookup')
+        with self.assertNumQueries(1):
+            found = get_user_by_subject('kc-lookup')
+            self.assertEqual(found.userprofile.keycloak_id, 'kc-lookup')
+        self.assertEqual(found.pk, user.pk)
+        self.assertIsNone(get_user_by_subject('kc-unknown'))
+
+    def test_email_is(self):
+        """Test that emails are matched in any letter case"""
+        user = UserFactory(email='Mixed.Case@Example.com')
+        self.assertEqual(list(User.objects.filter(email_is('mixed.case@example.COM'))), [user])
+        self.assertFalse(User.objects.filter(email_is('mixed.case@example.org')).exists())
+
+    @skipUnless(connection.vendor == 'sqlite', 'reads the SQLite query plan')
+    def test_indexes_used(self):
+        """Test that both lookups are served by an index instead of a table scan"""
+        plans = {}
+        for name, queryset in [
+            ('users_auth_user_email_upper', User.objects.filter(email_is('someone@example.com'))),
+            ('keycloak_id', UserProfile.objects.filter(keycloak_id='kc-plan')),
+        ]:
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                plans[name] = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn('USING INDEX users_auth_user_email_upper', plans['users_auth_user_email_upper'])
+        self.assertRegex(plans['keycloak_id'], r'USING INDEX \S+ \(keycloak_id=\?\)')
+
+    @skipUnless(connection.vendor == 'postgresql', 'operator classes are specific to PostgreSQL')
+    def test_email_indexes_used_on_postgresql(self):
+        """Test that email lookups and prefix searches are both served by the pattern index"""
+        plans = []
+        for queryset in [
+            User.objects.filter(email_is('someone@example.com')),
+            User.objects.filter(email__istartswith='some'),
+        ]:
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                # The test table is small enough for a scan to win otherwise
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {sql}', params)
+                plans.append(' '.join(row[0] for row in cursor.fetchall()))
+        for plan in plans:
+            self.assertIn('users_auth_user_email_upper_pattern', plan)
@@ -1,8 +1,17 @@
+import datetime
+from unittest import mock
+
 import pytest
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
+from users.cache import profile_cache, profile_entry, profile_etag
+from users.models import UserProfile
 from users.tests.factories import UserFactory, UserProfileFactory
 
 class TestUserViews(TestCase):
@@ -80,4 +89,233 @@ class TestUserViews(TestCase):
     #         {'phone_number': '+15550009999'},
     #         format='json'
     #     )
-    #     self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN) 
\ No newline at end of file
+    #     self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN) 
+
+class TestProfileCache(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = UserFactory()
+        cache.clear()
+        profile_cache.clear_local()
+        # A user without its profile loaded, as session authentication gives it
+        self.client.force_authenticate(user=User.objects.get(pk=self.user.pk))
+
+    def test_warm_read_skips_database(self):
+        """Test that a cached profile payload is served without queries"""
+        with self.assertNumQueries(1):
+            self.client.get(reverse('api_profile'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('api_profile'))
+        self.assertEqual(response.data['username'], self.user.username)
+
+    def test_shared_tier_read(self):
+        """Test that another worker's payload is picked up from the shared cache"""
+        self.client.get(reverse('api_profile'))
+        profile_cache.clear_local()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('api_profile'))
+        self.assertFalse(response.data['mfa_enabled'])
+
+    def test_writes_go_through(self):
+        """Test that toggling MFA and updating the phone number update the cached payload"""
+        self.client.get(reverse('api_profile'))
+        self.client.post(reverse('toggle_mfa'))
+        self.client.post(reverse('update_phone'), {'phone_number': '+15550002222'}, format='json')
+        profile_cache.clear_local()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('api_profile'))
+        self.assertTrue(response.data['mfa_enabled'])
+        self.assertEqual(response.data['phone_number'], '+15550002222')
+
+    def test_profile_save_elsewhere(self):
+        """Test that saving a profile without its user loaded drops the cached payload"""
+        self.client.get(reverse('api_profile'))
+        profile = UserProfile.objects.get(user=self.user)
+        profile.phone_number = '+15550003333'
+        profile.save()
+        self.assertIsNone(profile_cache.get(self.user.pk))
+
+    def test_user_save_invalidates(self):
+        """Test that changing the email drops the cached payload"""
+        self.client.get(reverse('api_profile'))
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        self.assertIsNone(profile_cache.get(self.user.pk))
+
+    def test_stale_read_not_cached(self):
+        """Test that a payload read before a write can't replace the written one"""
+        stale = profile_entry(self.user, self.user.userprofile)
+        self.client.post(reverse('toggle_mfa'))
+        self.assertFalse(profile_cache.add(self.user.pk, stale, 60))
+        self.assertTrue(profile_cache.get(self.user.pk)['payload']['mfa_enabled'])
+
+    def stale_worker_user(self):
+        """
+        The user as another worker still has it in its in-process user cache
+        after this one changed the email
+        """
+        stale = User.objects.select_related('userprofile').get(pk=self.user.pk)
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        return stale
+
+    def test_stale_local_user_read(self):
+        """Test that a worker with a stale cached user fills the shared tier from the database"""
+        self.client.force_authenticate(user=self.stale_worker_user())
+        response = self.client.get(reverse('api_profile'))
+        self.assertEqual(response.data['email'], 'changed@example.com')
+        profile_cache.clear_local()
+        self.assertEqual(profile_cache.get(self.user.pk)['payload']['email'], 'changed@example.com')
+
+    def test_stale_local_user_write(self):
+        """Test that a write from a worker with a stale cached user caches the current email"""
+        self.client.force_authenticate(user=self.stale_worker_user())
+        with self.assertNumQueries(1):
+            response = self.client.post(reverse('toggle_mfa'))
+        self.assertEqual(response.headers['ETag'], self.client.get(reverse('api_profile')).headers['ETag'])
+        profile_cache.clear_local()
+        entry = profile_cache.get(self.user.pk)
+        self.assertEqual(entry['payload']['email'], 'changed@example.com')
+        self.assertTrue(entry['payload']['mfa_enabled'])
+
+
+class TestConditionalRequests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = UserFactory()
+        cache.clear()
+        profile_cache.clear_local()
+        self.client.force_authenticate(user=self.user)
+
+    def test_validators_sent(self):
+        """Test that profile reads carry a strong ETag and Last-Modified"""
+        response = self.client.get(reverse('api_profile'))
+        self.assertRegex(response.headers['ETag'], r'^"[0-9a-f]+"$')
+        self.assertEqual(response.headers['Last-Modified'],
+                         http_date(int(self.user.userprofile.updated_at.timestamp())))
+
+    def test_not_modified(self):
+        """Test that polling with the current ETag gets an empty 304 without serializing the profile"""
+        etag = self.client.get(reverse('api_profile')).headers['ETag']
+        with mock.patch('users.views.Response') as serialize, self.assertNumQueries(0):
+            response = self.client.get(reverse('api_profile'), HTTP_IF_NONE_MATCH=etag)
+        serialize.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    def test_if_modified_since(self):
+        """Test that Last-Modified can be used for polling as well"""
+        last_modified = self.client.get(reverse('api_profile')).headers['Last-Modified']
+        response = self.client.get(reverse('api_profile'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_last_modified_follows_user(self):
+        """Test that changing the email moves Last-Modified along with the ETag"""
+        # Last-Modified has a one second resolution
+        UserProfile.objects.filter(user=self.user).update(updated_at=timezone.now() - datetime.timedelta(hours=1))
+        self.user.userprofile.refresh_from_db()
+        last_modified = self.client.get(reverse('api_profile')).headers['Last-Modified']
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        response = self.client.get(reverse('api_profile'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['email'], 'changed@example.com')
+        self.assertGreater(parse_http_date(response.headers['Last-Modified']), parse_http_date(last_modified))
+
+    def test_changed_after_write(self):
+        """Test that a write changes the ETag and the old one gets the full profile again"""
+        etag = self.client.get(reverse('api_profile')).headers['ETag']
+        write = self.client.post(reverse('toggle_mfa'))
+        self.assertNotEqual(write.headers['ETag'], etag)
+        response = self.client.get(reverse('api_profile'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers['ETag'], write.headers['ETag'])
+        self.assertTrue(response.data['mfa_enabled'])
+
+    def test_if_match(self):
+        """Test that a write based on the current version succeeds"""
+        etag = self.client.get(reverse('api_profile')).headers['ETag']
+        response = self.client.post(reverse('update_phone'), {'phone_number': '+15550004444'}, format='json',
+                                    HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(UserProfile.objects.get(user=self.user).phone_number, '+15550004444')
+
+    def test_lost_update_prevented(self):
+        """Test that a write based on an outdated version is refused with 412"""
+        etag = self.client.get(reverse('api_profile')).headers['ETag']
+        other = APIClient()
+        other.force_authenticate(user=User.objects.get(pk=self.user.pk))
+        self.assertEqual(other.post(reverse('toggle_mfa'), HTTP_IF_MATCH=etag).status_code, status.HTTP_200_OK)
+
+        response = self.client.post(reverse('update_phone'), {'phone_number': '+15550005555'}, format='json',
+                                    HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertTrue(profile.mfa_enabled)
+        self.assertIsNone(profile.phone_number)
+        self.assertEqual(response.headers['ETag'], profile_etag(self.user, profile))
+
+
+class TestProfilePatch(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+
+    def patch(self, data, **extra):
+        return self.client.patch(reverse('api_profile'), data, format='json', **extra)
+
+    def test_several_fields_one_statement(self):
+        """Test that several fields are updated by one UPDATE returning the new profile"""
+        with self.assertNumQueries(1):
+            response = self.patch({'mfa_enabled': True, 'phone_number': '+15550006666'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            'username': self.user.username,
+            'email': self.user.email,
+            'mfa_enabled': True,
+            'phone_number': '+15550006666',
+        })
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(response.headers['ETag'], profile_etag(self.user, profile))
+        self.assertTrue(profile.mfa_enabled)
+
+    def test_cached_payload_updated(self):
+        """Test that the patched profile is written through to the profile cache"""
+        self.patch({'phone_number': '+15550007777'})
+        profile_cache.clear_local()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('api_profile'))
+        self.assertEqual(response.data['phone_number'], '+15550007777')
+
+    def test_phone_number_cleared(self):
+        """Test that the phone number can be removed"""
+        self.patch({'phone_number': '+15550008888'})
+        response = self.patch({'phone_number': None})
+        self.assertIsNone(response.data['phone_number'])
+
+    def test_invalid_payload(self):
+        """Test that invalid, unknown or missing fields are rejected"""
+        self.assertEqual(self.patch({'phone_number': '+1' * 20}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.patch({'mfa_enabled': 'maybe'}).status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.patch({'keycloak_id': 'someone-else'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('keycloak_id', response.data)
+        self.assertEqual(self.patch({}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIsNone(UserProfile.objects.get(user=self.user).keycloak_id)
+
+    def test_if_match(self):
+        """Test that a patch based on an outdated version is refused"""
+        etag = self.client.get(reverse('api_profile')).headers['ETag']
+        self.assertEqual(self.patch({'mfa_enabled': True}, HTTP_IF_MATCH=etag).status_code, status.HTTP_200_OK)
+        response = self.patch({'mfa_enabled': False}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertTrue(UserProfile.objects.get(user=self.user).mfa_enabled)
+
+    def test_toggle_uses_stored_value(self):
+        """Test that toggling MFA flips the stored value, not the one the request loaded"""
+        UserProfile.objects.filter(user=self.user).update(mfa_enabled=True)
+        response = self.client.post(reverse('toggle_mfa'))
+        self.assertFalse(response.data['mfa_enabled'])
+        self.assertFalse(UserProfile.objects.get(user=self.user).mfa_enabled)
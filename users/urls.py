@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# Under ASGI the profile API is served by native async views
+api_views = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
     path('profile/', views.profile_view, name='profile'),
-    path('api/profile/', views.get_user_profile, name='api_profile'),
-    path('api/toggle-mfa/', views.toggle_mfa, name='toggle_mfa'),
-    path('api/update-phone/', views.update_phone, name='update_phone'),
+    path('api/profile/', api_views.get_user_profile, name='api_profile'),
+    path('api/toggle-mfa/', api_views.toggle_mfa, name='toggle_mfa'),
+    path('api/update-phone/', api_views.update_phone, name='update_phone'),
 ] 
\ No newline at end of file
@@ -3,10 +3,14 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
+from .cache import get_profile_entry, profile_entry
+from .conditional import not_modified, set_profile_validators, set_validators, update_profile
 from .models import UserProfile
+from .pagination import KeysetPagination
+from .serializers import DirectoryFilterSerializer, DirectoryUserSerializer, ProfileUpdateSerializer
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
@@ -22,6 +26,17 @@ bearer_auth = openapi.Parameter(
     required=True
 )
 
+# Profile payload of the profile API
+profile_schema = openapi.Schema(
+    type=openapi.TYPE_OBJECT,
+    properties={
+        'username': openapi.Schema(type=openapi.TYPE_STRING),
+        'email': openapi.Schema(type=openapi.TYPE_STRING, format=openapi.FORMAT_EMAIL),
+        'mfa_enabled': openapi.Schema(type=openapi.TYPE_BOOLEAN),
+        'phone_number': openapi.Schema(type=openapi.TYPE_STRING),
+    }
+)
+
 def profile_view(request):
     return render(request, 'users/profile.html')
 
@@ -30,16 +45,9 @@ def profile_view(request):
     responses={
         200: openapi.Response(
             description='User profile retrieved successfully',
-            schema=openapi.Schema(
-                type=openapi.TYPE_OBJECT,
-                properties={
-                    'username': openapi.Schema(type=openapi.TYPE_STRING),
-                    'email': openapi.Schema(type=openapi.TYPE_STRING, format=openapi.FORMAT_EMAIL),
-                    'mfa_enabled': openapi.Schema(type=openapi.TYPE_BOOLEAN),
-                    'phone_number': openapi.Schema(type=openapi.TYPE_STRING),
-                }
-            )
+            schema=profile_schema
         ),
+        304: 'Profile unchanged since the ETag in If-None-Match',
         401: 'Authentication failed',
         403: 'Permission denied'
     },
@@ -49,20 +57,49 @@ def profile_view(request):
     security=security_requirements,
     manual_parameters=[bearer_auth]
 )
-@api_view(['GET'])
+@swagger_auto_schema(
+    method='patch',
+    request_body=ProfileUpdateSerializer,
+    responses={
+        200: openapi.Response(
+            description='User profile updated successfully',
+            schema=profile_schema
+        ),
+        400: 'Invalid profile fields',
+        401: 'Authentication failed',
+        412: 'Profile changed since the ETag in If-Match'
+    },
+    operation_description="Update one or more fields of the current user's profile in a single statement",
+    operation_summary="Update User Profile",
+    tags=['User Profile'],
+    security=security_requirements,
+    manual_parameters=[bearer_auth]
+)
+@api_view(['GET', 'PATCH'])
 @permission_classes([IsAuthenticated])
 def get_user_profile(request):
+    if request.method == 'PATCH':
+        return patch_user_profile(request)
     try:
-        profile = request.user.userprofile
-        return Response({
-            'username': request.user.username,
-            'email': request.user.email,
-            'mfa_enabled': profile.mfa_enabled,
-            'phone_number': profile.phone_number,
-        })
+        entry = get_profile_entry(request.user)
+        response = not_modified(request, entry)
+        if response is None:
+            response = set_validators(Response(entry['payload']), entry['etag'], entry['last_modified'])
+        return response
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+def patch_user_profile(request):
+    serializer = ProfileUpdateSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    profile, failed = update_profile(request, serializer.validated_data)
+    if failed is not None:
+        return failed
+    entry = profile_entry(request.user, profile)
+    return set_validators(Response(entry['payload']), entry['etag'], entry['last_modified'])
+
 @swagger_auto_schema(
     method='post',
     responses={
@@ -75,7 +112,8 @@ def get_user_profile(request):
                 }
             )
         ),
-        401: 'Authentication failed'
+        401: 'Authentication failed',
+        412: 'Profile changed since the ETag in If-Match'
     },
     operation_description="Toggle Multi-Factor Authentication (MFA) for the current user",
     operation_summary="Toggle MFA",
@@ -86,10 +124,10 @@ def get_user_profile(request):
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def toggle_mfa(request):
-    profile = request.user.userprofile
-    profile.mfa_enabled = not profile.mfa_enabled
-    profile.save()
-    return Response({'mfa_enabled': profile.mfa_enabled})
+    profile, failed = update_profile(request, {'mfa_enabled': UserProfile.TOGGLE_MFA})
+    if failed is not None:
+        return failed
+    return set_profile_validators(Response({'mfa_enabled': profile.mfa_enabled}), request.user, profile)
 
 @swagger_auto_schema(
     method='post',
@@ -111,7 +149,8 @@ def toggle_mfa(request):
             )
         ),
         400: 'Phone number is required',
-        401: 'Authentication failed'
+        401: 'Authentication failed',
+        412: 'Profile changed since the ETag in If-Match'
     },
     operation_description="Update the phone number for the current user",
     operation_summary="Update Phone Number",
@@ -126,7 +165,60 @@ def update_phone(request):
     if not phone_number:
         return Response({'error': 'Phone number is required'}, status=400)
     
-    profile = request.user.userprofile
-    profile.phone_number = phone_number
-    profile.save()
-    return Response({'phone_number': profile.phone_number})
\ No newline at end of file
+    profile, failed = update_profile(request, {'phone_number': phone_number})
+    if failed is not None:
+        return failed
+    return set_profile_validators(Response({'phone_number': profile.phone_number}), request.user, profile)
+
+@swagger_auto_schema(
+    method='get',
+    query_serializer=DirectoryFilterSerializer,
+    manual_parameters=[
+        bearer_auth,
+        openapi.Parameter('cursor', openapi.IN_QUERY, description='Position of the page, from the next link of the previous page',
+                          type=openapi.TYPE_STRING),
+        openapi.Parameter('limit', openapi.IN_QUERY, description='Users per page (at most 200)',
+                          type=openapi.TYPE_INTEGER),
+    ],
+    responses={
+        200: openapi.Response(
+            description='Page of users, newest first',
+            schema=openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    'next': openapi.Schema(type=openapi.TYPE_STRING, format=openapi.FORMAT_URI, x_nullable=True),
+                    'results': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_OBJECT)),
+                }
+            )
+        ),
+        400: 'Invalid filters',
+        401: 'Authentication failed',
+        403: 'User is not staff',
+        404: 'Invalid cursor'
+    },
+    operation_description="Browse and filter user accounts for support tooling, one page per query without counting",
+    operation_summary="User Directory",
+    tags=['Users'],
+    security=security_requirements
+)
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def user_directory(request):
+    filters = DirectoryFilterSerializer(data=request.query_params.dict())
+    if not filters.is_valid():
+        return Response(filters.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    profiles = UserProfile.objects.select_related('user').only(
+        'keycloak_id', 'mfa_enabled', 'phone_number', 'created_at',
+        'user__username', 'user__email', 'user__is_active',
+    )
+    if 'email' in filters.validated_data:
+        profiles = profiles.filter(user__email__istartswith=filters.validated_data['email'])
+    if 'mfa_enabled' in filters.validated_data:
+        profiles = profiles.filter(mfa_enabled=filters.validated_data['mfa_enabled'])
+    if 'keycloak_id' in filters.validated_data:
+        profiles = profiles.filter(keycloak_id=filters.validated_data['keycloak_id'])
+
+    paginator = KeysetPagination()
+    page = paginator.paginate_queryset(profiles, request)
+    return paginator.get_paginated_response(DirectoryUserSerializer(page, many=True).data)
\ No newline at end of file